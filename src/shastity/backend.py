@@ -17,6 +17,8 @@ import shastity.hash as hash
 
 log = logging.get_logger(__name__)
 
+DEFAULT_CHUNK_SIZE = 64*1024
+
 class Backend(object):
     '''A storage backend. A backend is anything which allows four
     basic operations:
@@ -196,6 +198,38 @@ class Backend(object):
         @return The contents of the file.'''
         raise NotImplementedError
 
+    def get_chunks(self, name, chunk_size=DEFAULT_CHUNK_SIZE):
+        '''Get the contents of the file by the given name, as a
+        sequence of chunks produced as the data arrives. This allows
+        large files (i.e., manifests) to be processed incrementally.
+
+        The default implementation slices the result of get();
+        backends which are able to should override it to avoid holding
+        the entire file in memory.
+
+        @type name string
+        @param name The name of the file to get.
+
+        @param chunk_size Preferred size of each chunk. Chunks may be
+                          smaller (or, for some backends, larger).
+
+        @return An iterable of byte strings whose concatenation is the
+                contents of the file.'''
+        data = self.get(name)
+        for offset in xrange(0, len(data), chunk_size):
+            yield data[offset:offset + chunk_size]
+
+    def get_unverified_chunks(self, name, chunk_size=DEFAULT_CHUNK_SIZE):
+        '''As get_chunks(), except that backends verifying the integrity
+        of files (such as gpgcrypto.DataCryptoGPG) may produce chunks
+        before the file has been verified, failing only once it has all
+        been read. This avoids reading (and verifying) all of a file of
+        which only a prefix is wanted, but the data must only be used
+        where acting on corrupt data is harmless.
+
+        The default implementation is get_chunks().'''
+        return self.get_chunks(name, chunk_size)
+
     def list(self):
         '''Get a complete list of all files in the backend.
 
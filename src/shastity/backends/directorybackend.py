@@ -92,6 +92,18 @@ class DirectoryBackend(backend.Backend):
         with file(os.path.join(self.__path, name), 'r') as f:
             return f.read()
 
+    def get_chunks(self, name, chunk_size=backend.DEFAULT_CHUNK_SIZE):
+        assert not name.startswith(self.hidden_prefix)
+
+        log.info('getting %s (chunked)', name)
+
+        with file(os.path.join(self.__path, name), 'r') as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
     def list(self):
         log.info('listing backend files')
         return [ name for name in os.listdir(self.__path) if not name.startswith(self.hidden_prefix) ]
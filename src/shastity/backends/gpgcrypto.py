@@ -16,12 +16,18 @@ import subprocess
 import os
 import struct
 import re
+import sys
+import tempfile
+import threading
 from Crypto.Cipher import AES
 
 import shastity.backend as backend
 import shastity.hash as hash
 from shastity.util import AutoClose
 
+class GPGError(Exception):
+    pass
+
 def pipeWrap():
     return [AutoClose(x) for x in os.pipe()]
 
@@ -31,7 +37,14 @@ def enc(key, data):
 def dec(key, data):
     return encDec(key,data,extra='')
 
-def encDec(key, data, extra):
+def spawn(key, extra):
+    """spawn(key, extra)
+
+    Start gpg with the given extra arguments, reading the password
+    from a pipe, and the data from standard input.
+
+    @return The subprocess.Popen of gpg, with stdin and stdout as pipes.
+    """
     def doClose(*fds):
         """doClose()
         Write end of password pipe must be closed in child process.
@@ -55,11 +68,90 @@ def encDec(key, data, extra):
     with pass_w.fdopen('w') as f:
         f.write(key)
 
+    return p
+
+def encDec(key, data, extra):
+    p = spawn(key, extra)
     ret = p.communicate(input=data)[0]
     if p.wait():
-        raise "GPG failed"
+        raise GPGError("GPG failed")
     return ret
 
+def decStream(key, chunks, chunk_size):
+    """decStream(key, chunks, chunk_size)
+
+    Decrypt a message given as an iterable of chunks, producing the
+    plain text in chunks of chunk_size bytes (but the last) as gpg
+    produces it. The message is fed to gpg by a separate thread, and
+    neither the message nor the plain text is held in memory as a
+    whole.
+
+    gpg only verifies the integrity of the message once it has all
+    been read; GPGError is raised after the last chunk if gpg fails,
+    so consumers must not act on the plain text before it has been
+    consumed completely (see decChunks()). Consumers stopping early
+    (closing the generator) terminate gpg.
+    """
+    p = spawn(key, '')
+
+    errors = []
+    def feed():
+        try:
+            try:
+                for chunk in chunks:
+                    p.stdin.write(chunk)
+            except IOError:
+                pass # gpg went away; its exit status tells why
+            except:
+                errors.append(sys.exc_info())
+        finally:
+            try:
+                p.stdin.close()
+            except IOError:
+                pass
+
+    feeder = threading.Thread(target=feed)
+    feeder.setDaemon(True)
+    feeder.start()
+
+    try:
+        while True:
+            data = p.stdout.read(chunk_size)
+            if not data:
+                break
+            yield data
+    finally:
+        # when stopped early, gpg dies of SIGPIPE, and the feeder with it
+        p.stdout.close()
+        feeder.join()
+        status = p.wait()
+
+    if errors:
+        exc_type, exc_value, exc_tb = errors[0]
+        raise exc_type, exc_value, exc_tb
+    if status:
+        raise GPGError("GPG failed")
+
+def decChunks(key, chunks, chunk_size):
+    """decChunks(key, chunks, chunk_size)
+
+    As decStream(), but the plain text is spooled to a temporary file,
+    and only produced once gpg has verified the integrity of the
+    message as a whole; GPGError is raised before any of it otherwise.
+    """
+    spool = tempfile.TemporaryFile()
+    try:
+        for data in decStream(key, chunks, chunk_size):
+            spool.write(data)
+        spool.seek(0)
+        while True:
+            data = spool.read(chunk_size)
+            if not data:
+                break
+            yield data
+    finally:
+        spool.close()
+
 class BackendWrapper(backend.Backend):
     """BackendWrapper(backend.Backend)
 
@@ -72,10 +164,19 @@ class BackendWrapper(backend.Backend):
         return self.next.put(*args)
 
     def get(self, *args):
-        return self.next.put(*args)
+        return self.next.get(*args)
+
+    def get_chunks(self, *args):
+        return self.next.get_chunks(*args)
+
+    def get_unverified_chunks(self, *args):
+        return self.next.get_unverified_chunks(*args)
 
     def list(self, *args):
         return self.next.list(*args)
+
+    def delete(self, *args):
+        return self.next.delete(*args)
     
 class DataCryptoGPG(BackendWrapper):
     """DataCryptoGPG(BackendWrapper)
@@ -92,6 +193,12 @@ class DataCryptoGPG(BackendWrapper):
     def get(self, key):
         return dec(self.cryptoKey, self.next.get(key))
 
+    def get_chunks(self, key, chunk_size=backend.DEFAULT_CHUNK_SIZE):
+        return decChunks(self.cryptoKey, self.next.get_chunks(key, chunk_size), chunk_size)
+
+    def get_unverified_chunks(self, key, chunk_size=backend.DEFAULT_CHUNK_SIZE):
+        return decStream(self.cryptoKey, self.next.get_chunks(key, chunk_size), chunk_size)
+
 class NameCrypto(BackendWrapper):
     """NameCrypto(BackendWrapper)
 
@@ -112,6 +219,15 @@ class NameCrypto(BackendWrapper):
     def get(self, key):
         return self.next.get(self.__enc(key))
 
+    def get_chunks(self, key, *args):
+        return self.next.get_chunks(self.__enc(key), *args)
+
+    def get_unverified_chunks(self, key, *args):
+        return self.next.get_unverified_chunks(self.__enc(key), *args)
+
+    def delete(self, key):
+        return self.next.delete(self.__enc(key))
+
     def list(self):
         return [self.__dec(x) for x in self.next.list()]
 
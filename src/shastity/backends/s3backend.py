@@ -107,6 +107,20 @@ class S3Backend(backend.Backend):
 
         return k.get_contents_as_string()
 
+    def get_chunks(self, name, chunk_size=backend.DEFAULT_CHUNK_SIZE):
+        k = key.Key(bucket=self.__bucket(),
+                    name=name)
+
+        k.open_read()
+        try:
+            while True:
+                chunk = k.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            k.close()
+
     def list(self):
         for k in self.__bucket().list():
             yield k.name
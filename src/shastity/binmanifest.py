@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2009 Peter Schuller <peter.schuller@infidyne.com>
+
+'''
+Binary manifest encoding (manifest version 2).
+
+The textual (version 1) manifest format is convenient but bulky: each
+block hash is spelled out in hex along with the name of its algorithm,
+and all meta data is in decimal. Version 2 manifests share the
+textual header of version 1 (so that the version can be detected),
+followed by a binary body:
+
+  records | algorithm table | restart table | footer
+
+Records are encoded back to back, each consisting of:
+
+  - the path, front coded against the path of the preceding record:
+    varint length of the shared prefix, varint length of the remaining
+    suffix, and the suffix (UTF-8);
+  - the meta data: a varint combining the file type and permission bits
+    (see encode_mode()), varints for uid, gid and size, zigzag
+    varints for atime, mtime and ctime, and for symlinks the varint
+    length and value (UTF-8) of the symlink;
+  - the hashes: a varint count, and for each hash a varint index into
+    the algorithm table followed by a varint length and the digest.
+
+The algorithm table lists (algorithm name, raw) pairs. For raw
+algorithms, digests are stored as raw bytes and presented as lower
+case hex; other hashes (which are not hex strings) are stored as is.
+
+Every RESTART_INTERVAL:th record is a restart point, whose path is not
+front coded. The restart table holds the offsets of the restart points
+as fixed size integers, allowing any record to be located by decoding
+at most RESTART_INTERVAL records.
+
+The table thus does not hold the offset of every record: since paths
+are front coded, a record in the middle of a group cannot be decoded
+without the records preceding it anyway. Random access costs decoding
+(RESTART_INTERVAL + 1) / 2 records on average (8.5 at an interval of
+16), in exchange for a table of one offset (8 bytes) per group rather
+than per record.
+
+Malformed bodies (truncated, or otherwise corrupt) raise
+BinaryManifestError.
+
+The footer is fixed size: the offsets of the algorithm table and of
+the restart table, the number of records and a magic string. All
+offsets are relative to the start of the body.
+'''
+
+from __future__ import absolute_import
+from __future__ import with_statement
+
+import binascii
+import re
+import struct
+
+import shastity.metadata as metadata
+
+RESTART_INTERVAL = 16
+
+_FOOTER = struct.Struct('<QQQ8s')
+_FOOTER_MAGIC = 'SHMFv2\0\0'
+_OFFSET = struct.Struct('<Q')
+
+# file type codes; stored above the permission bits
+_TYPES = [ 'is_regular',
+           'is_directory',
+           'is_symlink',
+           'is_character_device',
+           'is_block_device',
+           'is_fifo' ]
+_PERMISSION_BITS = 12
+
+_hex_re = re.compile(r'^(?:[0-9a-f]{2})*$')
+
+class BinaryManifestError(Exception):
+    pass
+
+def _put_varint(out, n):
+    assert n >= 0, 'varints are unsigned: %d' % (n,)
+    while n >= 0x80:
+        out.append(chr((n & 0x7f) | 0x80))
+        n >>= 7
+    out.append(chr(n))
+
+def _get_varint(data, pos):
+    '''@return (value, new position)'''
+    result = 0
+    shift = 0
+    while True:
+        if pos >= len(data):
+            raise BinaryManifestError('manifest truncated (in varint)')
+        b = ord(data[pos])
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if b < 0x80:
+            return (result, pos)
+        shift += 7
+        if shift >= 64:
+            raise BinaryManifestError('invalid varint (longer than 64 bits)')
+
+def _zigzag(n):
+    return n * 2 if n >= 0 else -n * 2 - 1
+
+def _unzigzag(n):
+    return n // 2 if n % 2 == 0 else -(n + 1) // 2
+
+def _put_bytes(out, s):
+    _put_varint(out, len(s))
+    out.append(s)
+
+def _get_bytes(data, pos):
+    length, pos = _get_varint(data, pos)
+    if pos + length > len(data):
+        raise BinaryManifestError('manifest truncated (in string)')
+    return (data[pos:pos + length], pos + length)
+
+def _utf8(s):
+    if isinstance(s, unicode):
+        return s.encode('utf-8')
+    return s
+
+def encode_mode(md):
+    '''@return The file type and permission bits of a FileMetaData, as
+    a single integer.'''
+    for code, prop in enumerate(_TYPES):
+        if md[prop]:
+            return (code << _PERMISSION_BITS) | metadata.mode_to_bits(md)
+    raise AssertionError('should not be reachable')
+
+def decode_mode(mode):
+    '''@return The FileMetaData properties of the result of
+    encode_mode(), as a dict.'''
+    if mode >> _PERMISSION_BITS >= len(_TYPES):
+        raise BinaryManifestError('invalid file type code %d' % (mode >> _PERMISSION_BITS,))
+    props = dict([ (prop, False) for prop in _TYPES ])
+    props[_TYPES[mode >> _PERMISSION_BITS]] = True
+    props.update(metadata.bits_to_mode(mode & ((1 << _PERMISSION_BITS) - 1)))
+    return props
+
+def encode(entries):
+    '''
+    @param entries: Iterable of (path, metadata, hashes) entries.
+    @return The binary body of a version 2 manifest.'''
+    out = []
+    pos = 0          # offset of the next record
+    restarts = []
+    algos = dict()   # (name, raw) -> index
+    prevpath = ''
+    count = 0
+
+    for path, md, hashes in entries:
+        rec = []
+
+        path = _utf8(path)
+        if count % RESTART_INTERVAL == 0:
+            restarts.append(pos)
+            prefix = 0
+        else:
+            prefix = 0
+            limit = min(len(path), len(prevpath))
+            while prefix < limit and path[prefix] == prevpath[prefix]:
+                prefix += 1
+        _put_varint(rec, prefix)
+        _put_bytes(rec, path[prefix:])
+        prevpath = path
+
+        _put_varint(rec, encode_mode(md))
+        _put_varint(rec, md.uid)
+        _put_varint(rec, md.gid)
+        _put_varint(rec, md.size)
+        _put_varint(rec, _zigzag(md.atime))
+        _put_varint(rec, _zigzag(md.mtime))
+        _put_varint(rec, _zigzag(md.ctime))
+        if md.is_symlink:
+            _put_bytes(rec, _utf8(md.symlink_value))
+
+        _put_varint(rec, len(hashes))
+        for algo, digest in hashes:
+            raw = _hex_re.match(digest) is not None
+            key = (algo, raw)
+            if key not in algos:
+                algos[key] = len(algos)
+            _put_varint(rec, algos[key])
+            _put_bytes(rec, binascii.unhexlify(digest) if raw else digest)
+
+        rec = ''.join(rec)
+        out.append(rec)
+        pos += len(rec)
+        count += 1
+
+    algo_offset = pos
+    table = []
+    _put_varint(table, len(algos))
+    for (algo, raw), index in sorted(algos.items(), key=lambda item: item[1]):
+        _put_bytes(table, algo)
+        table.append(chr(1 if raw else 0))
+    table = ''.join(table)
+    out.append(table)
+
+    restart_offset = algo_offset + len(table)
+    out.extend([ _OFFSET.pack(offset) for offset in restarts ])
+
+    out.append(_FOOTER.pack(algo_offset, restart_offset, count, _FOOTER_MAGIC))
+
+    return ''.join(out)
+
+class BinaryManifest(object):
+    '''Read access to the entries of a version 2 manifest body, both
+    sequential (iteration) and random (indexing).'''
+
+    def __init__(self, data, start=0):
+        '''
+        @param data: String containing the body.
+        @param start: Offset of the body in data.
+        '''
+        if len(data) - start < _FOOTER.size:
+            raise BinaryManifestError('manifest truncated')
+
+        footer = len(data) - _FOOTER.size
+        algo_offset, restart_offset, count, magic = _FOOTER.unpack(data[footer:])
+        if magic != _FOOTER_MAGIC:
+            raise BinaryManifestError('bad manifest footer')
+        groups = (count + RESTART_INTERVAL - 1) // RESTART_INTERVAL
+        if not (algo_offset <= restart_offset and
+                start + restart_offset + groups * _OFFSET.size == footer):
+            raise BinaryManifestError('manifest truncated (or bad footer offsets)')
+
+        self.__data = data
+        self.__start = start
+        self.__count = count
+        self.__end = start + algo_offset # of the records
+        self.__restart_offset = start + restart_offset
+
+        self.__algos = []
+        pos = self.__end
+        nalgos, pos = _get_varint(data, pos)
+        for n in xrange(0, nalgos):
+            algo, pos = _get_bytes(data, pos)
+            if pos >= self.__restart_offset:
+                break
+            raw = data[pos] == chr(1)
+            pos += 1
+            self.__algos.append((algo, raw))
+        if pos > self.__restart_offset or len(self.__algos) != nalgos:
+            raise BinaryManifestError('algorithm table overruns the restart table')
+
+    def __len__(self):
+        return self.__count
+
+    def __decode(self, pos, prevpath):
+        '''@return ((path, metadata, hashes), utf-8 path, new position)'''
+        if pos >= self.__end:
+            raise BinaryManifestError('manifest truncated (fewer records than counted)')
+        try:
+            entry, path, pos = self.__decode_record(pos, prevpath)
+        except UnicodeDecodeError, e:
+            raise BinaryManifestError('invalid UTF-8 in manifest: %s' % (e,))
+        if pos > self.__end:
+            raise BinaryManifestError('record overruns the records of the manifest')
+        return (entry, path, pos)
+
+    def __decode_record(self, pos, prevpath):
+        data = self.__data
+
+        prefix, pos = _get_varint(data, pos)
+        if prefix > len(prevpath):
+            raise BinaryManifestError('front coded prefix (%d) longer than the preceding path' % (prefix,))
+        suffix, pos = _get_bytes(data, pos)
+        path = prevpath[0:prefix] + suffix
+
+        mode, pos = _get_varint(data, pos)
+        props = decode_mode(mode)
+        props['uid'], pos = _get_varint(data, pos)
+        props['gid'], pos = _get_varint(data, pos)
+        props['size'], pos = _get_varint(data, pos)
+        for prop in ('atime', 'mtime', 'ctime'):
+            value, pos = _get_varint(data, pos)
+            props[prop] = _unzigzag(value)
+        if props['is_symlink']:
+            value, pos = _get_bytes(data, pos)
+            props['symlink_value'] = value.decode('utf-8')
+
+        nhashes, pos = _get_varint(data, pos)
+        hashes = []
+        for n in xrange(0, nhashes):
+            index, pos = _get_varint(data, pos)
+            digest, pos = _get_bytes(data, pos)
+            if index >= len(self.__algos):
+                raise BinaryManifestError('invalid algorithm index %d' % (index,))
+            algo, raw = self.__algos[index]
+            hashes.append((algo, binascii.hexlify(digest) if raw else digest))
+
+        return ((path.decode('utf-8'), metadata.FileMetaData(props), hashes), path, pos)
+
+    def __iter__(self):
+        pos = self.__start
+        path = ''
+        for n in xrange(0, self.__count):
+            entry, path, pos = self.__decode(pos, path)
+            yield entry
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.__count
+        if not 0 <= index < self.__count:
+            raise IndexError(index)
+
+        group = index // RESTART_INTERVAL
+        pos = self.__start + _OFFSET.unpack_from(self.__data, self.__restart_offset + group * _OFFSET.size)[0]
+        path = ''
+        for n in xrange(group * RESTART_INTERVAL, index + 1):
+            entry, path, pos = self.__decode(pos, path)
+        return entry
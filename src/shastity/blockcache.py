@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2009 Peter Schuller <peter.schuller@infidyne.com>
+
+'''
+Restore-side block cache.
+
+Because of de-duplication, a single block may be referenced by many
+files in a manifest. Without a cache, materialization fetches (and
+decrypts) such a block once per reference. The BlockCache instead
+keeps fetched blocks around for as long as they have outstanding
+references, so that each block is fetched only once.
+
+The number of references to each block is determined by a pre-pass
+over the manifest (see count_references()). Blocks referenced only
+once are never cached. The cache is bounded both in memory and on
+disk; when memory is full, the blocks with the fewest remaining
+references are spilled to a local spool directory, and when that is
+full too, the blocks with the fewest remaining references are dropped
+(and will be fetched again if needed).
+
+Each tier keeps a heap of (remaining references, name) entries, so
+that the eviction candidate is found without sorting the tier.
+Remaining reference counts only ever decrease; release() pushes a new
+entry for a cached block, and entries which no longer match the block's
+count (or whose block has left the tier) are discarded when they come
+up.
+'''
+
+from __future__ import absolute_import
+from __future__ import with_statement
+
+import heapq
+import os
+import os.path
+import shutil
+import tempfile
+import threading
+
+import shastity.logging as logging
+import shastity.storagequeue as storagequeue
+
+log = logging.get_logger(__name__)
+
+DEFAULT_MAX_MEMORY = 64*1024*1024
+DEFAULT_MAX_DISK = 1024*1024*1024
+
+def count_references(entryiter, wanted=None):
+    '''
+    @param entryiter: Iterable of (path, metadata, hashes) manifest entries.
+    @param wanted: If given, a predicate on paths; entries for which it is
+                   false are not counted.
+    @return A dict mapping block names to the number of references.'''
+    refcounts = dict()
+    for path, metadata, hashes in entryiter:
+        if wanted is not None and not wanted(path):
+            continue
+        for algo, name in hashes:
+            refcounts[name] = refcounts.get(name, 0) + 1
+    return refcounts
+
+class BlockCache(object):
+    '''A bounded memory+disk cache of blocks keyed by block name, with
+    eviction based on remaining reference counts. Thread-safe.
+
+    @ivar hits Number of get() calls served from the cache.
+    @ivar misses Number of get() calls which had to load the block.'''
+
+    def __init__(self, refcounts, max_memory=DEFAULT_MAX_MEMORY, max_disk=DEFAULT_MAX_DISK,
+                 spooldir=None):
+        '''
+        @param refcounts: Dict of block name -> number of references (see
+                          count_references()). Taken over by the cache.
+        @param max_memory: Maximum number of bytes of block data kept in memory.
+        @param max_disk: Maximum number of bytes of block data spilled to disk.
+        @param spooldir: Directory in which to spill blocks. If None, a temporary
+                         directory is created (and removed by close()).
+        '''
+        self.max_memory = max_memory
+        self.max_disk = max_disk
+        self.hits = 0
+        self.misses = 0
+
+        self.__remaining = refcounts
+        self.__memory = dict()    # name -> data
+        self.__memory_heap = []   # (remaining, name), see module documentation
+        self.__memory_bytes = 0
+        self.__disk = dict()      # name -> size
+        self.__disk_heap = []     # (remaining, name)
+        self.__disk_bytes = 0
+        self.__loading = set()    # names currently being loaded
+        self.__cond = threading.Condition()
+
+        self.__own_spooldir = spooldir is None and max_disk > 0
+        self.__spooldir = tempfile.mkdtemp(suffix='-shastity-blockcache') if self.__own_spooldir else spooldir
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        self.close()
+
+    def close(self):
+        '''Release all cached blocks, removing the spool directory if
+        we created it.'''
+        with self.__cond:
+            for name in self.__disk.keys():
+                self.__drop_disk(name)
+            self.__memory.clear()
+            self.__memory_bytes = 0
+            del self.__memory_heap[:]
+            del self.__disk_heap[:]
+
+            if self.__own_spooldir and self.__spooldir is not None:
+                shutil.rmtree(self.__spooldir, ignore_errors=True)
+                self.__spooldir = None
+
+    def get(self, name, loader):
+        '''Return the block by the given name, calling loader() to
+        load it on a cache miss. Concurrent calls for a block that is
+        being loaded wait for that load rather than loading it again.
+
+        @return A (data, hit) tuple, where hit is whether the data came
+                from the cache.'''
+        with self.__cond:
+            while True:
+                if name in self.__memory:
+                    self.hits += 1
+                    return (self.__memory[name], True)
+                if name in self.__disk:
+                    self.hits += 1
+                    # Opened under the lock, but read outside of it; a
+                    # concurrent drop only unlinks the file.
+                    f = open(self.__spoolpath(name), 'rb')
+                    break
+                if name not in self.__loading:
+                    f = None
+                    self.misses += 1
+                    self.__loading.add(name)
+                    break
+                self.__cond.wait()
+
+        if f is not None:
+            with f:
+                return (f.read(), True)
+
+        try:
+            data = loader()
+        except:
+            with self.__cond:
+                self.__loading.remove(name)
+                self.__cond.notifyAll()
+            raise
+
+        with self.__cond:
+            self.__loading.remove(name)
+
+            # the caller's own reference is still counted; cache only
+            # if somebody else will want the block later
+            if self.__remaining.get(name, 0) > 1:
+                self.__memory[name] = data
+                self.__memory_bytes += len(data)
+                self.__push(self.__memory_heap, self.__memory, name)
+                self.__evict()
+
+            self.__cond.notifyAll()
+
+        return (data, False)
+
+    def release(self, name):
+        '''Signal that one reference to the given block has been
+        satisfied. The block is dropped once no references remain.'''
+        with self.__cond:
+            remaining = self.__remaining.get(name, 0) - 1
+            if remaining > 0:
+                self.__remaining[name] = remaining
+                if name in self.__memory:
+                    self.__push(self.__memory_heap, self.__memory, name)
+                if name in self.__disk:
+                    self.__push(self.__disk_heap, self.__disk, name)
+                return
+
+            self.__remaining.pop(name, None)
+            if name in self.__memory:
+                self.__memory_bytes -= len(self.__memory.pop(name))
+            if name in self.__disk:
+                self.__drop_disk(name)
+
+    def __spoolpath(self, name):
+        return os.path.join(self.__spooldir, name)
+
+    def __drop_disk(self, name):
+        '''@pre self.__cond locked'''
+        self.__disk_bytes -= self.__disk.pop(name)
+        os.unlink(self.__spoolpath(name))
+
+    def __push(self, heap, tier, name):
+        '''@pre self.__cond locked'''
+        heapq.heappush(heap, (self.__remaining.get(name, 0), name))
+
+        # keep stale entries from accumulating without bound
+        if len(heap) > 2 * len(tier) + 64:
+            heap[:] = [ (self.__remaining.get(n, 0), n) for n in tier ]
+            heapq.heapify(heap)
+
+    def __pop(self, heap, tier):
+        '''@pre self.__cond locked
+        @return The name of the block in the tier with the fewest
+                remaining references.'''
+        while True:
+            remaining, name = heapq.heappop(heap)
+            if name in tier and self.__remaining.get(name, 0) == remaining:
+                return name
+
+    def __evict(self):
+        '''@pre self.__cond locked'''
+        while self.__memory_bytes > self.max_memory:
+            name = self.__pop(self.__memory_heap, self.__memory)
+            data = self.__memory.pop(name)
+            self.__memory_bytes -= len(data)
+            if len(data) <= self.max_disk:
+                log.debug('spilling block %s to disk', name)
+                with open(self.__spoolpath(name), 'wb') as f:
+                    f.write(data)
+                self.__disk[name] = len(data)
+                self.__disk_bytes += len(data)
+                self.__push(self.__disk_heap, self.__disk, name)
+
+        while self.__disk_bytes > self.max_disk:
+            name = self.__pop(self.__disk_heap, self.__disk)
+            log.debug('dropping block %s from cache', name)
+            self.__drop_disk(name)
+
+class CachedGetOperation(storagequeue.GetOperation):
+    '''A GET operation which goes through a BlockCache. The caller is
+    responsible for calling release() on the cache once the block has
+    been consumed.'''
+
+    def __init__(self, name, cache, callback=None, errback=None):
+        storagequeue.GetOperation.__init__(self, name, callback, errback)
+
+        self.cache = cache
+        self.cache_hit = False
+
+    def execute(self, backend):
+        data, self.cache_hit = self.cache.get(self.name, lambda: backend.get(self.name))
+        return data
+
+    def bytes_down(self, value):
+        if self.cache_hit:
+            return 0
+        return storagequeue.GetOperation.bytes_down(self, value)
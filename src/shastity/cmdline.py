@@ -57,16 +57,33 @@ def _make_config(cmdname):
 
     if cmdname and cmdname in ('list-manifest',
                                'list-files',
-                               'persist', 'materialize',
-                               'get-blocks', 'show-manifest',
+                               'persist', 'materialize', 'extract-range',
+                               'get-blocks', 'show-manifest', 'find-file',
                                'common-blocks', 'list-blocks',
-                               'list-orphans'):
+                               'list-orphans', 'garbage-collect',
+                               'delete-manifest'):
         opts = opts.merge(options.EncryptionOptions())
         opts = opts.merge(options.S3Options())
 
     if cmdname and cmdname in ('persist'):
         opts = opts.merge(options.PersistOptions())
 
+    if cmdname and cmdname in ('persist', 'list-manifest', 'list-orphans', 'common-blocks',
+                               'garbage-collect', 'delete-manifest'):
+        opts = opts.merge(options.ManifestCacheOptions())
+
+    if cmdname and cmdname in ('persist', 'materialize', 'extract-range'):
+        opts = opts.merge(options.StorageQueueOptions())
+
+    if cmdname and cmdname in ('materialize',):
+        opts = opts.merge(options.MaterializeOptions())
+
+    if cmdname and cmdname in ('list-manifest',):
+        opts = opts.merge(options.ListManifestOptions())
+
+    if cmdname and cmdname in ('garbage-collect',):
+        opts = opts.merge(options.GarbageCollectOptions())
+
     return opts
 
 def _build_parser():
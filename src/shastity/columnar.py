@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2009 Peter Schuller <peter.schuller@infidyne.com>
+
+'''
+Columnar in-memory representation of manifests.
+
+A manifest held as a list of (path, FileMetaData, hashes) tuples costs
+several hundred bytes per entry, mostly in per-object overhead of the
+meta data instances; holding all manifests of a large backend is not
+feasible that way. A ColumnarManifest instead keeps each field of all
+entries in a single typed array (see the array module):
+
+  - paths: one blob of UTF-8 encoded paths, with an array of offsets;
+  - meta data: arrays of mode (file type and permission bits, as in
+    binmanifest), uid, gid, size and times; symlink values, being rare,
+    in a dict;
+  - hashes: a table of all digests (one blob, with an array of offsets
+    and an array of algorithms), with an array of offsets into it per
+    entry. Hex digests are stored as raw bytes.
+
+Entries are decoded on access, such that a ColumnarManifest can be
+used wherever a list of entries is expected (len(), indexing and
+iteration), while commands interested in all entries at once work on
+the columns directly.
+'''
+
+from __future__ import absolute_import
+from __future__ import with_statement
+
+import array
+import binascii
+import re
+
+import shastity.binmanifest as binmanifest
+import shastity.manifest as manifest
+import shastity.metadata as metadata
+
+_hex_re = re.compile(r'^(?:[0-9a-f]{2})*$')
+
+def _utf8(s):
+    if isinstance(s, unicode):
+        return s.encode('utf-8')
+    return s
+
+class ColumnarManifest(object):
+    '''
+    The entries of a manifest, by column. Instances are built by
+    from_entries() (or load()), and are to be treated as read-only.
+
+    @ivar mode  Array of file type and permission bits (binmanifest.encode_mode()).
+    @ivar uid   Array of owner UIDs.
+    @ivar gid   Array of group owner GIDs.
+    @ivar size  Array of file sizes.
+    @ivar atime Array of access times.
+    @ivar mtime Array of modification times.
+    @ivar ctime Array of ctimes.
+    @ivar hash_offsets Array of the offsets of the hashes of each entry in
+                       the digest table (one more than the number of
+                       entries; the hashes of entry n are those from
+                       hash_offsets[n] up to hash_offsets[n + 1]).
+    '''
+
+    def __init__(self):
+        self.__paths = array.array('c')
+        self.__path_offsets = array.array('L', [ 0 ])
+
+        self.mode = array.array('H')
+        self.uid = array.array('L')
+        self.gid = array.array('L')
+        self.size = array.array('l')
+        self.atime = array.array('l')
+        self.mtime = array.array('l')
+        self.ctime = array.array('l')
+        self.__symlinks = dict() # ordinal -> symlink value
+
+        self.__algos = []        # (name, raw)
+        self.__algo_index = dict()
+        self.__digests = array.array('c')
+        self.__digest_offsets = array.array('L', [ 0 ])
+        self.__digest_algos = array.array('B')
+        self.hash_offsets = array.array('L', [ 0 ])
+
+    @classmethod
+    def from_entries(cls, entries):
+        '''
+        @param entries: Iterable of (path, metadata, hashes) entries.
+        '''
+        mf = cls()
+        for entry in entries:
+            mf.__append(entry)
+        return mf
+
+    def __append(self, entry):
+        path, md, hashes = entry
+
+        self.__paths.fromstring(_utf8(path))
+        self.__path_offsets.append(len(self.__paths))
+
+        self.mode.append(binmanifest.encode_mode(md))
+        self.uid.append(md.uid)
+        self.gid.append(md.gid)
+        self.size.append(md.size)
+        self.atime.append(md.atime)
+        self.mtime.append(md.mtime)
+        self.ctime.append(md.ctime)
+        if md.is_symlink:
+            self.__symlinks[len(self.mode) - 1] = md.symlink_value
+
+        for algo, digest in hashes:
+            raw = _hex_re.match(digest) is not None
+            key = (algo, raw)
+            if key not in self.__algo_index:
+                assert len(self.__algos) < 256, 'too many hash algorithms'
+                self.__algo_index[key] = len(self.__algos)
+                self.__algos.append(key)
+            self.__digests.fromstring(binascii.unhexlify(digest) if raw else digest)
+            self.__digest_offsets.append(len(self.__digests))
+            self.__digest_algos.append(self.__algo_index[key])
+        self.hash_offsets.append(len(self.__digest_algos))
+
+    def __len__(self):
+        return len(self.mode)
+
+    def __index(self, n):
+        if n < 0:
+            n += len(self)
+        if not 0 <= n < len(self):
+            raise IndexError('manifest entry index out of range')
+        return n
+
+    def path(self, n):
+        '''@return The path of entry n.'''
+        n = self.__index(n)
+        return self.__paths[self.__path_offsets[n]:self.__path_offsets[n + 1]].tostring().decode('utf-8')
+
+    def metadata(self, n):
+        '''@return The FileMetaData of entry n.'''
+        n = self.__index(n)
+        props = binmanifest.decode_mode(self.mode[n])
+        props.update(dict(uid=self.uid[n],
+                          gid=self.gid[n],
+                          size=self.size[n],
+                          atime=self.atime[n],
+                          mtime=self.mtime[n],
+                          ctime=self.ctime[n]))
+        if n in self.__symlinks:
+            props['symlink_value'] = self.__symlinks[n]
+        return metadata.FileMetaData(props)
+
+    def __digest(self, d):
+        algo, raw = self.__algos[self.__digest_algos[d]]
+        digest = self.__digests[self.__digest_offsets[d]:self.__digest_offsets[d + 1]].tostring()
+        return (algo, binascii.hexlify(digest) if raw else digest)
+
+    def hashes(self, n):
+        '''@return The list of (algo, hex) hashes of entry n.'''
+        n = self.__index(n)
+        return [ self.__digest(d) for d in xrange(self.hash_offsets[n], self.hash_offsets[n + 1]) ]
+
+    def __getitem__(self, n):
+        return (self.path(n), self.metadata(n), self.hashes(n))
+
+    def __iter__(self):
+        for n in xrange(0, len(self)):
+            yield self[n]
+
+    def block_count(self):
+        '''@return The number of block references (not necessarily distinct).'''
+        return len(self.__digest_algos)
+
+    def blocks(self):
+        '''@return The set of distinct (algo, hex) blocks referenced.'''
+        return set([ self.__digest(d) for d in xrange(0, self.block_count()) ])
+
+    def total_size(self):
+        '''@return The total size of all files.'''
+        return sum(self.size)
+
+    def stats(self):
+        '''@return The ManifestStats of the entries.'''
+        return manifest.ManifestStats(files=len(self),
+                                      blocks=self.block_count(),
+                                      bytes=self.total_size())
+
+def load(backend, name, **kwargs):
+    '''
+    Read a manifest (see manifest.read_manifest(), to which keyword
+    arguments are passed) into a ColumnarManifest.
+    '''
+    return ColumnarManifest.from_entries(manifest.read_manifest(backend, name, **kwargs))
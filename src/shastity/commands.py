@@ -40,18 +40,26 @@ library interface, while keeping the implementation identical.
 from __future__ import absolute_import
 from __future__ import with_statement
 
+import os
 import re
+import sys
 import locale
 
 import shastity.options as options
 import shastity.config as config
+import shastity.blockcache as blockcache
+import shastity.columnar as columnar
 import shastity.benchmark as benchmark
 import shastity.traversal as traversal
 import shastity.logging as logging
 import shastity.manifest as manifest
+import shastity.manifestcache as manifestcache
+import shastity.refindex as refindex
 import shastity.filesystem as filesystem
 import shastity.persistence as persistence
 import shastity.materialization as materialization
+import shastity.ratelimit as ratelimit
+import shastity.selection as selection
 import shastity.storagequeue as storagequeue
 import shastity.backends.s3backend as s3backend
 import shastity.backends.directorybackend as directorybackend
@@ -59,6 +67,9 @@ import shastity.backends.gpgcrypto as gpgcrypto
 
 log = logging.get_logger(__name__)
 
+class CommandError(Exception):
+    pass
+
 # In the future we'll have groups of commands too, or else command
 # listings to the user become too verbose.
 
@@ -84,7 +95,11 @@ _all_commands = [ Command('persist',
                   Command('materialize',
                           ['src-uri', 'dst-path'],
                           options.GlobalOptions(),
-                          description='Materialize (restore) a directory tree.'),
+                          description='Materialize (restore) a directory tree (or, with --to-tar, write it as a tar stream).'),
+                  Command('extract-range',
+                          ['src-uri', 'path', 'offset', 'length', '[dst-path]'],
+                          options.GlobalOptions(),
+                          description='Extract a byte range of a single file (to dst-path, or standard output).'),
                   Command('verify',
                           ['src-path', 'dst-uri'],
                           options.GlobalOptions(),
@@ -92,7 +107,11 @@ _all_commands = [ Command('persist',
                   Command('garbage-collect',
                           ['dst-uri'],
                           options.GlobalOptions(),
-                          description='Garbage collect backend, removing unreferenced data (thus reclaiming space).'),
+                          description='Garbage collect backend, removing unreferenced data (thus reclaiming space). Refuses to run if the manifest backend holds objects it cannot account for. Must not run concurrently with persist.'),
+                  Command('delete-manifest',
+                          ['uri', 'label'],
+                          options.GlobalOptions(),
+                          description='Delete a manifest, updating block reference counts'),
                   Command('test-backend',
                           ['dst-uri'],
                           options.GlobalOptions(),
@@ -114,9 +133,13 @@ _all_commands = [ Command('persist',
                           options.GlobalOptions(),
                           description='Get a backend block by its plaintext name'),
                   Command('show-manifest',
-                          ['uri', 'label'],
+                          ['uri', 'label', '[path...]'],
+                          options.GlobalOptions(),
+                          description='Show manifest (or only the given paths) in readable format'),
+                  Command('find-file',
+                          ['uri', 'path'],
                           options.GlobalOptions(),
-                          description='Show manifest in readable format'),
+                          description='List the manifests containing the given path'),
                   Command('list-blocks',
                           ['uri'],
                           options.GlobalOptions(),
@@ -148,27 +171,50 @@ def get_command(name):
     return matching[0]
 
 CONCURRENCY = 10 # TODO: hard-coded
-def flatten(z):
-    return reduce(lambda x,y: x + y, z)
 
-def get_all_manifests(be):
-    return [(x, list(manifest.read_manifest(be, x)))
-            for x in manifest.list_manifests(be)]
+def get_manifest_cache(config, uri):
+    """
+    @return A ManifestCache for the manifests at the given URI, or None if
+            caching is disabled.
+    """
+    max_mb = config.get_option('manifest-cache-mb').get_required()
+    if max_mb <= 0:
+        return None
+    cachedir = os.path.expanduser(config.get_option('manifest-cache').get_required())
+    return manifestcache.ManifestCache(cachedir, uri, max_bytes=max_mb * 1024 * 1024)
 
-def get_all_blockhashes(mfs, unique = True):
-    ret = flatten([x[2] for x in flatten(mfs)])
-    if unique:
-        ret = list(set(ret))
-    return ret
+def get_refcount_index(config, uri, be):
+    """
+    @return The RefcountIndex of the manifests at the given URI, brought
+            up to date with the manifests present.
+    """
+    cache = get_manifest_cache(config, uri)
+    index = refindex.RefcountIndex(be)
+    if cache is not None:
+        index.sync(loader=lambda name: cache.get(be, name))
+    else:
+        index.sync()
+    return index
 
 def persist(conf, src_path, dst_uri):
     mpath, label, dpath = dst_uri.split(',')
     blocksize = conf.get_option('block-size').get_required()
+    mf_version = conf.get_option('manifest-version').get_required()
+    if mf_version not in manifest.FORMAT_VERSIONS:
+        raise CommandError('unsupported manifest version: %d' % (mf_version,))
 
     bf_manifest = get_backend_factory(mpath, conf)
     b_manifest = bf_manifest()
     bf_data = get_backend_factory(dpath, conf)
 
+    parent = conf.get_option('parent').get()
+    if parent == label:
+        raise CommandError('manifest %s cannot be its own parent' % (label,))
+    if label in manifest.list_manifests(b_manifest):
+        children = manifest.dependents(b_manifest, label)
+        if children:
+            raise CommandError('cannot replace manifest %s, the parent of %s' % (label, ', '.join(children)))
+
     uploaded = []
 
     try:
@@ -183,12 +229,11 @@ def persist(conf, src_path, dst_uri):
     except config.RequiredOptionMissingError, e:
         pass
 
+    refs = None
     if not conf.get_option('skip-blocks').get():
-        log.info("checking old manifests...")
-        mfs = get_all_manifests(b_manifest)
-        if len(mfs) != 0:
-            mfs = zip(*mfs)[1]
-            uploaded.extend(get_all_blockhashes(mfs))
+        log.info("loading block reference counts...")
+        refs = get_refcount_index(conf, mpath, b_manifest)
+        uploaded.extend(refs.referenced())
 
     if conf.get_option('continue').get_required():
         log.info("checking for previously upped blocks...")
@@ -201,28 +246,208 @@ def persist(conf, src_path, dst_uri):
     # run persist
     fs = filesystem.LocalFileSystem()
     traverser = traversal.traverse(fs, src_path)
-    sq = storagequeue.StorageQueue(bf_data,
-                                   CONCURRENCY)
-    mf = list(persistence.persist(fs,
-                                  traverser,
-                                  None,
-                                  src_path,
-                                  sq,
-                                  blocksize=blocksize,
-                                  skip_blocks=uploaded))
-    manifest.write_manifest(b_manifest, label, mf)
-
-def materialize(config, src_uri, dst_path, *files):
+    sq = get_storage_queue(conf, bf_data)
+    mf = persistence.persist(fs,
+                             traverser,
+                             None,
+                             src_path,
+                             sq,
+                             blocksize=blocksize,
+                             skip_blocks=uploaded)
+    known = set(uploaded)
+    blocks = set()
+    def collect_blocks(entries):
+        for entry in entries:
+            blocks.update(entry[2])
+            yield entry
+    mf = collect_blocks(mf)
+    # segments are uploaded as entries are produced; the manifest
+    # itself once all blocks are stored
+    segment_mb = conf.get_option('manifest-segment-mb').get_required()
+    manifest.write_manifest(b_manifest, label, mf, version=mf_version,
+                            segment_size=(segment_mb * 1024 * 1024 if segment_mb > 0 else None),
+                            index=conf.get_option('path-index').get_required(),
+                            parent=parent,
+                            max_depth=conf.get_option('max-delta-depth').get_required(),
+                            new_blocks=lambda: len(blocks - known))
+
+    if refs is None:
+        refs = refindex.RefcountIndex(b_manifest)
+    if label in refs.manifests():
+        refs.remove(label) # replaced; uses the old block set
+    refindex.write_block_set(b_manifest, label, blocks)
+    refs.add(label, blocks)
+
+def _manifest_order(entry):
+    return entry[0].split('/')
+
+def _indexed_entries(backend, label, files):
+    '''Resolve a selection through the path index of a manifest, if
+    possible: when all requested paths are literal and none of them is
+    a directory (whose contents would have to be found too).
+
+    @return The selected entries and their ancestors, in manifest order;
+            or None if the selection cannot be resolved this way.'''
+    if [ p for p in files.patterns if not selection.is_literal(p) ]:
+        return None
+    if not manifest.has_path_index(backend, label):
+        return None
+
+    paths = [ selection.normalize(p) for p in files.patterns ]
+    wanted = set(paths)
+    for path in paths:
+        wanted.update(selection.ancestors(path))
+
+    found = manifest.lookup(backend, label, wanted)
+    for path, meta, hashes in found.values():
+        if meta.is_directory and files.selects(path):
+            return None
+
+    return sorted(found.values(), key=_manifest_order)
+
+def materialize(config, src_uri, dst_path=None, *files):
+    to_tar = config.get_option('to-tar').get()
+    if to_tar is not None and dst_path is not None:
+        # no destination directory; all arguments are files
+        files = (dst_path,) + files
     if len(files) == 0:
         files = None
+    else:
+        files = selection.PathSelector(files)
     mpath, label, dpath = src_uri.split(',')
+    if to_tar is not None:
+        return materialize_to_tar(config, mpath, label, dpath, to_tar, files)
+    if dst_path is None:
+        raise CommandError('materialize requires a destination path (or --to-tar)')
     fs = filesystem.LocalFileSystem()
-    fs.mkdir(dst_path)
-    mf = list(manifest.read_manifest(get_backend_factory(mpath, config)(),
-                                     label))
-    sq = storagequeue.StorageQueue(get_backend_factory(dpath, config),
-                                   CONCURRENCY)
-    materialization.materialize(fs, dst_path, mf, sq, files)
+    delta = config.get_option('delta').get_required()
+    resume = config.get_option('resume').get_required()
+    if not ((delta or resume) and fs.is_dir(dst_path)):
+        fs.mkdir(dst_path)
+    # streamed, and read once per pass over it rather than held in memory
+    bf_manifest = get_backend_factory(mpath, config)
+    mf_factory = lambda: manifest.read_manifest(bf_manifest(), label, backend_factory=bf_manifest)
+    if files is not None:
+        entries = _indexed_entries(bf_manifest(), label, files)
+        if entries is not None:
+            log.info('selected %d entries through the path index', len(entries))
+            mf_factory = lambda: entries
+    hedge_percentile = config.get_option('hedge-percentile').get()
+    hedge_budget = config.get_option('hedge-budget').get_required() / 100.0
+    sq_factory = lambda: get_storage_queue(config,
+                                           get_backend_factory(dpath, config),
+                                           hedge_percentile=hedge_percentile,
+                                           hedge_budget=hedge_budget)
+    cache_memory = config.get_option('block-cache-memory').get_required() * 1024 * 1024
+    cache_disk = config.get_option('block-cache-disk').get_required() * 1024 * 1024
+    def cache_factory(entries):
+        if cache_memory <= 0:
+            return None
+        return blockcache.BlockCache(blockcache.count_references(entries),
+                                     max_memory=cache_memory,
+                                     max_disk=cache_disk)
+    fsync = config.get_option('fsync').get_required()
+    if fsync == 'batch':
+        sync_policy = materialization.make_sync_policy(
+            fsync,
+            max_files=config.get_option('fsync-batch-files').get_required(),
+            max_bytes=config.get_option('fsync-batch-mb').get_required() * 1024 * 1024)
+    else:
+        sync_policy = materialization.make_sync_policy(fsync)
+    # the journal is only kept by restores that may be resumed again
+    journal = None
+    if resume:
+        journal = materialization.RestoreJournal(fs,
+                                                 os.path.join(dst_path, materialization.JOURNAL_NAME),
+                                                 resume=True)
+    kwargs = dict(positional=config.get_option('out-of-order').get_required(),
+                  blocksize=config.get_option('block-size').get_required(),
+                  sync_policy=sync_policy,
+                  delta=delta,
+                  sparse=config.get_option('sparse').get_required(),
+                  apply_metadata=config.get_option('restore-metadata').get_required(),
+                  chown=(os.geteuid() == 0),
+                  journal=journal,
+                  resume=resume,
+                  verify=config.get_option('resume-verify').get_required())
+    processes = config.get_option('processes').get_required()
+    completed = False
+    try:
+        if processes > 1:
+            materialization.materialize_sharded(fs, dst_path, mf_factory, sq_factory, processes, files,
+                                                cache_factory=cache_factory,
+                                                incremental=(delta or resume),
+                                                **kwargs)
+        else:
+            cache = cache_factory(materialization.select_entries(files, mf_factory()))
+            try:
+                with sq_factory() as sq:
+                    materialization.materialize(fs, dst_path, mf_factory(), sq, files,
+                                                block_cache=cache,
+                                                **kwargs)
+            finally:
+                if cache is not None:
+                    cache.close()
+        completed = True
+    finally:
+        if journal is not None:
+            journal.close(remove=completed)
+
+def materialize_to_tar(config, mpath, label, dpath, tar_path, files):
+    entries = manifest.read_manifest(get_backend_factory(mpath, config)(), label)
+    with get_storage_queue(config, get_backend_factory(dpath, config)) as sq:
+        if tar_path == '-':
+            out = sys.stdout
+        else:
+            out = open(tar_path, 'wb')
+        try:
+            materialization.materialize_to_tar(entries, sq, out, files)
+        finally:
+            if tar_path == '-':
+                out.flush()
+            else:
+                out.close()
+
+def extract_range(config, src_uri, path, offset, length, dst_path=None):
+    mpath, label, dpath = src_uri.split(',')
+    path = selection.normalize(path).decode('utf-8')
+    # through the path index, if the manifest has one
+    entries = manifest.lookup(get_backend_factory(mpath, config)(), label, [ path ]).values()
+    with get_storage_queue(config, get_backend_factory(dpath, config)) as sq:
+        if dst_path is None:
+            out = sys.stdout
+        else:
+            out = open(dst_path, 'wb')
+        try:
+            materialization.extract_range(entries, path, sq, out,
+                                          blocksize=config.get_option('block-size').get_required(),
+                                          offset=int(offset),
+                                          length=int(length))
+        finally:
+            if dst_path is None:
+                out.flush()
+            else:
+                out.close()
+
+def get_storage_queue(config, backend_factory, **kwargs):
+    """get_storage_queue(config, backend_factory, **kwargs)
+
+    Creates a StorageQueue for the given backend factory, applying the
+    rate limiting options. Additional keyword arguments are passed on
+    to the StorageQueue.
+    """
+    limits = config.get_option('rate-limit').get()
+    limits = ratelimit.parse_limits(limits) if limits else ratelimit.UNLIMITED
+
+    schedule = config.get_option('rate-schedule').get()
+    if schedule:
+        schedule = ratelimit.parse_schedule(schedule, default=limits)
+
+    return storagequeue.StorageQueue(backend_factory,
+                                     CONCURRENCY,
+                                     limits=limits,
+                                     schedule=schedule or None,
+                                     **kwargs)
 
 def get_backend_factory(uri, config):
     """get_backend_factory(uri, config)
@@ -256,7 +481,7 @@ def get_backend_factory(uri, config):
     return ret3
 
 
-def show_manifest(config, uri, label):
+def show_manifest(config, uri, label, *paths):
     def number_group(n, sep):
         # TODO: if boto didn't bork out we would use locale instead of re:
         # return locale.format('%d', attr.size, grouping=True)
@@ -269,7 +494,12 @@ def show_manifest(config, uri, label):
     print "-" * (10 + 7 + 14 + 2 + 10)
     totblocks = 0
     totsize = 0
-    for name,attr,sums in manifest.read_manifest(b, label):
+    if paths:
+        found = manifest.lookup(b, label, [ selection.normalize(p) for p in paths ])
+        entries = sorted(found.values(), key=_manifest_order)
+    else:
+        entries = manifest.read_manifest(b, label)
+    for name,attr,sums in entries:
         totblocks += len(sums)
         totsize += attr.size
         print "%10s %7s %14s %s" % (
@@ -304,6 +534,21 @@ def uniq_c(arr):
         ret.append( (count, last) )
     return ret
 
+def find_file(config, uri, path):
+    b = get_backend_factory(uri, config)()
+    path = selection.normalize(path)
+
+    found = 0
+    for label in sorted(manifest.list_manifests(b)):
+        if not manifest.might_contain(b, label, path):
+            continue
+        entry = manifest.lookup(b, label, [ path ]).get(path.decode('utf-8'))
+        if entry is not None:
+            found += 1
+            print "%-30s %s" % (label, entry[1].to_string())
+    if not found:
+        print "Found no manifests containing %s" % (path,)
+
 def list_files(config, uri):
     b = get_backend_factory(uri, config)()
     fs = b.list()
@@ -314,68 +559,81 @@ def list_files(config, uri):
 def list_manifest(config, uri):
     b = get_backend_factory(uri, config)()
 
-    lmfs = list(get_all_manifests(b))
-    lmfs.sort()
+    labels = manifest.list_manifests(b)
+    labels.sort()
 
-    if not len(lmfs):
+    if not len(labels):
         print "Found no manifests"
         return
 
-    labels,mfs = zip(*lmfs)
-    uploaded = get_all_blockhashes(mfs, unique=False)
-    nuploaded = len(set(uploaded))
-
-    uploaded.sort()
-    dups = [y for x,y in uniq_c(uploaded) if x > 1]
-    dups = dict(zip(dups, [1] * len(uploaded)))
-
-    # TODO: not really happy with the speed of this
-    #@benchmark.Benchmark('/tmp/shastity.txt', 'persist.print_it')
-    def print_it():
-        totfiles = 0
-        totblocks = 0
-        totsize = 0
-        shead = "%-30s %6s %7s %7s %7s"
-        sdata = "%-30s %6d %7d %7d %7d"
-        print shead % ('Manifest', 'Files', 'Blocks', 'Shared', 'MB')
-        print "-" * 79
-        for label,mf in lmfs:
-            shared = 0
-            size = sum([x[1].size for x in mf])
-            blocks = flatten([x[2] for x in mf])
-            shared = sum([x in dups for x in blocks])
-            totfiles += len(mf)
-            totblocks += len(blocks)
-            totsize += size
-            print sdata % (label,
-                           len(mf),
-                           len(blocks),
-                           shared,
-                           size / 1000000)
-        print "-" * 79
-        print (sdata % ('Total',
+    # statistics are in the headers; only manifests predating them are
+    # read in full
+    cache = None
+    lmfs = []
+    for label in labels:
+        stats = manifest.read_stats(b, label)
+        if stats is None:
+            log.debug('manifest %s has no statistics; reading it', label)
+            if cache is None:
+                cache = get_manifest_cache(config, uri)
+            mf = cache.get(b, label) if cache is not None else columnar.load(b, label)
+            stats = mf.stats()
+        lmfs.append((label, stats))
+
+    counts = None
+    if config.get_option('shared').get_required():
+        counts = get_refcount_index(config, uri, b).counts()
+
+    def fmt(n):
+        return '-' if n is None else str(n)
+
+    totfiles = 0
+    totblocks = 0
+    totsize = 0
+    shead = "%-30s %6s %7s %7s %7s %7s"
+    print shead % ('Manifest', 'Files', 'Blocks', 'New', 'Shared', 'MB')
+    print "-" * 79
+    for label,stats in lmfs:
+        shared = None
+        if counts is not None:
+            shared = len([ block for block in refindex.read_block_set(b, label) if counts.get(block, 0) > 1 ])
+        totfiles += stats.files
+        totblocks += stats.blocks
+        totsize += stats.bytes
+        print shead % (label,
+                       stats.files,
+                       stats.blocks,
+                       fmt(stats.new_blocks),
+                       fmt(shared),
+                       stats.bytes / 1000000)
+    print "-" * 79
+    if counts is not None:
+        print (shead % ('Total',
                         totfiles,
-                        nuploaded,
-                        totblocks-nuploaded,
+                        len(counts),
+                        '',
+                        totblocks-len(counts),
                         totsize/1000000)) + ' unpacked/unshared'
-    print_it()
-
-
+    else:
+        print shead % ('Total',
+                       totfiles,
+                       totblocks,
+                       '',
+                       '-',
+                       totsize/1000000)
 
 def common_blocks(config, uri, *mf_names):
     b = get_backend_factory(uri, config)()
-    mfs = [manifest.read_manifest(b, x) for x in mf_names]
-    blocks = [get_all_blockhashes([x]) for x in mfs]
-    all_blocks = flatten(blocks)
-    before = [len(x) for x in blocks]
-    [ [bl.remove(x) for bl in blocks]
-       for x in list(set(all_blocks))
-       if all_blocks.count(x) == len(mf_names)
-       ]
-    after = [len(x) for x in blocks]
-    for nm,bf,af in zip(mf_names,before,after):
-        print '%d unique in %s' % (af, nm)
-    print '%d in common' % (before[0] - after[0])
+    cache = get_manifest_cache(config, uri)
+    if cache is not None:
+        mfs = [cache.get(b, x) for x in mf_names]
+    else:
+        mfs = [columnar.load(b, x) for x in mf_names]
+    blocks = [mf.blocks() for mf in mfs]
+    common = set.intersection(*blocks)
+    for nm,bl in zip(mf_names,blocks):
+        print '%d unique in %s' % (len(bl - common), nm)
+    print '%d in common' % (len(common),)
 
 
 def get_block(config, uri, block_name, local_name=None):
@@ -396,20 +654,54 @@ def list_orphans(config, uri):
     all_blocks = b_data.list()
 
     b_manifest = get_backend_factory(mpath, config)()
-    lmfs = list(get_all_manifests(b_manifest))
-    labels,mfs = zip(*lmfs)
-    mf_blocks = get_all_blockhashes(mfs, unique=False)
+    referenced = set([ hex for algo, hex in get_refcount_index(config, mpath, b_manifest).referenced() ])
 
     for hash in all_blocks:
-        algo = 'sha512' # TODO: assumed this
-        if (algo, hash) not in all_blocks:
+        if hash not in referenced:
             print hash
 
+def delete_manifest(config, uri, label):
+    b = get_backend_factory(uri, config)()
+    children = manifest.dependents(b, label)
+    if children:
+        raise CommandError('cannot delete manifest %s, the parent of %s' % (label, ', '.join(children)))
+    get_refcount_index(config, uri, b).delete_manifest(label)
+
 def verify(config, src_path, dst_uri):
     raise NotImplementedError('very not implemented')
 
 def garbage_collect(config, dst_uri):
-    raise NotImplementedError('garbage_collect not implemented')
+    mpath, dpath = dst_uri.split(',')
+
+    dry_run = config.get_option('dry-run').get_required()
+
+    b_manifest = get_backend_factory(mpath, config)()
+    index = get_refcount_index(config, mpath, b_manifest)
+
+    # every object in the manifest backend must be accounted for; one
+    # that is not may be (part of) a manifest referencing blocks that
+    # would otherwise be deleted
+    unexplained = index.unexplained()
+    if unexplained:
+        raise CommandError('refusing to garbage collect: %d unexpected object(s) in the manifest backend: %s'
+                           % (len(unexplained), ', '.join(unexplained[:10] + ([ '...' ] if len(unexplained) > 10 else []))))
+
+    referenced = set([ hex for algo, hex in index.referenced() ])
+
+    b_data = get_backend_factory(dpath, config)()
+    deleted = 0
+    for hash in b_data.list():
+        if hash not in referenced:
+            if dry_run:
+                print hash
+            else:
+                log.info('deleting unreferenced block %s', hash)
+                b_data.delete(hash)
+            deleted += 1
+    if dry_run:
+        log.info('would delete %d unreferenced blocks', deleted)
+    else:
+        log.info('deleted %d unreferenced blocks', deleted)
 
 def test_backend(config, dst_uri):
     raise NotImplementedError('test-backend not implemented')
@@ -28,6 +28,8 @@ mount points, types, or anything like that.
 from __future__ import absolute_import
 from __future__ import with_statement
 
+import ctypes
+import ctypes.util
 import errno
 import os
 import os.path
@@ -37,6 +39,20 @@ import tempfile
 
 import shastity.metadata as metadata
 
+_libc = None
+
+def _get_libc():
+    '''Return a ctypes handle to the C library, for the handful of
+    system calls not exposed by the os module, or None if
+    unavailable.'''
+    global _libc
+    if _libc is None:
+        try:
+            _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        except OSError, e:
+            _libc = False
+    return _libc or None
+
 class StaleTemporaryDirectory(Exception):
     '''Raised to indicate that an attempt to use a stale (cleaned up)
     temporary directory was detected.'''
@@ -114,6 +130,54 @@ class FileSystem(object):
     def fsync(self, fileno):
         raise NotImplementedError
 
+    def rename(self, src, dst):
+        raise NotImplementedError
+
+    def chmod(self, path, bits):
+        '''Set the permission bits (see metadata.mode_to_bits()) of the
+        given path, following symlinks.'''
+        raise NotImplementedError
+
+    def lchown(self, path, uid, gid):
+        '''Set the ownership of the given path, not following symlinks.'''
+        raise NotImplementedError
+
+    def utime(self, path, atime, mtime):
+        '''Set the access and modification times (seconds since epoch)
+        of the given path, following symlinks.'''
+        raise NotImplementedError
+
+    def start_writeback(self, fileno):
+        '''Initiate (but do not wait for) write-out of the dirty data
+        of the given file descriptor, as by sync_file_range(2) with
+        SYNC_FILE_RANGE_WRITE. A no-op where unsupported.'''
+        pass
+
+    def syncfs(self, path):
+        '''Flush all data of the file system containing the given path
+        to stable storage, as by syncfs(2), or sync(2) where syncfs(2)
+        is unavailable.'''
+        raise NotImplementedError
+
+    def allocate(self, fobj, size):
+        '''Extend the open file to the given size, reserving space for
+        it if the file system supports it (as by posix_fallocate()).'''
+        fobj.truncate(size)
+
+    def pwrite(self, fobj, offset, data):
+        '''Write data at the given offset of the open file. Unlike
+        pwrite(2), this moves the file position, so callers sharing a
+        file object must serialize their calls.'''
+        fobj.seek(offset)
+        fobj.write(data)
+
+    def punch_hole(self, fobj, offset, length):
+        '''Deallocate the given range of the open file, such that it
+        reads as zeros without occupying space, without changing the
+        size of the file (as by fallocate() with FALLOC_FL_PUNCH_HOLE).
+        Where unsupported, the range is overwritten with zeros.'''
+        self.pwrite(fobj, offset, '\0' * length)
+
     def is_symlink(self, path):
         '''@return Whether the given path is a symlink.'''
         raise NotImplementedError
@@ -130,7 +194,7 @@ class FileSystem(object):
         '''
         Stat the file at the given path, resutling in a FileMetaData object.
 
-        @return A FileMetaData object.'''
+        @return A FileMetaData (or StatMetaData) object.'''
         raise NotImplementedError
 
     def rmtree(self, path):
@@ -185,6 +249,62 @@ class LocalFileSystem(FileSystem):
     def fsync(self, fileno):
         os.fsync(fileno)
 
+    def rename(self, src, dst):
+        os.rename(src, dst)
+
+    def chmod(self, path, bits):
+        os.chmod(path, bits)
+
+    def lchown(self, path, uid, gid):
+        os.lchown(path, uid, gid)
+
+    def utime(self, path, atime, mtime):
+        os.utime(path, (atime, mtime))
+
+    def start_writeback(self, fileno):
+        libc = _get_libc()
+        if libc is not None and hasattr(libc, 'sync_file_range'):
+            SYNC_FILE_RANGE_WRITE = 2
+            libc.sync_file_range(fileno, ctypes.c_int64(0), ctypes.c_int64(0), SYNC_FILE_RANGE_WRITE)
+
+    def syncfs(self, path):
+        libc = _get_libc()
+        if libc is not None and hasattr(libc, 'syncfs'):
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                if libc.syncfs(fd) == 0:
+                    return
+            finally:
+                os.close(fd)
+        if libc is not None:
+            libc.sync()
+        else:
+            os.system('sync')
+
+    def allocate(self, fobj, size):
+        libc = _get_libc()
+        if libc is not None and size > 0:
+            fobj.flush()
+            ret = libc.posix_fallocate(fobj.fileno(), ctypes.c_int64(0), ctypes.c_int64(size))
+            if ret == 0:
+                return
+            # EOPNOTSUPP and friends; fall back to a sparse extension
+        fobj.truncate(size)
+
+    def punch_hole(self, fobj, offset, length):
+        libc = _get_libc()
+        if libc is not None and hasattr(libc, 'fallocate') and length > 0:
+            FALLOC_FL_KEEP_SIZE = 0x01
+            FALLOC_FL_PUNCH_HOLE = 0x02
+            fobj.flush()
+            ret = libc.fallocate(fobj.fileno(),
+                                 FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE,
+                                 ctypes.c_int64(offset),
+                                 ctypes.c_int64(length))
+            if ret == 0:
+                return
+        FileSystem.punch_hole(self, fobj, offset, length)
+
     def is_symlink(self, path):
         return os.path.islink(path)
 
@@ -197,40 +317,10 @@ class LocalFileSystem(FileSystem):
 
     def lstat(self, path):
         statinfo = os.lstat(path)
-
-        props = dict()
-        props['is_directory']        = stat.S_ISDIR(statinfo.st_mode)
-        props['is_character_device'] = stat.S_ISCHR(statinfo.st_mode)
-        props['is_block_device']     = stat.S_ISBLK(statinfo.st_mode)
-        props['is_regular']          = stat.S_ISREG(statinfo.st_mode)
-        props['is_fifo']             = stat.S_ISFIFO(statinfo.st_mode)
-        props['is_symlink']          = stat.S_ISLNK(statinfo.st_mode)
-        if props['is_symlink']:
-            props['symlink_value']   = os.readlink(path)
         # TODO: socket?
-
-        props['is_setuid']           = (statinfo.st_mode & stat.S_ISUID) == stat.S_ISUID
-        props['is_setgid']           = (statinfo.st_mode & stat.S_ISGID) == stat.S_ISGID
-        props['is_sticky']           = (statinfo.st_mode & stat.S_ISVTX) == stat.S_ISVTX
-
-        props['user_read']           = (statinfo.st_mode & stat.S_IRUSR) == stat.S_IRUSR
-        props['user_write']          = (statinfo.st_mode & stat.S_IWUSR) == stat.S_IWUSR
-        props['user_execute']        = (statinfo.st_mode & stat.S_IXUSR) == stat.S_IXUSR
-        props['group_read']          = (statinfo.st_mode & stat.S_IRGRP) == stat.S_IRGRP
-        props['group_write']         = (statinfo.st_mode & stat.S_IWGRP) == stat.S_IWGRP
-        props['group_execute']       = (statinfo.st_mode & stat.S_IXGRP) == stat.S_IXGRP
-        props['other_read']          = (statinfo.st_mode & stat.S_IROTH) == stat.S_IROTH
-        props['other_write']         = (statinfo.st_mode & stat.S_IWOTH) == stat.S_IWOTH
-        props['other_execute']        = (statinfo.st_mode & stat.S_IXOTH) == stat.S_IXOTH
-
-        props['uid']                 = statinfo[stat.ST_UID]
-        props['gid']                 = statinfo[stat.ST_GID]
-        props['size']                = statinfo[stat.ST_SIZE]
-        props['atime']               = statinfo[stat.ST_ATIME]
-        props['mtime']               = statinfo[stat.ST_MTIME]
-        props['ctime']               = statinfo[stat.ST_CTIME]
-
-        return metadata.FileMetaData(props=props)
+        if stat.S_ISLNK(statinfo.st_mode):
+            return metadata.StatMetaData.from_stat(statinfo, os.readlink(path))
+        return metadata.StatMetaData.from_stat(statinfo)
 
     def mkdtemp(self, suffix=None):
         # mkdtemp differentiates between None and no parameter
@@ -442,7 +532,8 @@ class MemoryFile:
         return False
 
     def lstat(self):
-        return self.metadata
+        return metadata.FileMetaData(props=dict(size=len(self.contents)),
+                                     other=self.metadata)
 
 class OpenMode:
     '''Trivial helper to interpret fopen() style modestrings.
@@ -586,16 +677,32 @@ class MemoryFileObject:
         raise NotImplementedError
 
     def seek(self, offset, whence=os.SEEK_SET):
-        raise NotImplementedError
+        if whence == os.SEEK_SET:
+            self.pos = offset
+        elif whence == os.SEEK_CUR:
+            self.pos += offset
+        elif whence == os.SEEK_END:
+            self.pos = len(self.memfile.contents) + offset
+        else:
+            raise AssertionError('invalid whence: %s' % (whence,))
 
     def tell(self):
-        raise NotImplementedError
+        return self.pos
 
-    def truncate(self, size=0):
-        self.memfile.contents = self.memfile.contents[0:size + 1]
+    def truncate(self, size=None):
+        if size is None:
+            size = self.pos
+        contents = self.memfile.contents[0:size]
+        self.memfile.contents = contents + '\0' * (size - len(contents))
 
     def write(self, str):
-        self.memfile.contents = self.memfile.contents[0:self.pos + 1] + str + self.memfile.contents[self.pos + 1:]
+        if self.mode.append_only:
+            self.pos = len(self.memfile.contents)
+        contents = self.memfile.contents
+        if self.pos > len(contents):
+            contents += '\0' * (self.pos - len(contents))
+        self.memfile.contents = contents[0:self.pos] + str + contents[self.pos + len(str):]
+        self.pos += len(str)
 
     def writelines(self, sequence):
         raise NotImplementedError
@@ -708,6 +815,38 @@ class MemoryFileSystem(FileSystem):
         assert fileno is None, 'attempt to fsync something other than None, which indicates the file descriptor did not come from us (= the memory file system backend)'
         pass # do nothing
 
+    def syncfs(self, path):
+        pass # do nothing
+
+    def chmod(self, path, bits):
+        node = self.__lookup(path)
+        node.metadata = metadata.FileMetaData(props=metadata.bits_to_mode(bits),
+                                              other=node.metadata)
+
+    def lchown(self, path, uid, gid):
+        node = self.__lookup(path, no_follow=True)
+        node.metadata = metadata.FileMetaData(props=dict(uid=uid, gid=gid),
+                                              other=node.metadata)
+
+    def utime(self, path, atime, mtime):
+        node = self.__lookup(path)
+        node.metadata = metadata.FileMetaData(props=dict(atime=atime, mtime=mtime),
+                                              other=node.metadata)
+
+    def rename(self, src, dst):
+        sdname, sfname = self.__split_slash_agnostically(src)
+        ddname, dfname = self.__split_slash_agnostically(dst)
+        sd = self.__lookup(sdname)
+        dd = self.__lookup(ddname)
+
+        entry = sd[sfname]
+        if dfname in dd:
+            if isinstance(dd[dfname], MemoryDirectory):
+                raise OSError(errno.EISDIR, 'is a directory')
+            dd.unlink(dfname)
+        dd.link(entry, dfname)
+        sd.entries.pop(sfname)
+
     def is_symlink(self, path):
         dname, fname = self.__split_slash_agnostically(path)
         d = self.__lookup(dname)
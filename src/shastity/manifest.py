@@ -6,12 +6,13 @@
 Individual manifest management.
 
 A manifest contains all information about a particular backup, except
-the contents of data blocks. Manifests are assumed to be of
-"managable" size, fitting comfortably in memory.
+the contents of data blocks.
 
 Manifests in memory are basically lists of (path, metadata, hashes)
 tuples. On disk, they are human-readable text as documented in the
-manual.
+manual (version 1), or a compact binary encoding (version 2; see
+binmanifest). Both versions share a textual header, from which the
+version is detected when reading.
 
 Manifests maintain the order of entries added to it. The preserved
 ordering is a public interface, and other modules depend on it (e.g.,
@@ -22,20 +23,109 @@ This module deals with creation/storage/retrieval/deletion of
 individual backup manifests as well as listing available manifests.
 
 Note that we avoid ever returning a concrete manifest directly, and
-expose only very limited functionality. This is for the purpose of
-allowing future improvements such as not necessitating that manifests
-fit into memory.
+expose only very limited functionality. This allows manifests to be
+streamed rather than held in memory.
+
+Segmented manifests
+===================
+
+Large manifests may be split into segments of bounded size (see
+write_manifest()). Each segment is itself a complete manifest, covering
+a contiguous range of entries, stored under the name of the manifest
+followed by a dot and the sequence number of the segment. The manifest
+proper (the "root") is a small text object with a 'segments' header,
+whose body lists the segments in order:
+
+  <segment name> <number of entries> <first path (spencoded)>
+
+Segments are uploaded as they fill up, and the root last; a manifest
+thus becomes visible only once complete. When reading, segments are
+fetched as iteration reaches them, optionally with some of them
+prefetched in parallel.
+
+Delta manifests
+===============
+
+Consecutive backups of the same tree usually differ in few entries. A
+manifest may therefore be written as a delta against a parent
+manifest (see write_manifest()), with 'parent <name>' and 'depth <n>'
+headers, the depth being the number of deltas in the chain down to a
+full manifest. Its body lists, in manifest order, the entries added or
+changed relative to the parent, and the paths removed:
+
+  + <metadata> | <path (spencoded)> | <hashes>
+  - <path (spencoded)>
+
+The body is always text (as in version 1), and never segmented nor
+indexed. Reading merges the delta into the (recursively read) parent
+as both are streamed. The depth of a chain is bounded; once reached,
+a full manifest is written instead, serving as a checkpoint for later
+deltas. A manifest that is the parent of others cannot be deleted.
+
+Deltas rely on manifest order: entries sorted by path, compared
+component by component (as produced by traversal).
+
+Naming
+======
+
+Objects derived from a manifest are stored in the manifest backend
+under the name of the manifest followed by a dot and a suffix:
+segments (.NNNNNN), the path index (.index), the bloom filter (.bloom),
+the block set (.blocks, see refindex) and the identifier object
+(.id-<hex>, see below). The reference count index
+uses the names refcount.manifests and refcount.NN. Only these exact
+forms are reserved (see is_derived_name()); any other name, including
+names with dots written before they were introduced, is a manifest.
+
+Statistics
+==========
+
+The header of a manifest (the root, if segmented) records summary
+statistics (see ManifestStats), such that listing manifests does not
+require reading their entries.
+
+Identifiers
+===========
+
+The header of a manifest (the root, if segmented) also carries a random
+identifier, 'id <hex>', drawn anew whenever the manifest is written.
+A manifest deleted and rewritten under the same name can thus be told
+from the original by reading only its header (see read_id()).
+
+The identifier is also recorded in the name of an empty object,
+<name>.id-<hex>, such that the identifiers of all manifests are known
+from a single listing of the backend (see list_ids()). It is written
+before the root, and that of the previous identifier deleted after it;
+an interrupted write thus leaves two, and never one identifying a root
+other than the one in place.
+
+Integrity
+=========
+
+Backends may only verify the integrity of an object once it has all
+been read (see Backend.get_unverified_chunks()). Entries are only
+produced from verified objects. Only read_stats(), read_id() and
+read_chain() read the header alone without verifying it, their results
+being informational (or, for the manifest cache, only causing a
+manifest to be read again).
 '''
 
 from __future__ import absolute_import
 from __future__ import with_statement
 
+import collections
+import itertools
+import multiprocessing.pool
 import  os.path
 import re
+import threading
+import uuid
 
+import shastity.binmanifest as binmanifest
 import shastity.filesystem as filesystem
 import shastity.logging as logging
 import shastity.metadata as metadata
+import shastity.pathindex as pathindex
 import shastity.spencode as spencode
 
 log = logging.get_logger(__name__)
@@ -46,60 +136,492 @@ class ManifestError(Exception):
         self.line = line
         self.msg = msg
 
-def write_manifest(backend, name, entry_generator):
+FORMAT_VERSIONS = (1, 2)
+
+DEFAULT_PREFETCH = 4
+
+DEFAULT_MAX_DEPTH = 7
+
+_ENCODE_BATCH = 1024
+
+def _encode_header(version, extra_headers=()):
+    """
+    @return The header of a manifest object.
+    """
+    mf_lines = ['shastity',
+                'version %d' % (version,)]
+    mf_lines.extend(extra_headers)
+    mf_lines.append('end')
+
+    return '\n'.join(mf_lines)
+
+def _encode_body(entries, version):
+    """
+    @return The body of a manifest object for the given entries,
+            including the newline separating it from the header.
+    """
+    if version == 2:
+        return '\n' + binmanifest.encode(entries)
+
+    # paths are encoded in bulk, a batch of entries at a time
+    parts = []
+    entries = iter(entries)
+    while True:
+        batch = list(itertools.islice(entries, _ENCODE_BATCH))
+        if not batch:
+            return ''.join(parts)
+        paths = spencode.spencode_many([ path for path, md, hashes in batch ])
+        parts.extend([ '\n' + _format_line(entry, pth) for entry, pth in zip(batch, paths) ])
+
+def _encode(entries, version, extra_headers=()):
+    """
+    @return The complete manifest object (header and body) for the
+            given entries.
+    """
+    return _encode_header(version, extra_headers) + _encode_body(entries, version)
+
+def _format_line(entry, pth=None):
+    """
+    @param pth The spencoded path of the entry, if already known.
+    @return The line describing an entry in a version 1 manifest.
+    """
+    (path, metadata, hashes) = entry
+
+    md = metadata.to_string()
+
+    if pth is None:
+        pth = spencode.spencode(path)
+
+    rest = ' '.join([ '%s,%s' % (algo, hex) for (algo, hex) in hashes ])
+
+    return '%s | %s | %s' % (md, pth, rest)
+
+class ManifestStats(object):
+    """
+    Summary statistics of a manifest, stored in its header such that
+    they can be obtained without reading the entries.
+
+    @ivar files Number of entries.
+    @ivar blocks Number of block references (not necessarily distinct).
+    @ivar bytes Total size of the files.
+    @ivar new_blocks Number of blocks stored by the backup that produced
+                     the manifest (i.e., not already in the backend), or
+                     None if unknown.
+    """
+    def __init__(self, files=0, blocks=0, bytes=0, new_blocks=None):
+        self.files = files
+        self.blocks = blocks
+        self.bytes = bytes
+        self.new_blocks = new_blocks
+
+    @classmethod
+    def for_entries(cls, entries):
+        stats = cls()
+        for entry in stats.count(entries):
+            pass
+        return stats
+
+    def count(self, entries):
+        """
+        @return A generator passing the given entries through, accounting
+                for each.
+        """
+        for entry in entries:
+            self.files += 1
+            self.blocks += len(entry[2])
+            self.bytes += entry[1].size
+            yield entry
+
+    def headers(self):
+        """
+        @return The manifest header lines recording the statistics.
+        """
+        headers = [ 'files %d' % (self.files,),
+                    'blocks %d' % (self.blocks,),
+                    'bytes %d' % (self.bytes,) ]
+        if self.new_blocks is not None:
+            headers.append('new-blocks %d' % (self.new_blocks,))
+        return headers
+
+def _entry_size(entry):
+    """
+    @return An estimate of the encoded size of an entry (an upper bound
+            for version 2).
+    """
+    path, metadata, hashes = entry
+    return len(path) + 64 + sum([ len(algo) + len(hex) + 2 for (algo, hex) in hashes ])
+
+def _segments(entries, segment_size):
+    """
+    Split entries into lists of consecutive entries, each of an
+    estimated size of at most segment_size (but at least one entry).
+    """
+    segment = []
+    size = 0
+    for entry in entries:
+        esize = _entry_size(entry)
+        if segment and size + esize > segment_size:
+            yield segment
+            segment = []
+            size = 0
+        segment.append(entry)
+        size += esize
+    if segment:
+        yield segment
+
+# see the module documentation; keep in sync with refindex
+_derived_re = re.compile(r'^(?:refcount\.(?:manifests|\d{2,})|.+\.(?:\d{6,}|index|bloom|blocks|id-[0-9a-f]{32}))$')
+_id_re = re.compile(r'^(.+)\.id-([0-9a-f]{32})$')
+
+def is_derived_name(name):
+    """
+    @return Whether the given name is that of an object derived from a
+            manifest (see module documentation), rather than of a manifest.
+    """
+    return _derived_re.match(name) is not None
+
+def _check_name(name):
+    """
+    Raise ManifestError if the given name cannot be that of a manifest.
+    """
+    if is_derived_name(name):
+        raise ManifestError(0, '', 'Invalid manifest name %s: reserved for objects derived from manifests' % (name,))
+
+def segment_name(name, n):
+    """
+    @return The name of segment number n of the manifest by the given name.
+    """
+    return '%s.%06d' % (name, n)
+
+def index_name(name):
+    """
+    @return The name of the path index of the manifest by the given name.
+    """
+    return '%s.index' % (name,)
+
+def bloom_name(name):
+    """
+    @return The name of the bloom filter of the manifest by the given name.
+    """
+    return '%s.bloom' % (name,)
+
+def id_name(name, ident):
+    """
+    @return The name of the object recording the given identifier of the
+            manifest by the given name.
+    """
+    return '%s.id-%s' % (name, ident)
+
+def _order(path):
+    """
+    @return The sort key of a path in manifest order.
+    """
+    if isinstance(path, unicode):
+        path = path.encode('utf-8')
+    return path.split('/')
+
+def _ordered(items):
+    """
+    Pair entries (or delta records) with their sort keys, checking that
+    they are in manifest order.
+
+    @param items Iterable of tuples whose first element is a path.
+    @return A generator of (key, item) tuples.
+    """
+    last = None
+    for item in items:
+        key = _order(item[0])
+        if last is not None and key <= last:
+            raise ManifestError(0, item[0], 'Entries not in manifest order')
+        last = key
+        yield (key, item)
+
+def _same(a, b):
+    """
+    @return Whether two entries for the same path are identical.
+    """
+    return (a[1].to_string() == b[1].to_string() and
+            [ tuple(h) for h in a[2] ] == [ tuple(h) for h in b[2] ])
+
+def _diff(parent_entries, entries):
+    """
+    Compare the entries of a manifest with those of its parent, both in
+    manifest order.
+
+    @return A generator of delta records, in manifest order: (path,
+            entry) for added or changed entries, (path, None) for removed
+            ones.
+    """
+    _end = (None, None)
+    parents = _ordered(parent_entries)
+    pkey, pentry = next(parents, _end)
+    for key, entry in _ordered(entries):
+        while pentry is not None and pkey < key:
+            yield (pentry[0], None)
+            pkey, pentry = next(parents, _end)
+        if pentry is not None and pkey == key:
+            if not _same(pentry, entry):
+                yield (entry[0], entry)
+            pkey, pentry = next(parents, _end)
+        else:
+            yield (entry[0], entry)
+    while pentry is not None:
+        yield (pentry[0], None)
+        pkey, pentry = next(parents, _end)
+
+def _merge(base_entries, records):
+    """
+    The inverse of _diff(): apply delta records to the entries of the
+    parent.
+
+    @return A backup entry generator.
+    """
+    _end = (None, None)
+    records = _ordered(records)
+    rkey, record = next(records, _end)
+    for key, entry in _ordered(base_entries):
+        while record is not None and rkey < key:
+            if record[1] is not None:
+                yield record[1]
+            rkey, record = next(records, _end)
+        if record is not None and rkey == key:
+            if record[1] is not None:
+                yield record[1]
+            rkey, record = next(records, _end)
+        else:
+            yield entry
+    while record is not None:
+        if record[1] is not None:
+            yield record[1]
+        rkey, record = next(records, _end)
+
+def _encode_delta_body(records):
+    """
+    @return The body of a delta manifest object for the given records,
+            including the newline separating it from the header.
+    """
+    mf_lines = []
+    for path, entry in records:
+        if entry is None:
+            mf_lines.append('\n- %s' % (spencode.spencode(path),))
+        else:
+            mf_lines.append('\n+ %s' % (_format_line(entry),))
+    log.debug('delta has %d records', len(mf_lines))
+
+    return ''.join(mf_lines)
+
+def write_manifest(backend, name, entry_generator, version=1, segment_size=None, index=False,
+                   parent=None, max_depth=DEFAULT_MAX_DEPTH, new_blocks=None):
     """
     @param backend A storage backend (dedicated to manifests)
 
     @type  name A string.
-    @param name Name of manifest; must not contain dots.
+    @param name Name of manifest; must not be a name reserved for derived
+                objects (see is_derived_name()). An existing manifest by
+                the name is replaced, and any of its segments, path index
+                and bloom filter no longer in use are deleted.
     
     @param entry_generator Backup entry generator producting all
                            entries, in order, for inclusion in the
                            manifest.
+
+    @param version Format version to write: 1 (text) or 2 (binary, see
+                   binmanifest).
+
+    @param segment_size If not None, split the manifest into segments of
+                        (approximately) at most this many bytes, uploading
+                        each one as soon as it is complete. Otherwise, the
+                        manifest is written as a single object.
+
+    @param index Whether to also write a path index and bloom filter (see
+                 pathindex and lookup()).
+
+    @param parent If not None, the name of the manifest (typically, of
+                  the previous backup of the same tree) against which to
+                  write the manifest as a delta. Entries must then be in
+                  manifest order. Version, segment_size and index apply
+                  only if a full manifest is written instead.
+
+    @param max_depth Maximum number of deltas in a chain. If writing a
+                     delta would exceed it, a full manifest is written.
+
+    @param new_blocks If not None, a callable returning the number of
+                      blocks newly stored for the manifest, called once
+                      all entries have been produced. It is recorded in
+                      the header along with the other ManifestStats.
     """
-    assert '.' not in name, 'manifest names cannot contain dots'
+    _check_name(name)
+    assert version in FORMAT_VERSIONS, 'unsupported manifest version %s' % (version,)
 
-    mf_lines = ['shastity',
-                'version 1',
-                'end']
+    ident = uuid.uuid4().hex
+    id_header = 'id %s' % (ident,)
 
-    for (path, metadata, hashes) in entry_generator:
-        md = metadata.to_string()
+    # derived objects of the manifest being replaced, if any
+    listing = backend.list()
+    stale = set(derived_objects(backend, name)) if name in listing else set()
+    stale.update([ id_name(name, old) for old in list_ids(backend, listing).get(name, []) ])
 
-        pth = spencode.spencode(path)
+    def put_root(data):
+        backend.put(id_name(name, ident), '')
+        backend.put(name, data)
+        _delete_stale(backend, stale)
+
+    stats = ManifestStats()
+    entry_generator = stats.count(entry_generator)
+    def stats_headers():
+        if new_blocks is not None:
+            stats.new_blocks = new_blocks()
+        return stats.headers()
+
+    if parent is not None:
+        _check_name(parent)
+        if parent == name:
+            raise ManifestError(0, '', 'Manifest %s cannot be its own parent' % (name,))
 
-        rest = ' '.join([ '%s,%s' % (algo, hex) for (algo, hex) in hashes ])
+        lines, headers, lineno = _open(backend.get_chunks(parent))
+        depth = headers['depth'] + 1
+        if depth <= max_depth:
+            log.debug('writing manifest %s as a delta against %s (depth %d)', name, parent, depth)
+            parent_entries = _read_opened(backend, lines, headers, lineno)
+            body = _encode_delta_body(_diff(parent_entries, entry_generator))
+            put_root(_encode_header(1, [ id_header,
+                                         'parent %s' % (parent,),
+                                         'depth %d' % (depth,) ] + stats_headers()) + body)
+            return
+        log.info('delta chain of %s reached depth %d; writing %s in full', parent, max_depth, name)
 
-        mf_lines.append('%s | %s | %s' % (md, pth, rest))
+    builder = pathindex.IndexBuilder() if index else None
+    def track(entries, segment):
+        for ordinal, entry in enumerate(entries):
+            if builder is not None:
+                builder.add(entry[0], segment, ordinal)
+            yield entry
 
-    backend.put(name, '\n'.join(mf_lines))
+    def write_index():
+        if builder is not None:
+            try:
+                backend.put(index_name(name), builder.index())
+                backend.put(bloom_name(name), builder.bloom().to_string())
+            finally:
+                builder.close()
+            stale.difference_update([ index_name(name), bloom_name(name) ])
 
-def read_manifest(backend, name):
+    headers = [ id_header ] + ([ 'index' ] if index else [])
+
+    if segment_size is None:
+        # the body first, the statistics being known only thereafter
+        body = _encode_body(track(entry_generator, 0), version)
+        write_index()
+        put_root(_encode_header(version, headers + stats_headers()) + body)
+        return
+
+    segments = []
+    for n, segment in enumerate(_segments(entry_generator, segment_size)):
+        segname = segment_name(name, n)
+        log.debug('writing manifest segment %s (%d entries)', segname, len(segment))
+        backend.put(segname, _encode(track(segment, n), version))
+        stale.discard(segname)
+        segments.append('%s %d %s' % (segname, len(segment), spencode.spencode(segment[0][0])))
+
+    write_index()
+    headers.append('segments %d' % (len(segments),))
+    headers.extend(stats_headers())
+    put_root('\n'.join([ _encode_header(1, headers) ] + segments))
+
+def _delete_stale(backend, names):
     """
-    @return A backup entry generator producing all entries, in order,
-            contained in the manifest.
+    Delete the given derived objects of a replaced manifest, once the
+    new root is in place.
     """
-    assert '.' not in name, 'manifest names cannot contain dots'
+    for stale in sorted(names):
+        log.debug('deleting stale manifest object %s', stale)
+        backend.delete(stale)
 
-    mf_lines = [ line.strip() for line in backend.get(name).split('\n') ]
+class _ChunkedLines(object):
+    """
+    Splits a sequence of chunks (see Backend.get_chunks()) into lines
+    as the chunks arrive, without holding more than one chunk (plus a
+    partial line) in memory.
+    """
+    def __init__(self, chunks):
+        self.__chunks = iter(chunks)
+        self.__lines = collections.deque() # complete lines
+        self.__partial = ''                # incomplete last line
 
-    version = None
-    lineno = 1
+    def readline(self):
+        """
+        @return The next line, without its newline, or None at the end of
+                the data. A final line lacking a newline is returned as is.
+        """
+        while not self.__lines:
+            chunk = next(self.__chunks, None)
+            if chunk is None:
+                line, self.__partial = self.__partial, ''
+                return line if line else None
+            lines = (self.__partial + chunk).split('\n')
+            self.__partial = lines.pop()
+            self.__lines.extend(lines)
+        return self.__lines.popleft()
 
-    if len(mf_lines) == 0:
-        raise ManifestError(lineno,
-                            '',
-                            "Manifest empty")
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if line is None:
+                return
+            yield line
 
-    if  mf_lines[0] != 'shastity':
-        raise ManifestError(lineno,
-                            mf_lines[0],
-                            "First line not 'shastity'")
+    def read_rest(self):
+        """
+        @return All remaining data, as a single string.
+        """
+        parts = [ line + '\n' for line in self.__lines ]
+        parts.append(self.__partial)
+        parts.extend(self.__chunks)
+        self.__lines.clear()
+        self.__partial = ''
+        return ''.join(parts)
 
-    lineno += 1
+def _read_header(lines):
+    """
+    Parse the textual header common to all manifest versions.
 
-    for head in mf_lines[lineno-1:]:
+    @param lines A _ChunkedLines positioned at the start of the manifest.
+    @return (headers, line number of the body), where headers is a dict
+            with the keys 'version', 'segments' (number of segments, or
+            None if not segmented), 'index' (whether there is a path
+            index), 'parent' (name of the parent of a delta, or None),
+            'depth' (number of deltas in the chain; 0 if not a delta),
+            'id' (the identifier of the manifest, or None) and 'stats'
+            (a dict of the statistics present; see ManifestStats).
+    """
+    lineno = 0
+    headers = dict(version=None,
+                   segments=None,
+                   index=False,
+                   parent=None,
+                   depth=0,
+                   id=None,
+                   stats=dict())
+
+    while True:
         lineno += 1
+        head = lines.readline()
+        if head is None:
+            if lineno == 1:
+                raise ManifestError(lineno,
+                                    '',
+                                    "Manifest empty")
+            raise ManifestError(lineno,
+                                '',
+                                "Header error or no data.")
+        head = head.strip()
+
+        if lineno == 1:
+            if head != 'shastity':
+                raise ManifestError(lineno,
+                                    head,
+                                    "First line not 'shastity'")
+            continue
 
         if head == 'end':
             break
@@ -107,7 +629,42 @@ def read_manifest(backend, name):
         # version
         m = re.match(r'version (\d+)', head)
         if m:
-            version = int(m.group(1))
+            headers['version'] = int(m.group(1))
+            continue
+
+        # segments
+        m = re.match(r'segments (\d+)', head)
+        if m:
+            headers['segments'] = int(m.group(1))
+            continue
+
+        # parent of a delta
+        m = re.match(r'parent (\S+)$', head)
+        if m:
+            headers['parent'] = m.group(1)
+            continue
+
+        # length of the delta chain
+        m = re.match(r'depth (\d+)', head)
+        if m:
+            headers['depth'] = int(m.group(1))
+            continue
+
+        # identifier
+        m = re.match(r'id ([0-9a-f]+)$', head)
+        if m:
+            headers['id'] = m.group(1)
+            continue
+
+        # statistics
+        m = re.match(r'(files|blocks|bytes|new-blocks) (\d+)$', head)
+        if m:
+            headers['stats'][m.group(1)] = int(m.group(2))
+            continue
+
+        # path index
+        if head == 'index':
+            headers['index'] = True
 
         # unknown
         else:
@@ -115,38 +672,460 @@ def read_manifest(backend, name):
                                 head,
                                 "Invalid header line: %s" % (head))
 
-    if len(mf_lines) == 0:
-        raise ManifestError(lineno,
-                            '',
-                            "Header error or no data.")
-
+    version = headers['version']
     if version is None:
         raise ManifestError(lineno,
                             '',
                             "Required manifest header 'version' missing")
+    if version not in FORMAT_VERSIONS:
+        raise ManifestError(lineno,
+                            '',
+                            "Unsupported manifest version %d" % (version,))
+    if headers['parent'] is not None and (version != 1 or headers['segments'] is not None):
+        raise ManifestError(lineno,
+                            '',
+                            "Delta manifests must be unsegmented version 1")
 
-    for line in mf_lines[lineno-1:]:
-        lineno += 1
-        (md, path, rest) = [ s.strip() for s in line.split('|') ]
+    return (headers, lineno + 1)
+
+def _parse_line(line):
+    """
+    @return The entry described by a line of a version 1 manifest.
+    """
+    # a single split: spencoded values contain neither whitespace nor '|'
+    fields = line.split()
+    sep = fields.index('|')
+    if len(fields) < sep + 3 or fields[sep + 2] != '|':
+        raise ValueError('invalid manifest line: %s' % (line,))
+
+    md = metadata.FileMetaData.from_fields(fields[0:sep])
+    path = spencode.spdecode(fields[sep + 1])
+
+    rest = [ (algo, hex) for (algo, hex) in [ pair.split(',') for pair in fields[sep + 3:] ] ]
+
+    return (path, md, rest)
+
+def _read_entries(lines, version, lineno):
+    """
+    Parse the body of a manifest object (a non-segmented manifest, or a
+    segment).
+
+    @param lines The _ChunkedLines of the object, positioned after the header.
+    @param version The format version of the object.
+    @param lineno The line number of the body.
+    @return A backup entry generator.
+    """
+    if version == 2:
+        try:
+            for entry in binmanifest.BinaryManifest(lines.read_rest()):
+                yield entry
+        except binmanifest.BinaryManifestError, e:
+            raise ManifestError(lineno, '', str(e))
+        return
+
+    for line in lines:
+        yield _parse_line(line)
+
+def _read_delta(lines, lineno):
+    """
+    Parse the body of a delta manifest.
 
-        md = metadata.FileMetaData.from_string(md)
-        path = spencode.spdecode(path)
-        
-        if rest:
-            rest = [ (algo, hex) for (algo, hex) in [ pair.split(',') for pair in rest.split() ] ]
+    @return A generator of delta records (see _diff()).
+    """
+    for line in lines:
+        if line.startswith('+ '):
+            entry = _parse_line(line[2:])
+            yield (entry[0], entry)
+        elif line.startswith('- '):
+            yield (spencode.spdecode(line[2:]), None)
         else:
-            rest = []
+            raise ManifestError(lineno, line, 'Invalid delta line')
+        lineno += 1
+
+def _open(chunks):
+    """
+    @param chunks A manifest object, as an iterable of chunks.
+    @return (lines, headers, line number of the body), where lines is a
+            _ChunkedLines positioned at the start of the body.
+    """
+    lines = _ChunkedLines(chunks)
+    headers, lineno = _read_header(lines)
+    return (lines, headers, lineno)
+
+def _read_segment(chunks):
+    """
+    @param chunks The segment, as an iterable of chunks.
+    @return A backup entry generator.
+    """
+    lines, headers, lineno = _open(chunks)
+    if headers['segments'] is not None:
+        raise ManifestError(lineno - 1, '', 'Nested segmented manifest')
+
+    return _read_entries(lines, headers['version'], lineno)
+
+def _read_segment_list(lines, segments, lineno):
+    """
+    Parse the body of the root of a segmented manifest.
+
+    @return A list of (segment name, number of entries, first path) tuples.
+    """
+    seglist = []
+    for line in lines:
+        try:
+            segname, count, first = line.split(' ')
+            seglist.append((segname, int(count), spencode.spdecode(first)))
+        except ValueError:
+            raise ManifestError(lineno, line, 'Invalid segment line')
+        lineno += 1
+    if len(seglist) != segments:
+        raise ManifestError(lineno, '', 'Expected %d segments, found %d' % (segments, len(seglist)))
+
+    return seglist
+
+def read_stats(backend, name):
+    """
+    @return The ManifestStats of the manifest by the given name, or None
+            if it has none (having been written by an earlier version).
+            Only its header is read.
+    """
+    _check_name(name)
+
+    lines, headers, lineno = _open(backend.get_unverified_chunks(name))
+    stats = headers['stats']
+    if 'files' not in stats:
+        return None
+    return ManifestStats(files=stats['files'],
+                         blocks=stats.get('blocks', 0),
+                         bytes=stats.get('bytes', 0),
+                         new_blocks=stats.get('new-blocks'))
+
+def read_id(backend, name):
+    """
+    @return The identifier of the manifest by the given name, which
+            changes whenever it (or, for a delta, any manifest of its
+            chain) is written; or None if it has none (having been
+            written by an earlier version). Only headers are read.
+    """
+    _check_name(name)
+
+    ids = []
+    while name is not None:
+        lines, headers, lineno = _open(backend.get_unverified_chunks(name))
+        if headers['id'] is None:
+            return None
+        ids.append(headers['id'])
+        name = headers['parent']
+    return '/'.join(ids)
+
+def read_chain(backend, name):
+    """
+    @return The names of the manifests of the delta chain of the manifest
+            by the given name: the manifest itself, followed by its parent
+            (if a delta), and so on. Only headers are read.
+    """
+    _check_name(name)
+
+    chain = []
+    while name is not None:
+        chain.append(name)
+        lines, headers, lineno = _open(backend.get_unverified_chunks(name))
+        name = headers['parent']
+    return chain
+
+def list_ids(backend, listing=None):
+    """
+    @param listing The listing of the backend, if already at hand.
+    @return A dict of manifest name -> sorted list of the identifiers of
+            its identifier objects (see module documentation): normally
+            exactly one; more if a write was interrupted. Manifests written
+            by earlier versions have none, and are absent. Only the
+            backend is listed.
+    """
+    if listing is None:
+        listing = backend.list()
 
-        yield (path, md, rest)
+    ids = dict()
+    for objname in listing:
+        m = _id_re.match(objname)
+        if m is not None:
+            ids.setdefault(m.group(1), []).append(m.group(2))
+    for idents in ids.itervalues():
+        idents.sort()
+    return ids
+
+def list_segments(backend, name):
+    """
+    @return A list of (segment name, number of entries, first path) tuples
+            describing the segments of the manifest by the given name, in
+            order; or None if the manifest is not segmented.
+    """
+    _check_name(name)
+
+    lines, headers, lineno = _open(backend.get_chunks(name))
+    if headers['segments'] is None:
+        return None # only the header was read
+
+    return _read_segment_list(lines, headers['segments'], lineno)
+
+def _prefetch_segments(backend_factory, segnames, prefetch):
+    """
+    Fetch segments using prefetch threads (each with its own backend),
+    keeping at most prefetch segments in flight or buffered.
+
+    @return A generator of the contents of each segment, in order.
+    """
+    local = threading.local()
+    def fetch(segname):
+        if not hasattr(local, 'backend'):
+            local.backend = backend_factory()
+        return ''.join(local.backend.get_chunks(segname))
+
+    pool = multiprocessing.pool.ThreadPool(prefetch)
+    try:
+        pending = collections.deque()
+        segnames = iter(segnames)
+        for segname in segnames:
+            pending.append(pool.apply_async(fetch, (segname,)))
+            if len(pending) >= prefetch:
+                break
+        while pending:
+            data = pending.popleft().get()
+            segname = next(segnames, None)
+            if segname is not None:
+                pending.append(pool.apply_async(fetch, (segname,)))
+            yield data
+    finally:
+        pool.terminate()
+
+def read_manifest(backend, name, backend_factory=None, prefetch=DEFAULT_PREFETCH):
+    """
+    The manifest is parsed incrementally as it is downloaded (see
+    Backend.get_chunks()), so that entries are produced before the
+    download completes and the manifest is never held in memory in its
+    entirety. The exception is version 2 (binary) manifests, whose
+    tables are at the end; they are held in memory in their compact
+    form, and decoded incrementally. For segmented manifests, this
+    applies to each segment in turn.
+
+    @param backend_factory If given, segments are prefetched in parallel
+                           using backends created by this factory.
+    @param prefetch Maximum number of segments to prefetch.
+
+    @return A backup entry generator producing all entries, in order,
+            contained in the manifest. The format version is detected
+            automatically.
+    """
+    _check_name(name)
+
+    lines, headers, lineno = _open(backend.get_chunks(name))
+    for entry in _read_opened(backend, lines, headers, lineno, backend_factory, prefetch):
+        yield entry
+
+def _read_opened(backend, lines, headers, lineno, backend_factory=None, prefetch=DEFAULT_PREFETCH):
+    """
+    read_manifest(), for a manifest whose header has been read (see
+    _open()).
+    """
+    if headers['parent'] is not None:
+        # deltas are small; read the delta entirely rather than keep it
+        # open while fetching the parent
+        records = list(_read_delta(lines, lineno))
+        base = read_manifest(backend, headers['parent'], backend_factory, prefetch)
+        for entry in _merge(base, records):
+            yield entry
+        return
+
+    if headers['segments'] is None:
+        for entry in _read_entries(lines, headers['version'], lineno):
+            yield entry
+        return
+
+    segnames = [ segname for segname, count, first in _read_segment_list(lines, headers['segments'], lineno) ]
+    if backend_factory is not None and prefetch > 0:
+        objects = ( [ data ] for data in _prefetch_segments(backend_factory, segnames, prefetch) )
+    else:
+        objects = ( backend.get_chunks(segname) for segname in segnames )
+
+    for chunks in objects:
+        for entry in _read_segment(chunks):
+            yield entry
+
+def _entries_at(lines, version, ordinals):
+    """
+    @param lines The _ChunkedLines of a manifest object, positioned after
+                 the header.
+    @param ordinals Set of ordinals of the wanted entries.
+    @return A dict of ordinal -> entry.
+    """
+    found = dict()
+    if not ordinals:
+        return found
+
+    if version == 2:
+        try:
+            mf = binmanifest.BinaryManifest(lines.read_rest())
+            for ordinal in ordinals:
+                if ordinal < len(mf):
+                    found[ordinal] = mf[ordinal]
+        except binmanifest.BinaryManifestError, e:
+            raise ManifestError(0, '', str(e))
+        return found
+
+    # lines must be parsed in sequence, but only the wanted ones decoded
+    last = max(ordinals)
+    ordinal = 0
+    for line in lines:
+        if ordinal in ordinals:
+            found[ordinal] = _parse_line(line)
+        if ordinal >= last:
+            break
+        ordinal += 1
+    return found
+
+def _path_index(backend, name):
+    """
+    @return The PathIndex of the manifest by the given name.
+    """
+    try:
+        return pathindex.PathIndex(backend.get(index_name(name)))
+    except pathindex.PathIndexError, e:
+        raise ManifestError(0, '', 'Invalid path index of %s: %s' % (name, e))
+
+def lookup(backend, name, paths):
+    """
+    Look up individual entries of a manifest. If the manifest has a
+    path index, only the index and the segments containing the entries
+    are read; otherwise, the entire manifest is.
+
+    @param paths Iterable of paths (unicode) to look up.
+
+    @return A dict of path -> entry, for those of the paths contained in
+            the manifest.
+    """
+    _check_name(name)
+
+    paths = set([ path.decode('utf-8') if isinstance(path, str) else path for path in paths ])
+
+    lines, headers, lineno = _open(backend.get_chunks(name))
+    if headers['parent'] is not None:
+        # the delta decides for the paths it lists, the parent for others
+        found = dict()
+        for path, entry in _read_delta(lines, lineno):
+            if path in paths:
+                paths.discard(path)
+                if entry is not None:
+                    found[path] = entry
+        if paths:
+            found.update(lookup(backend, headers['parent'], paths))
+        return found
+
+    if not headers['index']:
+        log.debug('manifest %s has no path index; scanning it', name)
+        return dict([ (entry[0], entry) for entry in read_manifest(backend, name) if entry[0] in paths ])
+
+    # segment -> set of candidate ordinals
+    candidates = dict()
+    pindex = _path_index(backend, name)
+    for path in paths:
+        for segment, ordinal in pindex.lookup(path):
+            candidates.setdefault(segment, set()).add(ordinal)
+
+    if headers['segments'] is None:
+        objects = { 0: (lines, headers['version']) }
+    else:
+        seglist = _read_segment_list(lines, headers['segments'], lineno)
+        objects = dict()
+        for segment in candidates.keys():
+            if segment >= len(seglist):
+                raise ManifestError(0, '', 'Path index of %s refers to missing segment %d' % (name, segment))
+            seglines, segheaders, seglineno = _open(backend.get_chunks(seglist[segment][0]))
+            objects[segment] = (seglines, segheaders['version'])
+
+    found = dict()
+    for segment, ordinals in candidates.iteritems():
+        seglines, version = objects[segment]
+        for entry in _entries_at(seglines, version, ordinals).itervalues():
+            # candidates may be hash collisions
+            if entry[0] in paths:
+                found[entry[0]] = entry
+    return found
+
+def has_path_index(backend, name):
+    """
+    @return Whether the manifest by the given name has a path index (and
+            bloom filter). Only its header is read; for a delta, the
+            headers of its chain, which has an index if the full
+            manifest at its end has.
+    """
+    _check_name(name)
+
+    lines, headers, lineno = _open(backend.get_chunks(name))
+    if headers['parent'] is not None:
+        return has_path_index(backend, headers['parent'])
+    return headers['index']
+
+def might_contain(backend, name, path):
+    """
+    @return False if the manifest by the given name definitely does not
+            contain the given path. Only the manifest's bloom filter is
+            read, if it has one. For a delta, the delta is read, and
+            the parent consulted for paths not in it.
+    """
+    _check_name(name)
+
+    lines, headers, lineno = _open(backend.get_chunks(name))
+    if headers['parent'] is not None:
+        if isinstance(path, str):
+            path = path.decode('utf-8')
+        for rpath, entry in _read_delta(lines, lineno):
+            if rpath == path:
+                return entry is not None
+        return might_contain(backend, headers['parent'], path)
+
+    if not headers['index']:
+        return True
+
+    try:
+        return pathindex.BloomFilter.from_string(backend.get(bloom_name(name))).might_contain(path)
+    except pathindex.PathIndexError, e:
+        raise ManifestError(0, '', 'Invalid bloom filter of %s: %s' % (name, e))
 
 def delete_manifest(backend, name):
     """
     @param backend Storage backend from which to delete the manifest
                    by the given name.
 
-    @param name Name of the manifest to delete.
+    @param name Name of the manifest to delete. It must not be the
+                parent of a delta manifest.
     """
+    _check_name(name)
+
+    children = dependents(backend, name)
+    if children:
+        raise ManifestError(0, '', 'Manifest %s is the parent of %s' % (name, ', '.join(children)))
+
+    derived = derived_objects(backend, name)
+    derived.extend([ id_name(name, ident) for ident in list_ids(backend).get(name, []) ])
+
+    # the root first, such that the manifest never appears incomplete
     backend.delete(name)
+    for objname in derived:
+        backend.delete(objname)
+
+def derived_objects(backend, name):
+    """
+    @return The names of the segments, path index and bloom filter of
+            the manifest by the given name, as listed by its root (only
+            the root is read).
+    """
+    lines, headers, lineno = _open(backend.get_chunks(name))
+    derived = []
+    if headers['segments'] is not None:
+        derived.extend([ segname for segname, count, first
+                         in _read_segment_list(lines, headers['segments'], lineno) ])
+    if headers['index']:
+        derived.extend([ index_name(name), bloom_name(name) ])
+    return derived
 
 def list_manifests(backend):
     """
@@ -154,4 +1133,19 @@ def list_manifests(backend):
 
     @return A list of names of all manifests contained in the backend.
     """
-    return backend.list()
+    return [ name for name in backend.list() if not is_derived_name(name) ]
+
+def dependents(backend, name):
+    """
+    @return A sorted list of the names of the delta manifests whose
+            parent is the manifest by the given name. The header of every
+            manifest is read.
+    """
+    children = []
+    for other in list_manifests(backend):
+        if other == name:
+            continue
+        lines, headers, lineno = _open(backend.get_chunks(other))
+        if headers['parent'] == name:
+            children.append(other)
+    return sorted(children)
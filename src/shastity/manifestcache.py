@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2009 Peter Schuller <peter.schuller@infidyne.com>
+
+'''
+Local cache of parsed manifests.
+
+Several commands need the contents of manifests: common-blocks, the
+reference count index (for manifests lacking a block set, see
+refindex) and list-manifests (for manifests lacking statistics).
+Fetching, decrypting and parsing them on every run is slow, and
+pointless: manifests rarely change once written.
+
+Manifests are returned as ColumnarManifest instances, such that all
+manifests of a backend may be held in memory.
+
+A ManifestCache keeps manifests in a local directory, in the compact
+binary encoding of version 2 manifests (see binmanifest), one file per
+manifest. Files are named by hashes of the backend URI and of the
+manifest name, so that one cache directory may serve any number of
+backends.
+
+Each cached manifest is stored along with the identifiers of the
+manifests of its delta chain (see manifest.list_ids()), which change
+whenever they are written. These are known from the listing of the
+backend, taken once when the cache is first used; a cached copy whose
+identifiers differ from those listed is replaced, and no manifest is
+read to validate one. A manifest deleted and rewritten under the same
+name (or a delta against it) is thus never served stale. (Manifests
+written by versions predating identifiers are assumed not to change.)
+Manifests that no longer exist in the listing are dropped from the
+cache.
+
+The total size of the cache is bounded; when it is exceeded, the least
+recently used manifests are evicted. Use is tracked by the
+modification times of the cache files.
+'''
+
+from __future__ import absolute_import
+from __future__ import with_statement
+
+import hashlib
+import os
+import os.path
+import tempfile
+
+import shastity.binmanifest as binmanifest
+import shastity.columnar as columnar
+import shastity.logging as logging
+import shastity.manifest as manifest
+import shastity.spencode as spencode
+
+log = logging.get_logger(__name__)
+
+DEFAULT_MAX_BYTES = 256*1024*1024
+
+_SUFFIX = '.mf'
+
+_MAGIC = 'shastity-cache'
+
+def _key(ids, name):
+    '''@return The identifiers of the manifest by the given name among ids
+    (see manifest.list_ids()), as recorded in a cache file.'''
+    return ','.join(ids.get(name, [])) or '-'
+
+def _header(ids, chain):
+    '''@return The line preceding the manifest in a cache file, recording
+    the identifiers of the manifests of the given delta chain.'''
+    return ' '.join([ _MAGIC ] + [ '%s %s' % (spencode.spencode(name), _key(ids, name))
+                                   for name in chain ]) + '\n'
+
+def _valid_header(data, ids):
+    '''@return The length of the header of the cache file data, if the
+    identifiers it records agree with ids; otherwise None.'''
+    end = data.find('\n') + 1
+    fields = data[0:end].split()
+    if not fields or fields[0] != _MAGIC or len(fields) % 2 != 1:
+        return None
+    for n in xrange(1, len(fields), 2):
+        try:
+            name = spencode.spdecode(fields[n]).encode('utf-8')
+        except (AssertionError, ValueError, UnicodeError):
+            return None
+        if _key(ids, name) != fields[n + 1]:
+            return None
+    return end
+
+class ManifestCache(object):
+    '''A size bounded, LRU evicted, on-disk cache of the manifests of one
+    backend.
+
+    @ivar hits Number of manifests served from the cache.
+    @ivar misses Number of manifests read from the backend.'''
+
+    def __init__(self, cachedir, uri, max_bytes=DEFAULT_MAX_BYTES):
+        '''
+        @param cachedir: Directory of the cache; created if it does not exist.
+        @param uri: URI of the backend whose manifests are cached.
+        @param max_bytes: Maximum total size of the cache directory, for all
+                          backends.
+        '''
+        self.cachedir = cachedir
+        self.uri = uri
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        self.__prefix = hashlib.sha1(uri).hexdigest()[0:16] + '-'
+        self.__ids = None # manifest name -> identifiers, once listed
+
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+
+    def __path(self, name):
+        return os.path.join(self.cachedir, '%s%s%s' % (self.__prefix, hashlib.sha1(name).hexdigest(), _SUFFIX))
+
+    def get(self, backend, name):
+        '''
+        @param backend: The backend (of our URI) containing the manifest.
+        @param name: Name of the manifest.
+        @return The entries of the manifest, as a ColumnarManifest.'''
+        ids = self.__list(backend)
+        path = self.__path(name)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except IOError:
+            data = None
+
+        offset = None
+        if data is not None:
+            offset = _valid_header(data, ids)
+            if offset is None:
+                log.debug('dropping cached manifest %s (rewritten)', name)
+                self.__remove(path)
+
+        if offset is not None:
+            try:
+                entries = columnar.ColumnarManifest.from_entries(binmanifest.BinaryManifest(data, offset))
+            except binmanifest.BinaryManifestError, e:
+                log.warning('discarding corrupt cached manifest %s: %s', name, e)
+                self.__remove(path)
+            else:
+                self.hits += 1
+                os.utime(path, None) # mark as recently used
+                return entries
+
+        self.misses += 1
+        header = _header(ids, manifest.read_chain(backend, name))
+        entries = columnar.load(backend, name)
+        self.__store(path, header + binmanifest.encode(entries))
+        self.__evict()
+        return entries
+
+    def __list(self, backend):
+        '''List the backend, if not already done, dropping manifests no
+        longer in it from the cache.
+
+        @return A dict of manifest name -> identifiers.'''
+        if self.__ids is None:
+            listing = backend.list()
+            self.__expire([ name for name in listing if not manifest.is_derived_name(name) ])
+            self.__ids = manifest.list_ids(backend, listing)
+        return self.__ids
+
+    def __store(self, path, data):
+        fd, tmppath = tempfile.mkstemp(dir=self.cachedir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(tmppath, path)
+        except:
+            self.__remove(tmppath)
+            raise
+
+    def __remove(self, path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+    def __expire(self, names):
+        '''Drop cached manifests of our backend not among the given names.'''
+        ours = set([ self.__path(name) for name in names ])
+        prefix = os.path.join(self.cachedir, self.__prefix)
+        for path in self.__files():
+            if path.startswith(prefix) and path not in ours:
+                log.debug('dropping cached manifest %s (gone from backend)', path)
+                self.__remove(path)
+
+    def __files(self):
+        return [ os.path.join(self.cachedir, fname) for fname in os.listdir(self.cachedir)
+                 if fname.endswith(_SUFFIX) ]
+
+    def __evict(self):
+        files = []
+        total = 0
+        for path in self.__files():
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+
+        files.sort()
+        for mtime, size, path in files:
+            if total <= self.max_bytes:
+                break
+            log.debug('evicting cached manifest %s', path)
+            self.__remove(path)
+            total -= size
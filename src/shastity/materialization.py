@@ -10,12 +10,25 @@ system.
 from __future__ import absolute_import
 from __future__ import with_statement
 
+import collections
+import errno
+import multiprocessing
+import multiprocessing.pool
 import os.path
+import shutil
+import tarfile
+import tempfile
 import threading
-import re
+import zlib
 
+import shastity.blockcache as blockcache
 import shastity.filesystem as filesystem
+import shastity.hash as hash
 import shastity.logging as logging
+import shastity.metadata as md
+import shastity.metadatapass as metadatapass
+import shastity.selection as selection
+import shastity.spencode as spencode
 import shastity.storagequeue as storagequeue
 import shastity.util as util
 
@@ -24,7 +37,549 @@ log = logging.get_logger(__name__)
 class DestinationPathNotDirectory(Exception):
     pass
 
-def materialize(fs, destpath, entryiter, sq, files = None):
+class PrecedingBlockFailed(Exception):
+    '''Raised to the writer of a block which cannot be written in
+    order, since a block preceding it has failed.'''
+    pass
+
+# Prefix of the temporary names under which files are restored when
+# writing out of order; they are renamed into place once complete.
+PARTIAL_PREFIX = '.shastity-partial.'
+
+def partial_path(local_path):
+    '''@return The temporary path under which local_path is written
+    before being renamed into place.'''
+    dname, fname = os.path.split(local_path)
+    return os.path.join(dname, PARTIAL_PREFIX + fname)
+
+def lstat_or_none(fs, path):
+    '''@return The lstat() of the given path, or None if nothing exists there.'''
+    try:
+        return fs.lstat(path)
+    except (OSError, IOError), e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+
+def open_for_write(fs, path):
+    '''Open the given path for writing from scratch. Whatever (non
+    directory) entry is already there is removed first, so that a
+    symlink is never followed out of the destination tree, and a
+    read-only file does not get in the way.'''
+    existing = lstat_or_none(fs, path)
+    if existing is not None and not existing.is_directory:
+        fs.unlink(path)
+    return fs.open(path, 'w')
+
+def blocks_fit(size, totblocks, blocksize):
+    '''@return Whether a file of the given size can have been split
+    into totblocks blocks of the given block size (i.e., whether block
+    offsets can be derived from block numbers).'''
+    if totblocks == 0:
+        return size == 0
+    return (totblocks - 1) * blocksize < size <= totblocks * blocksize
+
+class SyncPolicy(object):
+    """
+    Abstract base class of policies for how and when materialized
+    files are flushed to stable storage (fsync():ed).
+
+    A policy is handed each file once all of its data has been
+    written (file_done()), and is responsible for closing it and, if
+    it was written under a temporary name, renaming it into place.
+    Policies which delay flushing require files to be written under
+    temporary names (use_temp_names), and only rename them into place
+    once their data has been flushed. A crash thus never leaves a file
+    under its final name without its contents being durable.
+
+    Policies must be thread-safe; file_done() is called from storage
+    queue workers.
+
+    Once a file is known to be durable under its final name, it is
+    recorded in the journal (if any), allowing an interrupted restore
+    to be resumed.
+
+    @ivar use_temp_names Whether files must be written under temporary names.
+    @ivar journal        RestoreJournal in which to record durable files, or None.
+    """
+    use_temp_names = False
+    journal = None
+
+    def durable(self, fname):
+        """
+        Called by subclasses once the given file is durable.
+        """
+        if self.journal is not None:
+            self.journal.record(fname)
+
+    def file_done(self, fs, fobj, fname, tmpname):
+        """
+        @param fs: The file system.
+        @param fobj: Open file object of the completely written file.
+        @param fname: The final name of the file.
+        @param tmpname: The name under which the file was written, if
+                        not fname (else None, which is also the case for
+                        files updated in place).
+        """
+        raise NotImplementedError
+
+    def finish(self, fs, destpath):
+        """
+        Called once all files have been handed to file_done().
+
+        @param destpath: Root of the materialized tree.
+        """
+        pass
+
+class PerFileSync(SyncPolicy):
+    """
+    fsync() each file as soon as it is complete (the default).
+    """
+    def file_done(self, fs, fobj, fname, tmpname):
+        log.debug('fsync():ing after final block of %s', fname)
+        fobj.flush()
+        fs.fsync(fobj.fileno())
+        fobj.close()
+        if tmpname is not None:
+            fs.rename(tmpname, fname)
+        self.durable(fname)
+
+class BatchedSync(SyncPolicy):
+    """
+    Start write-out of each file as soon as it is complete, and fsync()
+    complete files in batches once a number of files or bytes has
+    accumulated. Since the kernel has had the opportunity to write out
+    many files concurrently, the fsync():s of a batch are cheap
+    compared to fsync():ing each file as it completes.
+
+    Completed files are closed while waiting for their batch (and
+    re-opened to be fsync():ed), so as to not hold on to file
+    descriptors.
+    """
+    use_temp_names = True
+
+    def __init__(self, max_files=1000, max_bytes=256*1024*1024):
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+
+        self.__lock = threading.Lock()
+        self.__pending = [] # (tmpname, fname)
+        self.__pending_bytes = 0
+
+    def file_done(self, fs, fobj, fname, tmpname):
+        fobj.flush()
+        fs.start_writeback(fobj.fileno())
+        size = fobj.tell()
+        fobj.close()
+
+        with self.__lock:
+            self.__pending.append((tmpname, fname))
+            self.__pending_bytes += size
+
+            if len(self.__pending) < self.max_files and self.__pending_bytes < self.max_bytes:
+                return
+
+            batch = self.__pending
+            self.__pending = []
+            self.__pending_bytes = 0
+
+        self.__flush(fs, batch)
+
+    def __flush(self, fs, batch):
+        log.debug('fsync():ing batch of %d files', len(batch))
+        for tmpname, fname in batch:
+            with fs.open(tmpname or fname, 'r') as f:
+                fs.fsync(f.fileno())
+        for tmpname, fname in batch:
+            if tmpname is not None:
+                fs.rename(tmpname, fname)
+            self.durable(fname)
+
+    def finish(self, fs, destpath):
+        with self.__lock:
+            batch = self.__pending
+            self.__pending = []
+            self.__pending_bytes = 0
+        self.__flush(fs, batch)
+
+class SyncfsAtEnd(SyncPolicy):
+    """
+    Do not flush individual files. Instead flush the entire file
+    system once (syncfs()) when the materialization is complete, and
+    only then rename all files into place.
+
+    The list of pending renames is kept in memory.
+    """
+    use_temp_names = True
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__pending = [] # (tmpname, fname)
+
+    def file_done(self, fs, fobj, fname, tmpname):
+        fobj.close()
+        with self.__lock:
+            self.__pending.append((tmpname, fname))
+
+    def finish(self, fs, destpath):
+        log.debug('flushing file system of %s', destpath)
+        fs.syncfs(destpath)
+        for tmpname, fname in self.__pending:
+            if tmpname is not None:
+                fs.rename(tmpname, fname)
+        # make the renames durable too
+        fs.syncfs(destpath)
+        for tmpname, fname in self.__pending:
+            self.durable(fname)
+        self.__pending = []
+
+class NoSync(SyncPolicy):
+    """
+    Never flush; leave it to the operating system. Files are written
+    under their final names, so a crash may leave files whose contents
+    are incomplete.
+    """
+    def file_done(self, fs, fobj, fname, tmpname):
+        fobj.close()
+        if tmpname is not None:
+            fs.rename(tmpname, fname)
+
+_sync_policies = dict(file=PerFileSync,
+                      batch=BatchedSync,
+                      syncfs=SyncfsAtEnd,
+                      none=NoSync)
+
+def make_sync_policy(name, **kwargs):
+    """
+    @param name: One of 'file', 'batch', 'syncfs' and 'none'.
+    @param kwargs: Passed to the policy constructor (see BatchedSync).
+    @return A SyncPolicy instance.
+    """
+    if name not in _sync_policies:
+        raise ValueError('unknown fsync policy: %s (expected one of %s)'
+                         '' % (name, ', '.join(sorted(_sync_policies.keys()))))
+    return _sync_policies[name](**kwargs)
+
+# Name of the restore journal kept in the root of the destination
+# (see RestoreJournal).
+JOURNAL_NAME = '.shastity-journal'
+
+class RestoreJournal(object):
+    '''A journal of the files of a restore which are completely
+    written and durable, allowing an interrupted restore to be resumed
+    without redoing them.
+
+    The journal is a text file with one spencoded path per line. It is
+    only appended to after the file it records is durable, and is
+    itself not flushed to stable storage; an entry lost in a crash
+    merely means the file is checked against the manifest on resume.
+    Since the set of completed files is kept in memory on resume, its
+    size is proportional to the number of files restored.'''
+
+    def __init__(self, fs, path, resume=False):
+        '''
+        @param fs: The file system in which to keep the journal.
+        @param path: Path of the journal file.
+        @param resume: Whether to load (and continue) an existing journal,
+                       rather than starting afresh.
+        '''
+        self.__fs = fs
+        self.__path = path
+        self.__lock = threading.Lock()
+        self.__completed = set()
+
+        if resume and fs.exists(path):
+            with fs.open(path, 'r') as f:
+                for line in f.read().split('\n'):
+                    # ignore a torn last line
+                    if len(line) >= 2 and line[0] == "'" and line[-1] == "'":
+                        self.__completed.add(spencode.spdecode(line))
+            log.info('resuming restore; %d files already complete', len(self.__completed))
+            self.__fobj = fs.open(path, 'a')
+        else:
+            self.__fobj = fs.open(path, 'w')
+
+    def is_complete(self, fname):
+        '''@return Whether the given file was recorded as complete by a previous run.'''
+        return fname in self.__completed
+
+    def record(self, fname):
+        '''Record the given file as complete and durable.'''
+        with self.__lock:
+            self.__fobj.write(spencode.spencode(fname) + '\n')
+            self.__fobj.flush()
+
+    def close(self, remove=False):
+        '''
+        @param remove: Remove the journal (when the restore has completed).
+        '''
+        with self.__lock:
+            self.__fobj.close()
+            if remove:
+                self.__fs.unlink(self.__path)
+
+def block_length(size, blocksize, block_num):
+    '''@return The length of the given block of a file of the given
+    size, assuming blocks_fit().'''
+    return min(blocksize, size - block_num * blocksize)
+
+_zero_hashes = dict() # (algo, length) -> hash
+
+def zero_block_hash(algo, length):
+    '''@return The hash (as found in manifests) of a block of the given
+    length consisting of zeros.'''
+    key = (algo, length)
+    if key not in _zero_hashes:
+        _zero_hashes[key] = hash.make_hasher(algo)('\0' * length)[1]
+    return _zero_hashes[key]
+
+def is_zero(bytestr):
+    '''@return Whether the given (non-empty) byte string consists of zeros.'''
+    return bytestr.count('\0') == len(bytestr)
+
+def zero_blocks(size, hashes, blocksize):
+    '''Identify the blocks of a file which are known to consist of
+    zeros by their hashes alone, without having to fetch them.
+
+    @param hashes: The (algo, hash) list of the file, from the manifest.
+    @return A dict mapping the numbers of such blocks to their lengths.'''
+    holes = dict()
+    for block_num, (algo, blockhash) in enumerate(hashes):
+        length = block_length(size, blocksize, block_num)
+        if blockhash == zero_block_hash(algo, length):
+            holes[block_num] = length
+    return holes
+
+class FileMaterialization(object):
+    """
+    Sequential materialization of a single file; the synchronization
+    point for the callbacks of the GET operations of its blocks.
+
+    In sparse mode, blocks consisting of zeros are skipped over rather
+    than written, leaving holes in the file. Blocks known in advance
+    to be zero (holes) are never delivered to write_block(), and are
+    skipped as soon as the preceding block has been written.
+
+    If a block is never going to be written (its GET or its write
+    failed), fail() must be called, releasing the writers of the
+    blocks following it.
+    """
+    def __init__(self, fs, fname, totblocks, sync_policy, sparse=False, holes=None):
+        """
+        @param fs: File system to which the file belongs.
+        @param fname: File name being materialized.
+        @param totblocks: Total number of expected blocks.
+        @param sync_policy: SyncPolicy to hand the file to once complete.
+        @param sparse: Skip over blocks consisting of zeros.
+        @param holes: Dict of block number -> length of blocks known to be zero,
+                      which will not be delivered. Requires sparse.
+        """
+        assert sparse or not holes
+
+        self.__fs = fs
+        self.__fname = fname
+        self.__tmpname = partial_path(fname) if sync_policy.use_temp_names else None
+        self.__totblocks = totblocks
+        self.__sync_policy = sync_policy
+        self.__sparse = sparse
+        self.__holes = holes or dict()
+        self.__fobj = open_for_write(fs, self.__tmpname or fname)
+
+        self.__cond = threading.Condition()
+        self.__last_block = -1 # last block written, -1 if no block written
+        self.__failed = False
+
+        with self.__cond:
+            self.__skip_holes()
+            if self.__last_block == totblocks - 1:
+                self.__finish()
+
+    def write_block(self, bytestr, block_num):
+        """
+        Blocks until block (block_num - 1) has been written, and
+        writes the block.
+
+        @param bytestr: Byte string to write to file.
+        @param block_num: The block number (first block is 0).
+        """
+        with self.__cond:
+            while self.__last_block != block_num - 1 and not self.__failed:
+                self.__cond.wait()
+            if self.__failed:
+                raise PrecedingBlockFailed('not writing block %d of %s' % (block_num, self.__fname))
+
+        assert self.__last_block == block_num - 1
+
+        if self.__sparse and bytestr and is_zero(bytestr):
+            log.info('skipping zero block %d of file %s', block_num, self.__fname)
+            self.__fobj.seek(len(bytestr), os.SEEK_CUR)
+        else:
+            log.info('materializing block %d of file %s', block_num, self.__fname)
+            self.__fobj.write(bytestr)
+
+        with self.__cond:
+            self.__last_block += 1
+            assert self.__last_block == block_num
+            self.__skip_holes()
+            self.__cond.notifyAll() # not terribly efficient
+
+            if self.__last_block == self.__totblocks - 1:
+                self.__finish()
+
+    def fail(self, reason):
+        '''Called when a block will never be written, releasing (with
+        an error) the writers of subsequent blocks.'''
+        with self.__cond:
+            self.__failed = True
+            self.__cond.notifyAll()
+
+    def __skip_holes(self):
+        '''@pre self.__cond locked'''
+        while self.__last_block + 1 in self.__holes:
+            self.__fobj.seek(self.__holes[self.__last_block + 1], os.SEEK_CUR)
+            self.__last_block += 1
+
+    def __finish(self):
+        if self.__sparse:
+            # a trailing hole must still count towards the size
+            self.__fobj.truncate(self.__fobj.tell())
+        self.__sync_policy.file_done(self.__fs, self.__fobj, self.__fname, self.__tmpname)
+
+class PositionalFileMaterialization(object):
+    """
+    Out-of-order materialization of a single file. The file is
+    written under a temporary name, preallocated to its final size,
+    and blocks are written at their offsets as soon as they arrive.
+    Once all blocks have landed the file is truncated to its final
+    size and handed to the sync policy, which renames it into place.
+
+    In in-place mode (used by delta restores), an existing file is
+    instead opened for update under its final name, only the blocks
+    that differ are written, and the file is truncated or extended to
+    its final size.
+
+    In sparse mode, the file is not preallocated, and blocks
+    consisting of zeros are not written (or, in in-place mode, have
+    holes punched for them).
+    """
+    def __init__(self, fs, fname, totblocks, size, blocksize, sync_policy, pending=None, in_place=False,
+                 sparse=False, holes=None):
+        """
+        @param fs: File system to which the file belongs.
+        @param fname: File name being materialized.
+        @param totblocks: Total number of blocks of the file.
+        @param size: The final size of the file.
+        @param blocksize: The size of all blocks but the last.
+        @param sync_policy: SyncPolicy to hand the file to once complete.
+        @param pending: Number of blocks that will be written, not counting holes
+                        (defaults to all blocks which are not holes).
+        @param in_place: Update the existing file rather than writing a new one.
+        @param sparse: Do not preallocate, and do not write blocks consisting of zeros.
+        @param holes: Dict of block number -> length of blocks known to be zero,
+                      which will not be delivered. Requires sparse.
+        """
+        assert blocks_fit(size, totblocks, blocksize)
+        assert sparse or not holes
+
+        holes = holes or dict()
+
+        self.__fs = fs
+        self.__fname = fname
+        self.__tmpname = None if in_place else partial_path(fname)
+        self.__totblocks = totblocks
+        self.__size = size
+        self.__blocksize = blocksize
+        self.__sync_policy = sync_policy
+        self.__in_place = in_place
+        self.__sparse = sparse
+
+        self.__lock = threading.Lock() # serializes writes, protects __remaining
+        self.__remaining = (totblocks - len(holes)) if pending is None else pending
+
+        if in_place:
+            self.__fobj = fs.open(fname, 'r+')
+            self.__fobj.truncate(size)
+            for block_num, length in holes.iteritems():
+                fs.punch_hole(self.__fobj, block_num * blocksize, length)
+        elif sparse:
+            self.__fobj = open_for_write(fs, self.__tmpname)
+            self.__fobj.truncate(size)
+        else:
+            self.__fobj = open_for_write(fs, self.__tmpname)
+            fs.allocate(self.__fobj, size)
+
+        if self.__remaining == 0:
+            self.__finish()
+
+    def write_block(self, bytestr, block_num):
+        """
+        Write the given block at its offset, finishing the file if it
+        was the last outstanding block.
+
+        @param bytestr: Byte string to write to file.
+        @param block_num: The block number (first block is 0).
+        """
+        expected = block_length(self.__size, self.__blocksize, block_num)
+        assert len(bytestr) == expected, ('block %d of %s has size %d, expected %d'
+                                          '' % (block_num, self.__fname, len(bytestr), expected))
+
+        with self.__lock:
+            offset = block_num * self.__blocksize
+            if self.__sparse and is_zero(bytestr):
+                log.info('skipping zero block %d of file %s', block_num, self.__fname)
+                if self.__in_place:
+                    self.__fs.punch_hole(self.__fobj, offset, len(bytestr))
+            else:
+                log.info('materializing block %d of file %s', block_num, self.__fname)
+                self.__fs.pwrite(self.__fobj, offset, bytestr)
+
+            self.__remaining -= 1
+            if self.__remaining == 0:
+                self.__finish()
+
+    def fail(self, reason):
+        '''Called when a block will never be written. Nothing waits
+        for it, so there is nothing to release.'''
+        pass
+
+    def __finish(self):
+        self.__fobj.truncate(self.__size)
+        self.__fobj.seek(self.__size)
+        self.__sync_policy.file_done(self.__fs, self.__fobj, self.__fname, self.__tmpname)
+
+def changed_blocks(fs, fname, hashes, blocksize):
+    '''Hash the existing file at the given block boundaries and
+    compare against the expected hashes.
+
+    @param hashes: The (algo, hash) list of the file, from the manifest.
+    @return The list of numbers of the blocks whose contents differ from
+            (or are missing in) the existing file.'''
+    changed = []
+    with fs.open(fname, 'r') as f:
+        for block_num, (algo, expected) in enumerate(hashes):
+            data = f.read(blocksize)
+            if not data or hash.make_hasher(algo)(data)[1] != expected:
+                changed.append(block_num)
+    return changed
+
+def select_entries(files, entryiter):
+    '''Filter a manifest stream down to the entries to materialize for
+    the given selection (see materialize()): selected entries, and the
+    directories leading up to them.
+
+    @param files: A PathSelector, list of paths, or None for all entries.'''
+    if files is None:
+        return entryiter
+    if not isinstance(files, selection.PathSelector):
+        files = selection.PathSelector(files)
+    return ( (path, metadata, hashes)
+             for path, metadata, hashes, state in selection.filter_entries(files, entryiter)
+             if state == selection.SELECTED or metadata.is_directory )
+
+def materialize(fs, destpath, entryiter, sq, files = None, positional=False, blocksize=None,
+                block_cache=None, sync_policy=None, delta=False, hash_threads=None, sparse=False,
+                apply_metadata=False, chown=False, metadata_threads=metadatapass.DEFAULT_THREADS,
+                journal=None, resume=False, verify=False):
     '''
     @type fs FileSystem instance.
     @param fs File system into which to materialize the stream.
@@ -38,8 +593,43 @@ def materialize(fs, destpath, entryiter, sq, files = None):
     @param sq Storage queue via which to perform read operations necessary in
               order to populate the tree.
 
-    @type files list of strings
-    @param files List of files to materalize. If None materialize all.
+    @type files list of strings, or PathSelector
+    @param files Paths (possibly containing wildcards) to materialize, along with
+                 everything below them. If None materialize all. See the selection
+                 module.
+
+    @param positional If true, write blocks out of order as they arrive (see below).
+    @param blocksize The block size the backup was persisted with. Required
+                     if positional is true.
+
+    @type block_cache BlockCache
+    @param block_cache If given, blocks are fetched through this cache (whose
+                       reference counts must cover the entries being
+                       materialized), such that shared blocks are fetched once.
+
+    @type sync_policy SyncPolicy
+    @param sync_policy How to flush files to stable storage. Defaults to PerFileSync.
+
+    @param delta If true, materialize onto an existing tree, fetching only
+                 the blocks of existing files which differ (see below).
+                 Requires blocksize.
+    @param hash_threads Number of threads hashing existing files in delta mode.
+                        Defaults to the number of CPUs.
+
+    @param sparse If true, leave holes in files instead of writing blocks of
+                  zeros (see below).
+
+    @param apply_metadata If true, apply permissions and times (and, if chown is
+                          true, ownership) of all materialized entries in a
+                          final pass (see the metadatapass module).
+    @param metadata_threads Number of threads applying meta data.
+
+    @type journal RestoreJournal
+    @param journal If given, durable files are recorded in this journal.
+    @param resume If true, continue an interrupted restore (see below).
+                  Requires blocksize.
+    @param verify If true, when resuming, check even the files recorded
+                  in the journal against the manifest hashes.
     '''
     # We traverse the list in order, thus ensuring that directories
     # are created prior to their contents. However, we also want to
@@ -63,104 +653,579 @@ def materialize(fs, destpath, entryiter, sq, files = None):
     # bytes, will probably conclude that N bytes have been
     # restored. If parts of the file are sparse because of
     # out-of-order writes, this could cause quite a lot of
-    # confusion. So even though it is strictly speaking sub-optimal
-    # from a performance standpoint, we will require sequential
-    # writes. This means that the callback for block n for a file,
-    # will not return until the callback for block n - 1 has returned.
+    # confusion. So by default, even though it is strictly speaking
+    # sub-optimal from a performance standpoint, we require
+    # sequential writes. This means that the callback for block n for
+    # a file, will not return until the callback for block n - 1 has
+    # returned.
     #
     # We accomplish this by creating a FileMaterialization instance
     # for each file that we are restoring, which is the
     # synchronization point for the callbacks.
+    #
+    # In positional mode we instead use PositionalFileMaterialization,
+    # which writes each block at its offset as soon as it arrives, so
+    # that a single slow block does not stall the others. The POLA
+    # concern is addressed by writing to a temporary name which is
+    # only renamed into place once all blocks have landed. Since the
+    # manifest does not record the block size, the caller must supply
+    # it; files whose size does not agree with it are materialized
+    # sequentially.
+    #
+    # In delta mode, existing files are hashed at the block boundaries
+    # of the manifest (in parallel, by a pool of threads which then
+    # enqueue GETs for the differing blocks), and updated in place
+    # using PositionalFileMaterialization. Files that do not exist, or
+    # whose size does not agree with the block size, are materialized
+    # from scratch.
+    #
+    # In sparse mode, blocks of zeros are not written but skipped
+    # over (or have holes punched for them, when updating in place),
+    # keeping sparse files such as VM images sparse. Where the block
+    # size is known, zero blocks are recognized by their hashes in the
+    # manifest and not even fetched; otherwise they are recognized as
+    # they arrive.
+    #
+    # When resuming, files recorded as complete in the journal are
+    # skipped (unless verify is true). Other existing files are
+    # treated as in delta mode: blocks confirmed by their hashes are
+    # kept, and the rest (typically everything following the last
+    # block written before the interruption) is fetched. A file of the
+    # right size is not trusted without its hashes, since an
+    # interrupted in-place update leaves the file at its final size
+    # with stale contents. Partial files (see partial_path()) left
+    # behind by the interruption are removed.
+    assert not positional or blocksize, 'positional materialization requires the block size'
+    assert not delta or blocksize, 'delta materialization requires the block size'
+    assert not resume or blocksize, 'resuming materialization requires the block size'
 
-    class FileMaterialization:
-        """
-        TODO: Handle I/O errors (propagate to callers of write_block).
-        """
-        def __init__(self, fname, totblocks, fobj):
-            """
-            @param fname: File name being materialized.
-            @param totblocks: Total number of expected blocks.
-            @param fobj: File object to which to write blocks.
-            """
-            self.__fname = fname
-            self.__totblocks = totblocks
-            self.__fobj = fobj
-
-            self.__cond = threading.Condition()
-            self.__last_block = -1 # last block written, -1 if no block written
-
-        def write_block(self, bytestr, block_num):
-            """
-            Blocks until block (block_num - 1) has been written, and
-            writes the block.
-
-            @param bytestr: Byte string to write to file.
-            @param block_num: The block number (first block is 0).
-            """
-            with self.__cond:
-                while self.__last_block != block_num - 1:
-                    self.__cond.wait()
+    incremental = delta or resume
 
-            assert self.__last_block == block_num - 1
+    if sync_policy is None:
+        sync_policy = PerFileSync()
+    sync_policy.journal = journal
 
-            log.info('materializing block %d of file %s', block_num, self.__fname)
-            self.__fobj.write(bytestr)
+    def deliver(m13n, block_num, blockname, bstr):
+        m13n.write_block(bstr, block_num)
+        if block_cache is not None:
+            block_cache.release(blockname)
+
+    def get_op(m13n, block_num, blockname):
+        callback = util.bind(deliver, m13n, block_num, blockname)
+        if block_cache is not None:
+            return blockcache.CachedGetOperation(name=blockname,
+                                                 cache=block_cache,
+                                                 callback=callback,
+                                                 errback=m13n.fail)
+        else:
+            return storagequeue.GetOperation(name=blockname,
+                                             callback=callback,
+                                             errback=m13n.fail)
+
+    def enqueue_blocks(m13n, blocknames):
+        """@param blocknames: (block_num, blockname) pairs."""
+        ops = [ get_op(m13n, block_num, blockname)
+                for block_num, blockname in blocknames ]
+        for op in ops:
+            sq.enqueue(op)
+
+    def skip_blocks(hashes, block_nums):
+        '''Account for blocks which will not be fetched.'''
+        if block_cache is not None:
+            for block_num in block_nums:
+                block_cache.release(hashes[block_num][1])
+
+    def find_holes(metadata, hashes):
+        if sparse and blocksize and blocks_fit(metadata.size, len(hashes), blocksize):
+            return zero_blocks(metadata.size, hashes, blocksize)
+        return dict()
 
-            with self.__cond:
-                self.__last_block += 1
-                assert self.__last_block == block_num
-                self.__cond.notifyAll() # not terribly efficient
+    def delta_file(local_path, existing, metadata, hashes):
+        try:
+            # The file may be read-only (not least because a previous
+            # restore applied its meta data); make it readable and
+            # writable by us for as long as it takes to open it.
+            bits = md.mode_to_bits(existing)
+            if bits & 0600 != 0600:
+                fs.chmod(local_path, bits | 0600)
+            try:
+                changed = changed_blocks(fs, local_path, hashes, blocksize)
+                log.info('%d of %d blocks of %s differ', len(changed), len(hashes), local_path)
 
-                if block_num == self.__totblocks - 1:
-                    log.debug('fsync():ing after final block of %s', self.__fname)
-                    self.__fobj.flush()
-                    # todo: always, or optionally based on settings, delay fsync
-                    # in order to avoid overhead.
-                    fs.fsync(self.__fobj.fileno())
-                    self.__fobj.close()
+                holes = find_holes(metadata, hashes)
+                holes = dict([ (block_num, holes[block_num]) for block_num in changed if block_num in holes ])
+                fetch = [ block_num for block_num in changed if block_num not in holes ]
+                skip_blocks(hashes, set(xrange(0, len(hashes))) - set(fetch))
+
+                m13n = PositionalFileMaterialization(fs,
+                                                     fname=local_path,
+                                                     totblocks=len(hashes),
+                                                     size=metadata.size,
+                                                     blocksize=blocksize,
+                                                     sync_policy=sync_policy,
+                                                     pending=len(fetch),
+                                                     in_place=True,
+                                                     sparse=sparse,
+                                                     holes=holes)
+            finally:
+                if bits & 0600 != 0600:
+                    fs.chmod(local_path, bits)
+            enqueue_blocks(m13n, [ (block_num, hashes[block_num][1]) for block_num in fetch ])
+        finally:
+            delta_slots.release()
 
     if not fs.is_dir(destpath):
         raise DestinationPathNotDirectory(destpath)
 
-    curdir = None
-    for path, metadata, hashes in entryiter:
-        local_path = os.path.join(destpath, path)
+    entryiter = select_entries(files, entryiter)
+
+    pool = None
+    spool = metadatapass.MetadataSpool() if apply_metadata else None
+    try:
+        if incremental:
+            if hash_threads is None:
+                hash_threads = multiprocessing.cpu_count()
+            pool = multiprocessing.pool.ThreadPool(hash_threads)
+            # bounds the number of files waiting to be hashed
+            delta_slots = threading.Semaphore(hash_threads * 4)
+            delta_results = collections.deque()
+
+        curdir = None
+        for path, metadata, hashes in entryiter:
+            local_path = os.path.join(destpath, path)
+
+            log.info('materializing [%s]', path)
+
+            assert not path.startswith('/')
+
+            if spool is not None:
+                spool.add(local_path, metadata, path.count('/'))
 
-        log.info('materializing [%s]', path)
+            # In incremental mode, a (non directory) entry may already
+            # be in the way. Only regular files are updated in place;
+            # anything else is removed before the entry is created (see
+            # open_for_write()), and never followed.
+            existing = None
+            if incremental and not metadata.is_directory:
+                existing = lstat_or_none(fs, local_path)
+                if existing is not None and existing.is_directory:
+                    existing = None
 
-        assert not path.startswith('/')
+            if resume and not metadata.is_directory and not metadata.is_symlink:
+                tmpname = partial_path(local_path)
+                if lstat_or_none(fs, tmpname) is not None:
+                    log.info('removing partial file %s of interrupted restore', tmpname)
+                    fs.unlink(tmpname)
 
-        if metadata.is_directory:
-            if files is not None:
-                for f in files:
-                    if re.search("^" + path, f):
-                        break
+            if metadata.is_directory:
+                if not (incremental and fs.is_dir(local_path)):
+                    fs.mkdir(local_path)
+                curdir = path
+            elif metadata.is_symlink:
+                if existing is not None:
+                    fs.unlink(local_path)
+                fs.symlink(metadata.symlink_value, local_path)
+            elif (resume
+                  and not verify
+                  and journal is not None
+                  and existing is not None
+                  and existing.is_regular
+                  and existing.size == metadata.size
+                  and journal.is_complete(local_path)):
+                log.info('skipping already materialized file %s', local_path)
+                skip_blocks(hashes, xrange(0, len(hashes)))
+            elif (existing is not None
+                  and existing.is_regular
+                  and blocks_fit(metadata.size, len(hashes), blocksize)):
+                delta_slots.acquire()
+                delta_results.append(pool.apply_async(delta_file, (local_path, existing, metadata, hashes)))
+                # propagate errors early, and do not accumulate results
+                while delta_results and delta_results[0].ready():
+                    delta_results.popleft().get()
+            else:
+                # TODO: figure out why these needed to be commented out,
+                # and whether they should be removed or not.
+                #assert curdir is not None, 'no curdir - first entry not directory?'
+                #assert path.startswith(curdir), ('%s does not start with %s - out of order?'
+                #                                 '' % (path, curdir))
+                # TODO: fix perms before any writing happens
+                holes = find_holes(metadata, hashes)
+                skip_blocks(hashes, holes.keys())
+                if positional and blocks_fit(metadata.size, len(hashes), blocksize):
+                    m13n = PositionalFileMaterialization(fs,
+                                                         fname=local_path,
+                                                         totblocks=len(hashes),
+                                                         size=metadata.size,
+                                                         blocksize=blocksize,
+                                                         sync_policy=sync_policy,
+                                                         sparse=sparse,
+                                                         holes=holes)
                 else:
-                    continue
+                    m13n = FileMaterialization(fs,
+                                               fname=local_path,
+                                               totblocks=len(hashes),
+                                               sync_policy=sync_policy,
+                                               sparse=sparse,
+                                               holes=holes)
+
+                enqueue_blocks(m13n, [ (block_num, algohash[1])
+                                       for block_num, algohash in enumerate(hashes)
+                                       if block_num not in holes ])
+
+        if incremental:
+            pool.close()
+            pool.join()
+            for result in delta_results:
+                result.get()
+        sq.wait()
+        sync_policy.finish(fs, destpath)
+
+        if block_cache is not None:
+            log.info('block cache: %d hits, %d misses', block_cache.hits, block_cache.misses)
+
+        if spool is not None:
+            spool.apply(fs, threads=metadata_threads, chown=chown)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        if spool is not None:
+            spool.close()
+
+class ShardFailed(Exception):
+    pass
+
+def shard_of(path, shards):
+    '''@return The shard (0 to shards - 1) to which the given path belongs.'''
+    if isinstance(path, unicode):
+        path = path.encode('utf-8')
+    return (zlib.crc32(path) & 0xffffffff) % shards
+
+class ShardSpool(object):
+    '''Partitions entries into shards (see shard_of()), spooled to
+    local disk in a textual form, such that each shard can be read back
+    (any number of times, and by a forked child) without reading the
+    manifest again.'''
+
+    def __init__(self, shards):
+        self.__spooldir = tempfile.mkdtemp(suffix='-shastity-shards')
+        self.__files = [ open(self.__path(shard), 'w') for shard in xrange(0, shards) ]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        self.close()
+
+    def __path(self, shard):
+        return os.path.join(self.__spooldir, 'shard.%d' % (shard,))
+
+    def add(self, path, metadata, hashes):
+        line = '%s %s | %s\n' % (spencode.spencode(path),
+                                 ' '.join([ '%s,%s' % (algo, hex) for algo, hex in hashes ]),
+                                 metadata.to_string())
+        self.__files[shard_of(path, len(self.__files))].write(line)
+
+    def finish(self):
+        '''Complete the spool; called once all entries have been added.'''
+        for f in self.__files:
+            f.close()
+
+    def entries(self, shard):
+        '''@return An iterator over the entries of the given shard, in the
+        order in which they were added.'''
+        with open(self.__path(shard), 'r') as f:
+            for line in f:
+                head, mdstr = line.rstrip('\n').split(' | ', 1)
+                comps = head.split(' ')
+                hashes = [ tuple(algohash.split(',', 1)) for algohash in comps[1:] if algohash ]
+                yield (spencode.spdecode(comps[0]), md.FileMetaData.from_string(mdstr), hashes)
+
+    def close(self):
+        for f in self.__files:
+            f.close()
+        shutil.rmtree(self.__spooldir, ignore_errors=True)
+
+def materialize_sharded(fs, destpath, entries_factory, sq_factory, processes, files=None,
+                        cache_factory=None, incremental=False,
+                        apply_metadata=False, chown=False, metadata_threads=metadatapass.DEFAULT_THREADS,
+                        **kwargs):
+    '''
+    Materialize using several processes, for when a single process is
+    CPU bound (typically on decryption) and limited to one core by the
+    GIL.
 
-            fs.mkdir(local_path)
-            # TODO: fix perms
-            curdir = path
+    The non-directory entries are split into disjoint shards by a hash
+    of their paths, and each shard is materialized (by materialize())
+    in its own process, with its own storage queue. The calling process
+    reads the manifest once, creating all directories and spooling each
+    shard to local disk (see ShardSpool) beforehand, and applies meta
+    data afterwards.
+
+    Child processes are forked, and so inherit the state of the caller
+    (such as any journal).
+
+    @param entries_factory Callable returning an iterable of the (path, metadata,
+                           hashes) entries to materialize. Called once.
+    @param sq_factory Callable returning a new StorageQueue. Called in each child.
+    @param processes Number of processes (shards).
+    @param files As for materialize().
+    @param cache_factory If given, callable returning a BlockCache (or None) for a given
+                         iterable of entries. Called in each child with its shard.
+    @param incremental Whether existing directories are acceptable (as when resuming,
+                       or in delta mode).
+    @param apply_metadata As for materialize().
+    @param chown As for materialize().
+    @param metadata_threads As for materialize().
+    @param kwargs Passed to materialize() in each child.
+    '''
+    if not fs.is_dir(destpath):
+        raise DestinationPathNotDirectory(destpath)
+
+    def run_shard(shard):
+        cache = cache_factory(spool.entries(shard)) if cache_factory is not None else None
+        try:
+            with sq_factory() as sq:
+                materialize(fs, destpath, spool.entries(shard), sq, block_cache=cache, **kwargs)
+        finally:
+            if cache is not None:
+                cache.close()
+
+    mdspool = metadatapass.MetadataSpool() if apply_metadata else None
+    spool = ShardSpool(processes)
+    try:
+        for path, metadata, hashes in select_entries(files, entries_factory()):
+            local_path = os.path.join(destpath, path)
+            if mdspool is not None:
+                mdspool.add(local_path, metadata, path.count('/'))
+            if metadata.is_directory:
+                if not (incremental and fs.is_dir(local_path)):
+                    fs.mkdir(local_path)
+            else:
+                spool.add(path, metadata, hashes)
+        spool.finish()
+
+        children = [ multiprocessing.Process(target=run_shard, args=(shard,))
+                     for shard in xrange(0, processes) ]
+        for child in children:
+            child.start()
+        for child in children:
+            child.join()
+
+        failed = [ shard for shard, child in enumerate(children) if child.exitcode != 0 ]
+        if failed:
+            raise ShardFailed('materialization of shard(s) %s failed' % (', '.join([ str(shard) for shard in failed ]),))
+
+        if mdspool is not None:
+            mdspool.apply(fs, threads=metadata_threads, chown=chown)
+    finally:
+        spool.close()
+        if mdspool is not None:
+            mdspool.close()
+
+class ExtractError(Exception):
+    pass
+
+class _RangeWriter(object):
+    '''Writes the requested byte range of consecutive blocks to a
+    stream, in order, as the blocks arrive.'''
+    def __init__(self, out, first_block, skip, length):
+        '''
+        @param out: File-like object to write to.
+        @param first_block: Number of the first block of the range.
+        @param skip: Number of bytes of the first block preceding the range.
+        @param length: Length of the range.
+        '''
+        self.__out = out
+        self.__first_block = first_block
+        self.__skip = skip
+        self.__remaining = length
+
+        self.__cond = threading.Condition()
+        self.__next_block = first_block
+        self.__failed = False
+
+    def write_block(self, block_num, bytestr):
+        with self.__cond:
+            while self.__next_block != block_num and not self.__failed:
+                self.__cond.wait()
+            if self.__failed:
+                raise ExtractError('not writing block %d; a preceding block failed' % (block_num,))
+
+        if block_num == self.__first_block:
+            bytestr = bytestr[self.__skip:]
+        bytestr = bytestr[0:self.__remaining]
+        self.__out.write(bytestr)
+
+        with self.__cond:
+            self.__remaining -= len(bytestr)
+            self.__next_block += 1
+            self.__cond.notifyAll()
+
+    def fail(self, reason):
+        '''Called when a block will never be written, releasing (with
+        an error) the writers of subsequent blocks.'''
+        with self.__cond:
+            self.__failed = True
+            self.__cond.notifyAll()
+
+def extract_range(entryiter, path, sq, out, blocksize, offset=0, length=None):
+    '''
+    Extract a byte range of a single file, fetching only the blocks
+    covering the range.
+
+    @type entryiter iterable yielding (path, metadata, hashes) tuples
+    @param entryiter The manifest entries; consumed up to the entry of the file.
+    @param path Path of the file within the manifest (unicode, or a UTF-8 encoded
+                str), normalized as by selection.normalize().
+    @type sq StorageQueue
+    @param sq Storage queue via which to fetch blocks (concurrently).
+    @param out File-like object to which the range is written.
+    @param blocksize The block size the backup was persisted with.
+    @param offset Offset of the first byte of the range.
+    @param length Length of the range, or None for the remainder of the file. The
+                  range is truncated at the end of the file.
+    @return The number of bytes written.
+    '''
+    path = selection.normalize(path)
+    if isinstance(path, unicode):
+        path = path.encode('utf-8')
+    # entries read from a manifest have unicode paths, but those fresh
+    # from a traversal do not
+    paths = { str: path, unicode: path.decode('utf-8') }
+
+    for entry in entryiter:
+        if entry[0] == paths[type(entry[0])]:
+            break
+    else:
+        raise ExtractError('no such file in manifest: %s' % (path,))
+
+    path, metadata, hashes = entry
+    if not metadata.is_regular:
+        raise ExtractError('not a regular file: %s' % (path,))
+    if not blocks_fit(metadata.size, len(hashes), blocksize):
+        raise ExtractError('block size %d does not agree with the size of %s; '
+                           'wrong block size?' % (blocksize, path))
+
+    end = metadata.size if length is None else min(metadata.size, offset + length)
+    if offset >= end:
+        return 0
+
+    first = offset // blocksize
+    last = (end - 1) // blocksize
+    log.info('extracting bytes %d-%d of %s from blocks %d-%d', offset, end, path, first, last)
+
+    writer = _RangeWriter(out, first, offset - first * blocksize, end - offset)
+    for block_num in xrange(first, last + 1):
+        sq.enqueue(storagequeue.GetOperation(name=hashes[block_num][1],
+                                             callback=util.bind(writer.write_block, block_num),
+                                             errback=writer.fail))
+    sq.wait()
+
+    return end - offset
+
+class _SequencedWriter(object):
+    '''Writes pieces of data, numbered consecutively from 0, to a
+    stream in order, irrespective of the order in which they are
+    handed to it.'''
+    def __init__(self, out):
+        self.__out = out
+        self.__cond = threading.Condition()
+        self.__next = 0
+        self.__pending = dict() # seq -> data
+        self.__failed = False
+        self.written = 0
+
+    def put(self, seq, data, wait):
+        '''
+        @param seq: The sequence number of the data.
+        @param data: Byte string.
+        @param wait: Whether to block until all preceding data has been written
+                     (bounding the amount of data held in memory), rather than
+                     leaving the data to be written once it has.
+        '''
+        with self.__cond:
+            if wait:
+                while self.__next != seq and not self.__failed:
+                    self.__cond.wait()
+                if self.__failed:
+                    raise PrecedingBlockFailed('not writing piece %d of the stream' % (seq,))
+            self.__pending[seq] = data
+            while self.__next in self.__pending:
+                data = self.__pending.pop(self.__next)
+                self.__out.write(data)
+                self.written += len(data)
+                self.__next += 1
+            self.__cond.notifyAll()
+
+    def fail(self, reason):
+        '''Called when a piece will never be handed to the writer,
+        releasing (with an error) those waiting to put subsequent
+        pieces.'''
+        with self.__cond:
+            self.__failed = True
+            self.__cond.notifyAll()
+
+def materialize_to_tar(entryiter, sq, out, files=None):
+    '''
+    Materialize a manifest stream as a POSIX (pax) tar stream rather
+    than into a file system, avoiding staging the tree on disk.
+
+    Entries are emitted in manifest order, with permissions, ownership,
+    times and symlinks. Blocks are fetched concurrently through the
+    storage queue, prefetching the blocks of subsequent files while
+    earlier ones are being written, with the amount of block data held
+    in memory bounded by the concurrency of the queue.
+
+    @param entryiter: The (path, metadata, hashes) entries.
+    @type sq StorageQueue
+    @param sq: Storage queue via which to fetch blocks.
+    @param out: File-like object to write the tar stream to.
+    @param files: As for materialize().
+    '''
+    writer = _SequencedWriter(out)
+    seq = 0
+
+    for path, meta, hashes in select_entries(files, entryiter):
+        log.info('archiving [%s]', path)
+
+        info = tarfile.TarInfo(path)
+        info.mode = md.mode_to_bits(meta)
+        info.uid = meta.uid
+        info.gid = meta.gid
+        info.mtime = meta.mtime
+        if meta.is_directory:
+            info.type = tarfile.DIRTYPE
+        elif meta.is_symlink:
+            info.type = tarfile.SYMTYPE
+            info.linkname = meta.symlink_value
+        elif meta.is_regular:
+            info.type = tarfile.REGTYPE
+            info.size = meta.size
         else:
-            if files is not None and path not in files:
-                continue
-            # TODO: figure out why these needed to be commented out,
-            # and whether they should be removed or not.
-            #assert curdir is not None, 'no curdir - first entry not directory?'
-            #assert path.startswith(curdir), ('%s does not start with %s - out of order?'
-            #                                 '' % (path, curdir))
-            f = fs.open(local_path, 'w')
-            # TODO: fix perms before any writing happens
-            # TODO: and remember to optionally fsync to avoid security vuln in case
-            #       of crash and out-of-order writes.
-            m13n = FileMaterialization(fname=local_path,
-                                       totblocks=len(hashes),
-                                       fobj=f)
-            blocknames = [ algohash[1] for algohash in hashes ]
-
-            ops = [ storagequeue.GetOperation(name=blockname,
-                                              callback=util.bind(lambda m13n, block_num, bstr: m13n.write_block(bstr, block_num), m13n, block_num))
-                    for block_num, blockname in enumerate(blocknames) ]
-            for op in ops:
-                sq.enqueue(op)
+            log.warning('skipping special file %s', path)
+            continue
+
+        writer.put(seq, info.tobuf(format=tarfile.PAX_FORMAT), wait=False)
+        seq += 1
+
+        if info.type == tarfile.REGTYPE:
+            for algo, blockname in hashes:
+                sq.enqueue(storagequeue.GetOperation(name=blockname,
+                                                     callback=util.bind(writer.put, seq, wait=True),
+                                                     errback=writer.fail))
+                seq += 1
+
+            remainder = meta.size % tarfile.BLOCKSIZE
+            if remainder:
+                writer.put(seq, tarfile.NUL * (tarfile.BLOCKSIZE - remainder), wait=False)
+                seq += 1
+
     sq.wait()
+
+    # end of archive marker, padded to a full record
+    end = tarfile.NUL * (2 * tarfile.BLOCKSIZE)
+    remainder = (writer.written + len(end)) % tarfile.RECORDSIZE
+    if remainder:
+        end += tarfile.NUL * (tarfile.RECORDSIZE - remainder)
+    writer.put(seq, end, wait=False)
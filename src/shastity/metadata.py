@@ -6,6 +6,8 @@
 File meta data handling.
 '''
 
+import stat
+
 import shastity.spencode as spencode
 
 def mode_to_str(propdict):
@@ -142,7 +144,168 @@ def str_to_mode(s):
 
     return ret
 
-class FileMetaData(object):
+# (property, mode bit) pairs of the permission related properties, as
+# in stat(2)
+_permission_bits = [ ('is_setuid',     04000),
+                     ('is_setgid',     02000),
+                     ('is_sticky',     01000),
+                     ('user_read',     00400),
+                     ('user_write',    00200),
+                     ('user_execute',  00100),
+                     ('group_read',    00040),
+                     ('group_write',   00020),
+                     ('group_execute', 00010),
+                     ('other_read',    00004),
+                     ('other_write',   00002),
+                     ('other_execute', 00001) ]
+
+def mode_to_bits(propdict):
+    '''Produce the permission bits (as accepted by chmod(2)) of the
+    permission/sticky/setuid attributes.'''
+    bits = 0
+    for prop, bit in _permission_bits:
+        if propdict[prop]:
+            bits |= bit
+    return bits
+
+def bits_to_mode(bits):
+    '''Inverse of mode_to_bits().'''
+    return dict([ (prop, (bits & bit) == bit) for prop, bit in _permission_bits ])
+
+# Tables for the conversion of mode strings, used by to_string() and
+# from_string() instead of mode_to_str() and str_to_mode(). A mode
+# string is a file type character followed by the permission string.
+
+# (type property, type character, stat(2) file type), in the order of
+# precedence of mode_to_str()
+_file_types = [ ('is_regular',          '-', stat.S_IFREG),
+                ('is_block_device',     'b', stat.S_IFBLK),
+                ('is_character_device', 'c', stat.S_IFCHR),
+                ('is_directory',        'd', stat.S_IFDIR),
+                ('is_symlink',          'l', stat.S_IFLNK),
+                ('is_fifo',             'p', stat.S_IFIFO) ]
+
+# type character -> dict of the type properties
+_type_props = dict([ (char, dict([ (p, p == prop) for p, c, f in _file_types ]))
+                     for prop, char, fmt in _file_types ])
+
+# stat(2) file type -> type character
+_type_chars = dict([ (fmt, char) for prop, char, fmt in _file_types ])
+
+# permission bits -> permission string, for all 4096 combinations
+_perm_strings = [ mode_to_str(dict(_type_props['-'], **bits_to_mode(bits)))[1:]
+                  for bits in xrange(0, 4096) ]
+
+# permission string -> permission bits
+_perm_bits = dict([ (perms, bits) for bits, perms in enumerate(_perm_strings) ])
+
+# permission bits -> dict of the permission properties; filled on demand
+# since few distinct modes occur in practice
+_perm_props = dict()
+
+def _mode_props(modestr):
+    '''@return The type and permission properties of a mode string, as a
+    new dict (like str_to_mode(), but table driven).'''
+    try:
+        props = dict(_type_props[modestr[0]])
+        bits = _perm_bits[modestr[1:]]
+    except (KeyError, IndexError):
+        raise AssertionError('invalid mode string: %s' % (modestr,))
+    if bits not in _perm_props:
+        _perm_props[bits] = bits_to_mode(bits)
+    props.update(_perm_props[bits])
+    return props
+
+class _MetaData(object):
+    '''Interface common to FileMetaData and StatMetaData: the
+    properties named by propnames, accessible as attributes or by
+    name, and conversion to string.'''
+
+    __slots__ = ()
+
+    # for introspection and automation purposes.
+    propnames = [ 'is_directory',
+                  'is_character_device',
+                  'is_block_device',
+                  'is_regular',
+                  'is_fifo',
+                  'is_symlink',
+                  'is_setuid',
+                  'is_setgid',
+                  'is_sticky',
+                  'user_read',
+                  'user_write',
+                  'user_execute',
+                  'group_read',
+                  'group_write',
+                  'group_execute',
+                  'other_read',
+                  'other_write',
+                  'other_execute',
+                  'uid',
+                  'gid',
+                  'size',
+                  'atime',
+                  'mtime',
+                  'ctime',
+                  'symlink_value' ]
+
+    def __getitem__(self, key):
+        if key in self.propnames:
+            return getattr(self, key)
+        else:
+            raise KeyError(key)
+
+    def __str__(self):
+        return self.to_string()
+        
+    def _mode_string(self):
+        '''@return The mode string (as per mode_to_str()).'''
+        for prop, char, fmt in _file_types:
+            if getattr(self, prop):
+                break
+        else:
+            raise AssertionError('should not be reachable')
+
+        bits = 0
+        for prop, bit in _permission_bits:
+            if getattr(self, prop):
+                bits |= bit
+
+        return char + _perm_strings[bits]
+
+    def to_string(self):
+        '''Produce a string encoding of this meta data.
+
+        The format of the string is:
+
+          MODESTR uid gid size atime mtime ctime
+
+        Where MODESTR is the result of mode_to_str() (ls -l
+        style). Times are seconds since epoch.'''
+
+        assert self.uid is not None
+        assert self.gid is not None
+        assert self.size is not None
+        assert self.atime is not None
+        assert self.mtime is not None
+        assert self.ctime is not None
+
+        s = '%s %d %d %d %d %d %d' % (self._mode_string(),
+                                      self.uid,
+                                      self.gid,
+                                      self.size,
+                                      self.atime,
+                                      self.mtime,
+                                      self.ctime)
+
+        if self.is_symlink:
+            assert self.symlink_value is not None # may be empty though - that's valid for a symlink
+            s += ' ' + spencode.spencode(self.symlink_value)
+
+        return s
+
+class FileMetaData(_MetaData):
     '''Represents meta-data about files, including any and all
     meta-data that are to be preserved on backup/restore.
     
@@ -190,33 +353,6 @@ class FileMetaData(object):
     @ivar symlink_value       Value of symlink - if it is a symlink.
     '''
 
-    # for introspection and automation purposes.
-    propnames = [ 'is_directory',
-                  'is_character_device',
-                  'is_block_device',
-                  'is_regular',
-                  'is_fifo',
-                  'is_symlink',
-                  'is_setuid',
-                  'is_setgid',
-                  'is_sticky',
-                  'user_read',
-                  'user_write',
-                  'user_execute',
-                  'group_read',
-                  'group_write',
-                  'group_execute',
-                  'other_read',
-                  'other_write',
-                  'other_execute',
-                  'uid',
-                  'gid',
-                  'size',
-                  'atime',
-                  'mtime',
-                  'ctime',
-                  'symlink_value' ]
-
     def __init__(self, props=None, other=None):
         '''
         @param props: Dict of properties that match those of the instance to be created.
@@ -224,6 +360,7 @@ class FileMetaData(object):
                       do not appear in props.
         '''
         self.__write_protected = False
+        self.__mode_string = None # known only if parsed
 
         if other: # initialize from other instance
             for prop in self.propnames:
@@ -246,25 +383,19 @@ class FileMetaData(object):
         else:
             self.__dict__[key] = value
 
-    def __getitem__(self, key):
-        if key in self.propnames:
-            return getattr(self, key)
-        else:
-            raise KeyError(key)
-
-    def __str__(self):
-        return self.to_string()
-        
     @classmethod
     def from_string(cls, s):
         '''Given a string in the format produced by to_string(), parse
         it and return the resulting instance.'''
-        comps = s.split()
-        
+        return cls.from_fields(s.split())
+
+    @classmethod
+    def from_fields(cls, comps):
+        '''from_string(), given the string already split at whitespace.'''
         assert len(comps) > 1
 
-        d = str_to_mode(comps[0]) # grab most flags
-        
+        d = _mode_props(comps[0]) # grab most flags
+
         expt_len = 8 if d['is_symlink'] else 7
         assert len(comps) == expt_len, ('incorrectly formatted meta data string - should be 7 or 8 '
                                         'space separated tokens, depending on whether it is a symlink')
@@ -275,59 +406,101 @@ class FileMetaData(object):
         d['atime'] = int(comps[4])
         d['mtime'] = int(comps[5])
         d['ctime'] = int(comps[6])
+        d['symlink_value'] = spencode.spdecode(comps[7]) if d['is_symlink'] else None
 
-        if d['is_symlink']:
-            d['symlink_value'] = spencode.spdecode(comps[7])
+        return cls._from_props(d, comps[0])
 
-        return FileMetaData(d)
-
-    def to_string(self):
-        '''Produce a string encoding of this meta data.
-
-        The format of the string is:
-
-          MODESTR uid gid size atime mtime ctime
+    @classmethod
+    def _from_props(cls, props, mode_string):
+        '''Construct an instance given every property, bypassing the
+        checks of __init__ (and the per-property write protection).
+
+        @param props: Dict of all properties.
+        @param mode_string: The mode string the properties were parsed from.'''
+        md = object.__new__(cls)
+        md.__dict__.update(props)
+        md.__mode_string = mode_string
+        md.__write_protected = True
+        return md
+
+    def _mode_string(self):
+        if self.__mode_string is not None:
+            return self.__mode_string
+        return _MetaData._mode_string(self)
+
+def _type_property(fmt):
+    return property(lambda self: stat.S_IFMT(self.st_mode) == fmt)
+
+def _bit_property(bit):
+    return property(lambda self: (self.st_mode & bit) == bit)
+
+class StatMetaData(_MetaData):
+    '''A compact, immutable alternative to FileMetaData for meta data
+    obtained from stat(2), as produced for every file during
+    traversal. Only st_mode and the numeric fields are stored (in
+    slots); the type and permission properties are derived from
+    st_mode on access.
+
+    @ivar st_mode The st_mode of the file, as returned by stat(2).
+    '''
 
-        Where MODESTR is the result of mode_to_str() (ls -l
-        style). Times are seconds since epoch.'''
+    __slots__ = ('st_mode', 'uid', 'gid', 'size', 'atime', 'mtime', 'ctime', 'symlink_value')
 
-        assert self.uid is not None
-        assert self.gid is not None
-        assert self.size is not None
-        assert self.atime is not None
-        assert self.mtime is not None
-        assert self.ctime is not None
+    def __init__(self, st_mode, uid, gid, size, atime, mtime, ctime, symlink_value=None):
+        init = object.__setattr__
+        init(self, 'st_mode', st_mode)
+        init(self, 'uid', uid)
+        init(self, 'gid', gid)
+        init(self, 'size', size)
+        init(self, 'atime', atime)
+        init(self, 'mtime', mtime)
+        init(self, 'ctime', ctime)
+        init(self, 'symlink_value', symlink_value)
 
-        if self.is_symlink:
-            assert self.symlink_value is not None # may be empty though - that's valid for a symlink
-            possible_symlink = ' %s' % (spencode.spencode(self.symlink_value),)
-        else:
-            possible_symlink = ''
-
-        return ('%(modestring)s %(uid)d %(gid)d %(size)d %(atime)d %(mtime)d %(ctime)d%(possible_symlink)s'
-                '' % dict(modestring=mode_to_str(dict(is_directory=self.is_directory,
-                                                      is_character_device=self.is_character_device,
-                                                      is_block_device=self.is_block_device,
-                                                      is_regular=self.is_regular,
-                                                      is_fifo=self.is_fifo,
-                                                      is_symlink=self.is_symlink,
-                                                      is_setuid=self.is_setuid,
-                                                      is_setgid=self.is_setgid,
-                                                      is_sticky=self.is_sticky,
-                                                      user_read=self.user_read,
-                                                      user_write=self.user_write,
-                                                      user_execute=self.user_execute,
-                                                      group_read=self.group_read,
-                                                      group_write=self.group_write,
-                                                      group_execute=self.group_execute,
-                                                      other_read=self.other_read,
-                                                      other_write=self.other_write,
-                                                      other_execute=self.other_execute)),
-                          uid=self.uid,
-                          gid=self.gid,
-                          size=self.size,
-                          atime=self.atime,
-                          mtime=self.mtime,
-                          ctime=self.ctime,
-                          possible_symlink=possible_symlink))
+    @classmethod
+    def from_stat(cls, statinfo, symlink_value=None):
+        '''
+        @param statinfo: An os.stat_result.
+        @param symlink_value: The value of the symlink, if it is one.
+        '''
+        return cls(statinfo.st_mode,
+                   statinfo[stat.ST_UID],
+                   statinfo[stat.ST_GID],
+                   statinfo[stat.ST_SIZE],
+                   statinfo[stat.ST_ATIME],
+                   statinfo[stat.ST_MTIME],
+                   statinfo[stat.ST_CTIME],
+                   symlink_value)
 
+    def __setattr__(self, key, value):
+        raise AssertionError('setting a property on StatMetaData is not allowed - we are read-only!')
+
+    def _mode_string(self):
+        fmt = stat.S_IFMT(self.st_mode)
+        if fmt not in _type_chars:
+            raise AssertionError('should not be reachable')
+        return _type_chars[fmt] + _perm_strings[self.st_mode & 07777]
+
+    def __reduce__(self):
+        return (StatMetaData, (self.st_mode, self.uid, self.gid, self.size,
+                               self.atime, self.mtime, self.ctime, self.symlink_value))
+
+    is_directory        = _type_property(stat.S_IFDIR)
+    is_character_device = _type_property(stat.S_IFCHR)
+    is_block_device     = _type_property(stat.S_IFBLK)
+    is_regular          = _type_property(stat.S_IFREG)
+    is_fifo             = _type_property(stat.S_IFIFO)
+    is_symlink          = _type_property(stat.S_IFLNK)
+
+    is_setuid           = _bit_property(stat.S_ISUID)
+    is_setgid           = _bit_property(stat.S_ISGID)
+    is_sticky           = _bit_property(stat.S_ISVTX)
+    user_read           = _bit_property(stat.S_IRUSR)
+    user_write          = _bit_property(stat.S_IWUSR)
+    user_execute        = _bit_property(stat.S_IXUSR)
+    group_read          = _bit_property(stat.S_IRGRP)
+    group_write         = _bit_property(stat.S_IWGRP)
+    group_execute       = _bit_property(stat.S_IXGRP)
+    other_read          = _bit_property(stat.S_IROTH)
+    other_write         = _bit_property(stat.S_IWOTH)
+    other_execute       = _bit_property(stat.S_IXOTH)
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2009 Peter Schuller <peter.schuller@infidyne.com>
+
+'''
+Deferred application of file meta data (ownership, permissions and
+times) after a restore.
+
+Meta data cannot be applied as entries are materialized: writing the
+contents of a file updates its mtime, creating entries in a directory
+updates the mtime of the directory, and restrictive permissions on a
+directory may prevent its contents from being created at all. Applying
+it inline would also serialize the restore on system calls.
+
+Instead, entries are recorded in a MetadataSpool while materializing,
+and once all contents are in place apply() makes a final pass over
+them using a pool of threads: first all non-directories (in any
+order), then directories, deepest first, such that the mtime (and
+permissions) of a directory are only set once nothing more will
+happen to its contents.
+
+Entries are spooled to disk, one file per directory depth plus one for
+all non-directories, in the textual form used by manifests; only one
+entry per thread is held in memory at a time, irrespective of the
+number of entries.
+'''
+
+from __future__ import absolute_import
+from __future__ import with_statement
+
+import os
+import os.path
+import Queue
+import shutil
+import sys
+import tempfile
+import threading
+
+import shastity.logging as logging
+import shastity.metadata as metadata
+import shastity.spencode as spencode
+
+log = logging.get_logger(__name__)
+
+DEFAULT_THREADS = 8
+
+def apply_entry(fs, path, md, chown):
+    '''Apply the meta data of a single entry.
+
+    @param chown: Whether to apply ownership. Typically only possible when
+                  running as root.'''
+    if chown:
+        fs.lchown(path, md.uid, md.gid)
+
+    # neither permissions nor times of symlinks themselves can be
+    # portably set
+    if md.is_symlink:
+        return
+
+    # after chown, which may clear setuid/setgid bits
+    fs.chmod(path, metadata.mode_to_bits(md))
+    fs.utime(path, md.atime, md.mtime)
+
+def run_parallel(func, items, threads):
+    '''Call func(item) for each item using the given number of
+    threads, without consuming items faster than they are
+    processed. The first exception raised by func is re-raised once
+    all threads are done.'''
+    queue = Queue.Queue(threads * 64)
+    errors = []
+
+    def worker():
+        while True:
+            item = queue.get()
+            if item is None:
+                return
+            if errors:
+                continue # drain
+            try:
+                func(item)
+            except:
+                errors.append(sys.exc_info())
+
+    workers = [ threading.Thread(target=worker) for n in xrange(0, threads) ]
+    for w in workers:
+        w.setDaemon(True)
+        w.start()
+
+    try:
+        for item in items:
+            if errors:
+                break
+            queue.put(item)
+    finally:
+        for w in workers:
+            queue.put(None)
+        for w in workers:
+            w.join()
+
+    if errors:
+        exc_type, exc_value, exc_tb = errors[0]
+        raise exc_type, exc_value, exc_tb
+
+class MetadataSpool(object):
+    '''Records (path, meta data) entries for later application by
+    apply().'''
+
+    def __init__(self, spooldir=None):
+        '''
+        @param spooldir: Directory in which to spool entries. If None, a temporary
+                         directory is created (and removed by close()).
+        '''
+        self.__own_spooldir = spooldir is None
+        self.__spooldir = tempfile.mkdtemp(suffix='-shastity-metadata') if self.__own_spooldir else spooldir
+
+        self.__files = None  # spool of non-directories
+        self.__dirs = dict() # depth -> spool of directories
+        self.count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        self.close()
+
+    def __bucket(self, md, depth):
+        if not md.is_directory:
+            if self.__files is None:
+                self.__files = open(os.path.join(self.__spooldir, 'files'), 'w+')
+            return self.__files
+        if depth not in self.__dirs:
+            self.__dirs[depth] = open(os.path.join(self.__spooldir, 'dirs.%d' % (depth,)), 'w+')
+        return self.__dirs[depth]
+
+    def add(self, path, md, depth):
+        '''
+        @param path: Path of the materialized entry.
+        @param md: Its FileMetaData.
+        @param depth: Its depth in the tree being materialized (number of
+                      ancestor directories).
+        '''
+        self.__bucket(md, depth).write('%s %s\n' % (spencode.spencode(path), md.to_string()))
+        self.count += 1
+
+    def __entries(self, f):
+        f.flush()
+        f.seek(0)
+        for line in f:
+            path, mdstr = line.rstrip('\n').split(' ', 1)
+            yield (spencode.spdecode(path), metadata.FileMetaData.from_string(mdstr))
+
+    def apply(self, fs, threads=DEFAULT_THREADS, chown=False):
+        '''Apply all spooled meta data.
+
+        @param fs: The file system in which the entries were materialized.
+        @param threads: Number of threads making system calls.
+        @param chown: Whether to apply ownership.'''
+        log.info('applying meta data of %d entries', self.count)
+
+        func = lambda (path, md): apply_entry(fs, path, md, chown)
+
+        if self.__files is not None:
+            run_parallel(func, self.__entries(self.__files), threads)
+
+        for depth in sorted(self.__dirs.keys(), reverse=True):
+            run_parallel(func, self.__entries(self.__dirs[depth]), threads)
+
+    def close(self):
+        '''Discard spooled entries, removing the spool directory if we
+        created it.'''
+        for f in [ self.__files ] + self.__dirs.values():
+            if f is not None:
+                f.close()
+                os.unlink(f.name)
+        self.__files = None
+        self.__dirs = dict()
+
+        if self.__own_spooldir and self.__spooldir is not None:
+            shutil.rmtree(self.__spooldir, ignore_errors=True)
+            self.__spooldir = None
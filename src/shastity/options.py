@@ -60,10 +60,82 @@ def S3Options():
                     ])
 
 
+def ManifestCacheOptions():
+    return _config([
+            config.StringOption('manifest-cache', None, '~/.shastity-cache/manifests',
+                                short_help='Directory in which to cache parsed manifests'),
+            config.IntOption('manifest-cache-mb', None, 256,
+                             short_help='Maximum size (MB) of the manifest cache; 0 disables it'),
+                    ])
+
 def PersistOptions():
     return _config([
             config.StringOption('skip-blocks', None, None,
                                 short_help='File containing blocks to skip'),
             config.BoolOption('continue', None, False,
                               short_help='Check list of blocks uploaded'),
+            config.IntOption('manifest-version', None, 1,
+                             short_help='Manifest format to write: 1 (text) or 2 (binary)'),
+            config.IntOption('manifest-segment-mb', None, 8,
+                             short_help='Split manifests into segments of at most this many MB; 0 disables'),
+            config.BoolOption('path-index', None, True,
+                              short_help='Write a path index for fast lookup of individual files'),
+            config.StringOption('parent', None, None,
+                                short_help='Write the manifest as a delta against this manifest'),
+            config.IntOption('max-delta-depth', None, 7,
+                             short_help='Maximum length of a chain of delta manifests; 0 disables deltas'),
+                    ])
+
+def ListManifestOptions():
+    return _config([
+            config.BoolOption('shared', None, False,
+                              short_help='Also count blocks shared with other manifests (reads the reference counts)'),
+                    ])
+
+def GarbageCollectOptions():
+    return _config([
+            config.BoolOption('dry-run', None, False,
+                              short_help='List the unreferenced blocks instead of deleting them'),
+                    ])
+
+def MaterializeOptions():
+    return _config([
+            config.IntOption('hedge-percentile', None, None,
+                             short_help='Hedge GETs slower than this latency percentile'),
+            config.IntOption('hedge-budget', None, 5,
+                             short_help='Maximum hedged GETs, in percent of all GETs'),
+            config.StringOption('to-tar', None, None,
+                                short_help='Write a tar stream to the given file (- for standard output) instead of restoring'),
+            config.IntOption('processes', None, 1,
+                             short_help='Number of processes to restore with'),
+            config.BoolOption('out-of-order', None, False,
+                              short_help='Write blocks at their offsets as they arrive'),
+            config.IntOption('block-cache-memory', None, 64,
+                             short_help='Memory (MB) for caching shared blocks; 0 disables the cache'),
+            config.IntOption('block-cache-disk', None, 1024,
+                             short_help='Disk space (MB) for caching shared blocks'),
+            config.BoolOption('delta', None, False,
+                              short_help='Update an existing tree, fetching only blocks that differ'),
+            config.BoolOption('resume', None, False,
+                              short_help='Resume an interrupted restore, skipping completed files'),
+            config.BoolOption('resume-verify', None, False,
+                              short_help='When resuming, hash-check even files recorded as complete'),
+            config.BoolOption('sparse', None, False,
+                              short_help='Leave holes instead of writing blocks of zeros'),
+            config.BoolOption('restore-metadata', None, True,
+                              short_help='Apply permissions, times and (as root) ownership after restoring'),
+            config.StringOption('fsync', None, 'file',
+                                short_help='When to fsync restored files: file, batch, syncfs or none'),
+            config.IntOption('fsync-batch-files', None, 1000,
+                             short_help='Files per fsync batch (with --fsync=batch)'),
+            config.IntOption('fsync-batch-mb', None, 256,
+                             short_help='Megabytes per fsync batch (with --fsync=batch)'),
+                    ])
+
+def StorageQueueOptions():
+    return _config([
+            config.StringOption('rate-limit', None, None,
+                                short_help='Rate limits, e.g. "up=512k down=2M ops=50"'),
+            config.StringOption('rate-schedule', None, None,
+                                short_help='Rate limits by time of day, e.g. "08:00-18:00 up=512k; 18:00-08:00 up=10M"'),
                     ])
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2009 Peter Schuller <peter.schuller@infidyne.com>
+
+'''
+Path indexes: locating individual entries of a manifest without
+reading all of it.
+
+A path index maps (a hash of) each path in a manifest to its location:
+the number of the segment containing it (0 for a manifest that is not
+segmented) and its ordinal within that segment. It consists of a table
+of fixed size records, sorted by key, for binary search:
+
+  key (8 bytes) | segment (4 bytes) | ordinal (4 bytes)
+
+The key is a prefix of the SHA-1 of the UTF-8 encoded path. Distinct
+paths may (rarely) share a key, so a lookup yields candidate locations
+whose entries must be checked against the path.
+
+Separately, a BloomFilter over the same hashes allows a manifest to be
+ruled out as containing a given path by fetching only the (much
+smaller) filter; this is what makes queries over all manifests cheap.
+
+Both are stored with a short textual header, in the style of
+manifests, followed by a binary body.
+
+Manifests may have tens of millions of entries, so IndexBuilder keeps
+them packed, sorting them in runs of bounded size spilled to temporary
+files, which are merged when the index is produced.
+'''
+
+from __future__ import absolute_import
+from __future__ import with_statement
+
+import bisect
+import hashlib
+import heapq
+import math
+import struct
+import tempfile
+
+INDEX_MAGIC = 'shastity-index'
+BLOOM_MAGIC = 'shastity-bloom'
+
+BITS_PER_ENTRY = 10
+
+_RECORD = struct.Struct('>8sII')
+_BUILD_RECORD = struct.Struct('>16sII') # digest prefix, segment, ordinal
+
+RUN_RECORDS = 256 * 1024 # records sorted in memory at a time
+_BLOOM_HEADER = struct.Struct('<II')
+
+class PathIndexError(Exception):
+    pass
+
+def path_hash(path):
+    '''
+    @param path: A manifest path (unicode, or UTF-8 encoded).
+    @return The 20 byte digest from which keys and filter positions derive.'''
+    if isinstance(path, unicode):
+        path = path.encode('utf-8')
+    return hashlib.sha1(path).digest()
+
+def _header(magic):
+    return '%s\nversion 1\nend\n' % (magic,)
+
+def _body(magic, data):
+    '''@return Offset of the body of an index or filter object.'''
+    header = _header(magic)
+    if not data.startswith(header):
+        raise PathIndexError('not a %s object (or unsupported version)' % (magic,))
+    return len(header)
+
+class IndexBuilder(object):
+    '''Collects the locations of the paths of a manifest as it is
+    written, keeping only their hashes.'''
+
+    def __init__(self, run_records=RUN_RECORDS):
+        '''
+        @param run_records: Number of records to sort in memory at a time.
+        '''
+        self.__run_records = run_records
+        self.__run = bytearray() # packed records not yet spilled
+        self.__runs = []         # temporary files of sorted records
+        self.__count = 0
+
+    def __len__(self):
+        return self.__count
+
+    def add(self, path, segment, ordinal):
+        self.__run += _BUILD_RECORD.pack(path_hash(path)[0:16], segment, ordinal)
+        self.__count += 1
+        if len(self.__run) >= self.__run_records * _BUILD_RECORD.size:
+            self.__spill()
+
+    def __spill(self):
+        '''Sort the current run and write it to a temporary file.'''
+        if not self.__run:
+            return
+        data = str(self.__run)
+        self.__run = bytearray()
+        size = _BUILD_RECORD.size
+        records = [ data[offset:offset + size] for offset in xrange(0, len(data), size) ]
+        records.sort()
+        f = tempfile.TemporaryFile(prefix='shastity-index-')
+        f.write(''.join(records))
+        self.__runs.append(f)
+
+    def __records(self, f):
+        '''@return Iterator over the records of a run.'''
+        size = _BUILD_RECORD.size
+        f.seek(0)
+        while True:
+            data = f.read(size * 4096)
+            if not data:
+                return
+            for offset in xrange(0, len(data), size):
+                yield data[offset:offset + size]
+
+    def index(self):
+        '''@return The index object.'''
+        self.__spill()
+        out = tempfile.TemporaryFile(prefix='shastity-index-')
+        try:
+            out.write(_header(INDEX_MAGIC))
+            for rec in heapq.merge(*[ self.__records(f) for f in self.__runs ]):
+                out.write(rec[0:8] + rec[16:24])
+            out.seek(0)
+            return out.read()
+        finally:
+            out.close()
+
+    def bloom(self):
+        '''@return The BloomFilter of the paths.'''
+        self.__spill()
+        bf = BloomFilter.for_entries(self.__count)
+        for f in self.__runs:
+            for rec in self.__records(f):
+                bf.add_digest(rec[0:16])
+        return bf
+
+    def close(self):
+        '''Remove the temporary files.'''
+        for f in self.__runs:
+            f.close()
+        self.__runs = []
+
+class _Keys(object):
+    '''Sequence view of the keys of the records of an index, for bisect.'''
+    def __init__(self, data, start):
+        self.__data = data
+        self.__start = start
+
+    def __len__(self):
+        return (len(self.__data) - self.__start) // _RECORD.size
+
+    def __getitem__(self, n):
+        offset = self.__start + n * _RECORD.size
+        return self.__data[offset:offset + 8]
+
+class PathIndex(object):
+    def __init__(self, data):
+        '''
+        @param data: An index object, as produced by IndexBuilder.index().
+        '''
+        self.__data = data
+        self.__start = _body(INDEX_MAGIC, data)
+        if (len(data) - self.__start) % _RECORD.size != 0:
+            raise PathIndexError('truncated path index')
+        self.__keys = _Keys(data, self.__start)
+
+    def __len__(self):
+        return len(self.__keys)
+
+    def lookup(self, path):
+        '''
+        @return A list of candidate (segment, ordinal) locations of the
+                given path; empty if the path is definitely absent.'''
+        key = path_hash(path)[0:8]
+        n = bisect.bisect_left(self.__keys, key)
+
+        locations = []
+        while n < len(self.__keys) and self.__keys[n] == key:
+            k, segment, ordinal = _RECORD.unpack_from(self.__data, self.__start + n * _RECORD.size)
+            locations.append((segment, ordinal))
+            n += 1
+        return locations
+
+class BloomFilter(object):
+    '''A Bloom filter over path hashes, using double hashing to derive
+    the bit positions.'''
+
+    def __init__(self, nbits, nhashes, bits=None):
+        '''
+        @param nbits: Number of bits in the filter.
+        @param nhashes: Number of bit positions per path.
+        @param bits: The bits of an existing filter, as a string.
+        '''
+        assert nbits > 0
+        self.nbits = nbits
+        self.nhashes = nhashes
+        self.__bits = bytearray(bits if bits is not None else (nbits + 7) // 8)
+
+    @classmethod
+    def for_entries(cls, count, bits_per_entry=BITS_PER_ENTRY):
+        '''@return An empty filter sized for the given number of paths.'''
+        nbits = max(64, count * bits_per_entry)
+        nhashes = max(1, int(round(bits_per_entry * math.log(2))))
+        return cls(nbits, nhashes)
+
+    @classmethod
+    def from_string(cls, data):
+        start = _body(BLOOM_MAGIC, data)
+        nbits, nhashes = _BLOOM_HEADER.unpack_from(data, start)
+        bits = data[start + _BLOOM_HEADER.size:]
+        if len(bits) != (nbits + 7) // 8:
+            raise PathIndexError('truncated bloom filter')
+        return cls(nbits, nhashes, bits)
+
+    def to_string(self):
+        return (_header(BLOOM_MAGIC) +
+                _BLOOM_HEADER.pack(self.nbits, self.nhashes) +
+                str(self.__bits))
+
+    def __positions(self, digest):
+        h1, h2 = struct.unpack('<II', digest[8:16])
+        return [ (h1 + n * h2) % self.nbits for n in xrange(0, self.nhashes) ]
+
+    def add(self, path):
+        self.add_digest(path_hash(path))
+
+    def add_digest(self, digest):
+        '''Add a path by its path_hash() (or a prefix of at least 16 bytes).'''
+        for pos in self.__positions(digest):
+            self.__bits[pos >> 3] |= 1 << (pos & 7)
+
+    def might_contain(self, path):
+        '''@return False if the path was definitely not added.'''
+        for pos in self.__positions(path_hash(path)):
+            if not self.__bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
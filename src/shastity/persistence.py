@@ -83,7 +83,7 @@ def _persist_file(fs,
                     #print "Putting block"
                     sq.enqueue(storagequeue.PutOperation(name=hash,
                                                          data=block))
-                    skip_blocks.append( (algo,hash) )
+                    skip_blocks.add( (algo,hash) )
                     blocks_upped += 1
                 else:
                     #print "Skipping block"
@@ -115,7 +115,7 @@ def persist(fs,
     '''
     assert incremental is None, 'incremental optimization not yet implemented'
     
-    skipblocks = skip_blocks[:]
+    skipblocks = set(skip_blocks)
     for path, meta in traversal:
         # Future: Do traversal/incremental optimization logic here.
         log.info('persisting [%s]', path)
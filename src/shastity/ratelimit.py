@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2009 Peter Schuller <peter.schuller@infidyne.com>
+
+'''
+Rate limiting (bandwidth shaping) support for the storage queue.
+
+Limits are expressed as a RateLimits instance, giving the maximum
+number of bytes per second uploaded, bytes per second downloaded and
+operations per second. Each limit is enforced by a TokenBucket.
+
+A RateSchedule maps times of day to RateLimits, allowing for instance
+a tighter upload limit during business hours.
+
+The string formats understood by parse_limits() and parse_schedule()
+are those used for the corresponding command line options::
+
+  up=512k down=2M ops=50
+  08:00-18:00 up=512k ops=50; 18:00-08:00 up=10M
+
+Byte counts accept the (binary) suffixes k, M and G. A limit which is
+not mentioned is unlimited.
+'''
+
+from __future__ import absolute_import
+from __future__ import with_statement
+
+import re
+import threading
+import time
+
+class RateLimitParseError(Exception):
+    pass
+
+class TokenBucket(object):
+    '''A thread-safe token bucket.
+
+    Tokens accumulate at the configured rate, up to the burst size. A
+    rate of None means unlimited, in which case no waiting ever
+    happens.
+
+    The bucket may go into debt: charge() always succeeds, and
+    subsequent calls to wait() will block until the debt has been
+    paid off. This is what allows callers to charge for transfers
+    whose size is not known until after the fact (such as the size of
+    a GET), and to let small operations through without delay.'''
+
+    def __init__(self, rate=None, burst=None):
+        '''
+        @param rate: Tokens per second, or None for unlimited.
+        @param burst: Maximum number of accumulated tokens. Defaults to one second
+                      worth of tokens.
+        '''
+        self.__cond = threading.Condition()
+        self.__rate = None
+        self.__burst = None
+        self.__tokens = 0.0
+        self.__stamp = time.time()
+
+        self.set_rate(rate, burst)
+
+    def __refill(self):
+        '''@pre self.__cond locked'''
+        now = time.time()
+        if self.__rate is not None:
+            self.__tokens = min(self.__burst,
+                                self.__tokens + (now - self.__stamp) * self.__rate)
+        self.__stamp = now
+
+    def set_rate(self, rate, burst=None):
+        '''Change the rate of the bucket. Any waiters are woken up to
+        re-evaluate their wait under the new rate.'''
+        with self.__cond:
+            self.__refill()
+
+            self.__rate = rate
+            if rate is None:
+                self.__burst = None
+                self.__tokens = 0.0
+            else:
+                self.__burst = float(burst if burst is not None else rate)
+                self.__tokens = min(self.__tokens, self.__burst)
+
+            self.__cond.notifyAll()
+
+    def get_rate(self):
+        with self.__cond:
+            return self.__rate
+
+    def charge(self, amount):
+        '''Consume the given number of tokens without waiting,
+        possibly putting the bucket into debt.'''
+        with self.__cond:
+            if self.__rate is not None:
+                self.__refill()
+                self.__tokens -= amount
+
+    def wait(self, amount=0, timeout=None):
+        '''Block until at least the given number of tokens is
+        available (without consuming them). Amounts larger than the
+        burst size are treated as the burst size, since they would
+        otherwise never be satisfied.
+
+        @param timeout: Maximum number of seconds to wait, or None to wait
+                        for as long as it takes.
+        @return True if the tokens are available, False if the timeout
+                expired first.'''
+        deadline = None if timeout is None else time.time() + timeout
+        with self.__cond:
+            while self.__rate is not None:
+                self.__refill()
+
+                needed = min(amount, self.__burst)
+                if self.__tokens >= needed:
+                    return True
+
+                delay = (needed - self.__tokens) / self.__rate
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    delay = min(delay, remaining)
+                self.__cond.wait(delay)
+
+            return True
+
+    def consume(self, amount):
+        '''Wait for and then consume the given number of tokens.'''
+        self.wait(amount)
+        self.charge(amount)
+
+class RateLimits(object):
+    '''A set of limits. Any limit may be None, meaning unlimited.
+
+    @ivar upload   Maximum bytes per second uploaded.
+    @ivar download Maximum bytes per second downloaded.
+    @ivar ops      Maximum operations per second.'''
+
+    def __init__(self, upload=None, download=None, ops=None):
+        self.upload = upload
+        self.download = download
+        self.ops = ops
+
+    def __eq__(self, other):
+        return (isinstance(other, RateLimits)
+                and (self.upload, self.download, self.ops) == (other.upload, other.download, other.ops))
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return '<RateLimits(up=%s down=%s ops=%s)>' % (self.upload, self.download, self.ops)
+
+UNLIMITED = RateLimits()
+
+class RateSchedule(object):
+    '''Maps times of day to RateLimits.
+
+    The schedule consists of a list of (start, end, limits) windows,
+    where start and end are minutes since midnight (local time). A
+    window whose end precedes its start wraps around midnight. The
+    first matching window wins; outside of all windows, the default
+    limits apply.'''
+
+    def __init__(self, windows, default=UNLIMITED):
+        '''
+        @param windows: List of (start_minute, end_minute, RateLimits) tuples.
+        @param default: RateLimits applying outside of all windows.
+        '''
+        self.windows = windows
+        self.default = default
+
+    def limits_at(self, when=None):
+        '''
+        @param when: Seconds since epoch, or None for now.
+        @return The RateLimits in effect at the given time.'''
+        tm = time.localtime(when)
+        minute = tm.tm_hour * 60 + tm.tm_min
+
+        for start, end, limits in self.windows:
+            if start <= end:
+                if start <= minute < end:
+                    return limits
+            elif minute >= start or minute < end:
+                return limits
+
+        return self.default
+
+_suffixes = { '': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3 }
+
+def _parse_amount(s):
+    m = re.match(r'^(\d+)([kKmMgG]?)$', s)
+    if not m:
+        raise RateLimitParseError('invalid amount: %s' % (s,))
+    return int(m.group(1)) * _suffixes[m.group(2).lower()]
+
+def parse_limits(s):
+    '''Parse a string such as 'up=512k down=2M ops=50' into a
+    RateLimits instance.'''
+    kwargs = dict()
+    for token in s.replace(',', ' ').split():
+        if '=' not in token:
+            raise RateLimitParseError('expected key=value, got: %s' % (token,))
+        k, v = token.split('=', 1)
+        if k == 'up':
+            kwargs['upload'] = _parse_amount(v)
+        elif k == 'down':
+            kwargs['download'] = _parse_amount(v)
+        elif k == 'ops':
+            kwargs['ops'] = _parse_amount(v)
+        else:
+            raise RateLimitParseError('unknown limit: %s' % (k,))
+
+    return RateLimits(**kwargs)
+
+def _parse_time(s, end=False):
+    '''@param end: Whether the time ends a window, and may thus be 24:00
+                 (the end of the day).'''
+    m = re.match(r'^(\d\d?):(\d\d)$', s)
+    if not m or int(m.group(2)) > 59:
+        raise RateLimitParseError('invalid time of day: %s' % (s,))
+    minute = int(m.group(1)) * 60 + int(m.group(2))
+    if minute > 24 * 60 or (minute == 24 * 60 and not end):
+        raise RateLimitParseError('invalid time of day: %s' % (s,))
+    return minute
+
+def parse_schedule(s, default=UNLIMITED):
+    '''Parse a string such as '08:00-18:00 up=512k; 18:00-08:00
+    up=10M' into a RateSchedule instance. A window may end at 24:00,
+    meaning the end of the day.
+
+    @param default: RateLimits applying outside of the scheduled windows.'''
+    windows = []
+    for part in [ p.strip() for p in s.split(';') if p.strip() ]:
+        span, _, limits = part.partition(' ')
+        if '-' not in span:
+            raise RateLimitParseError('expected HH:MM-HH:MM, got: %s' % (span,))
+        start, end = span.split('-', 1)
+        windows.append((_parse_time(start), _parse_time(end, end=True), parse_limits(limits)))
+
+    return RateSchedule(windows, default)
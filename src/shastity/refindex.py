@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2009 Peter Schuller <peter.schuller@infidyne.com>
+
+'''
+Block reference counts, stored alongside the manifests.
+
+Finding out which blocks are in use (to skip uploading them again, to
+list orphans or to garbage collect) would otherwise require reading
+every manifest. Instead, the manifest backend holds:
+
+  - For each manifest, a block set object (<name>.blocks) listing the
+    distinct blocks it references.
+  - A reference count index: for each block, the number of manifests
+    referencing it. It is sharded by block name over SHARDS objects
+    (refcount.<nn>), such that each object stays of reasonable size.
+  - The list of manifests accounted for by the index
+    (refcount.manifests).
+
+The index is updated when a manifest is added or deleted, reading and
+writing only the block set of that manifest and the shards. Updates
+are not atomic: the shards are written before the list of manifests,
+and a manifest is added after it becomes visible but removed after it
+is deleted. An interrupted update can thus only leave counts too high,
+never too low, such that no block in use is ever considered
+unreferenced. Concurrent updates (e.g., two simultaneous persists to
+the same backend) are not supported.
+
+Manifests written before the index existed, or whose update was
+interrupted, are picked up by sync(), which compares the list of
+manifests accounted for with the manifests in the backend.
+'''
+
+from __future__ import absolute_import
+from __future__ import with_statement
+
+import zlib
+
+import shastity.logging as logging
+import shastity.manifest as manifest
+
+log = logging.get_logger(__name__)
+
+SHARDS = 64
+
+MANIFESTS_NAME = 'refcount.manifests'
+
+_BLOCKS_MAGIC = 'shastity-blocks'
+_REFCOUNT_MAGIC = 'shastity-refcount'
+
+class RefindexError(Exception):
+    pass
+
+def blocks_name(name):
+    '''@return The name of the block set of the manifest by the given name.'''
+    return '%s.blocks' % (name,)
+
+def shard_name(n):
+    return 'refcount.%02d' % (n,)
+
+def shard_of(block):
+    '''@return The shard of a block, given as an (algo, hex) tuple.'''
+    return (zlib.crc32(block[1]) & 0xffffffff) % SHARDS
+
+def _header(magic):
+    return '%s\nversion 1\nend\n' % (magic,)
+
+def _body_lines(magic, data):
+    header = _header(magic)
+    if not data.startswith(header):
+        raise RefindexError('not a %s object (or unsupported version)' % (magic,))
+    return [ line for line in data[len(header):].split('\n') if line ]
+
+def block_set(entries):
+    '''
+    @param entries: Iterable of (path, metadata, hashes) manifest entries.
+    @return The set of distinct (algo, hex) blocks referenced.'''
+    blocks = set()
+    for path, metadata, hashes in entries:
+        blocks.update(hashes)
+    return blocks
+
+def _encode_block_set(blocks):
+    return _header(_BLOCKS_MAGIC) + '\n'.join([ '%s,%s' % block for block in sorted(blocks) ])
+
+def write_block_set(backend, name, blocks):
+    '''
+    @param blocks: Iterable of the distinct (algo, hex) blocks referenced by
+                   the manifest by the given name.'''
+    backend.put(blocks_name(name), _encode_block_set(blocks))
+
+def read_block_set(backend, name):
+    '''@return The set of (algo, hex) blocks of the manifest by the given name.'''
+    return set([ tuple(line.split(',', 1)) for line in _body_lines(_BLOCKS_MAGIC, backend.get(blocks_name(name))) ])
+
+class RefcountIndex(object):
+    '''The reference count index of a manifest backend. Shards are
+    read lazily and cached for the lifetime of the instance.'''
+
+    def __init__(self, backend):
+        '''
+        @param backend: The backend containing the manifests.
+        '''
+        self.backend = backend
+
+        self.__shards = dict() # n -> dict of block -> count
+        self.__manifests = None
+        self.__names = None    # listing of the backend
+
+    def __exists(self, name):
+        # backends have no exists(name); list once, which is cheap
+        # compared to reading every manifest
+        if self.__names is None:
+            self.__names = set(self.backend.list())
+        return name in self.__names
+
+    def __put(self, name, data):
+        self.backend.put(name, data)
+        if self.__names is not None:
+            self.__names.add(name)
+
+    def manifests(self):
+        '''@return The set of names of the manifests accounted for.'''
+        if self.__manifests is None:
+            if self.__exists(MANIFESTS_NAME):
+                self.__manifests = set(_body_lines(_REFCOUNT_MAGIC, self.backend.get(MANIFESTS_NAME)))
+            else:
+                self.__manifests = set()
+        return self.__manifests
+
+    def __shard(self, n):
+        if n not in self.__shards:
+            counts = dict()
+            if self.__exists(shard_name(n)):
+                for line in _body_lines(_REFCOUNT_MAGIC, self.backend.get(shard_name(n))):
+                    block, count = line.split(' ')
+                    counts[tuple(block.split(',', 1))] = int(count)
+            self.__shards[n] = counts
+        return self.__shards[n]
+
+    def __write_shard(self, n):
+        lines = [ '%s,%s %d' % (block[0], block[1], count)
+                  for block, count in sorted(self.__shards[n].iteritems()) ]
+        self.__put(shard_name(n), _header(_REFCOUNT_MAGIC) + '\n'.join(lines))
+
+    def __apply(self, blocks, delta, touched):
+        '''Apply a change to the counts in memory, recording the shards
+        touched.'''
+        for block in blocks:
+            n = shard_of(block)
+            counts = self.__shard(n)
+            count = counts.get(block, 0) + delta
+            if count > 0:
+                counts[block] = count
+            else:
+                counts.pop(block, None)
+            touched.add(n)
+
+    def __flush(self, touched):
+        '''Write the touched shards, then the list of manifests.'''
+        for n in sorted(touched):
+            self.__write_shard(n)
+        self.__put(MANIFESTS_NAME,
+                   _header(_REFCOUNT_MAGIC) + '\n'.join(sorted(self.__manifests)))
+
+    def __add(self, name, blocks, touched):
+        log.debug('adding manifest %s to reference counts', name)
+        self.__apply(blocks, 1, touched)
+        self.__manifests.add(name)
+
+    def __remove(self, name, touched):
+        log.debug('removing manifest %s from reference counts', name)
+        self.__apply(read_block_set(self.backend, name), -1, touched)
+        self.__manifests.remove(name)
+
+    def add(self, name, blocks):
+        '''Account for a manifest. Has no effect if it already is.
+
+        @param blocks: The distinct (algo, hex) blocks it references.'''
+        if name in self.manifests():
+            return
+        touched = set()
+        self.__add(name, blocks, touched)
+        self.__flush(touched)
+
+    def remove(self, name):
+        '''Stop accounting for a (deleted) manifest, using its block set.'''
+        if name not in self.manifests():
+            return
+        touched = set()
+        self.__remove(name, touched)
+        self.__flush(touched)
+
+    def sync(self, names=None, loader=None):
+        '''Bring the index in line with the manifests in the backend:
+        add those not accounted for and remove those no longer present.
+
+        @param names: Names of the manifests in the backend; listed if None.
+        @param loader: Callable returning the entries of a manifest by name,
+                       for manifests lacking a block set. Defaults to reading
+                       the manifest.'''
+        if names is None:
+            names = manifest.list_manifests(self.backend)
+        if loader is None:
+            loader = lambda name: manifest.read_manifest(self.backend, name)
+
+        names = set(names)
+        gone = self.manifests() - names
+        new = names - self.manifests()
+        if not gone and not new:
+            return
+
+        for name in gone:
+            if not self.__exists(blocks_name(name)):
+                log.warning('block set of deleted manifest %s missing; rebuilding reference counts', name)
+                return self.rebuild(names, loader)
+
+        touched = set()
+        for name in sorted(gone):
+            self.__remove(name, touched)
+        for name in sorted(new):
+            if self.__exists(blocks_name(name)):
+                blocks = read_block_set(self.backend, name)
+            else:
+                blocks = block_set(loader(name))
+                self.__put(blocks_name(name), _encode_block_set(blocks))
+            self.__add(name, blocks, touched)
+        self.__flush(touched)
+
+    def rebuild(self, names, loader):
+        '''Recompute the index from scratch, from the given manifests.'''
+        self.__shards = dict([ (n, dict()) for n in xrange(0, SHARDS) ])
+        self.__manifests = set()
+
+        touched = set(xrange(0, SHARDS))
+        for name in sorted(names):
+            blocks = block_set(loader(name))
+            self.__put(blocks_name(name), _encode_block_set(blocks))
+            self.__add(name, blocks, touched)
+        self.__flush(touched)
+
+    def delete_manifest(self, name):
+        '''Delete a manifest and its block set, updating the counts.'''
+        manifest.delete_manifest(self.backend, name)
+        self.remove(name)
+        if self.__exists(blocks_name(name)):
+            self.backend.delete(blocks_name(name))
+            self.__names.discard(blocks_name(name))
+
+    def counts(self):
+        '''@return A dict of (algo, hex) block -> number of manifests
+        referencing it.'''
+        counts = dict()
+        for n in xrange(0, SHARDS):
+            counts.update(self.__shard(n))
+        return counts
+
+    def unexplained(self):
+        '''@return The sorted names of the objects in the backend that are
+        neither manifests, objects derived from them, block sets of
+        manifests accounted for, nor part of the index. There should be
+        none once the index is in sync; others may be left behind by an
+        interrupted (or running) write.'''
+        names = set(self.backend.list())
+        explained = set([ MANIFESTS_NAME ] + [ shard_name(n) for n in xrange(0, SHARDS) ])
+        explained.update([ blocks_name(name) for name in self.manifests() ])
+        ids = manifest.list_ids(self.backend, names)
+        for name in names:
+            if not manifest.is_derived_name(name):
+                explained.add(name)
+                explained.add(blocks_name(name))
+                explained.update(manifest.derived_objects(self.backend, name))
+                explained.update([ manifest.id_name(name, ident) for ident in ids.get(name, []) ])
+        return sorted(names - explained)
+
+    def referenced(self):
+        '''@return The set of (algo, hex) blocks referenced by any manifest.'''
+        return set(self.counts().iterkeys())
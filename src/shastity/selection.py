@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2009 Peter Schuller <peter.schuller@infidyne.com>
+
+'''
+Selection of a subset of the paths in a manifest, for selective
+restores.
+
+A PathSelector is built from a list of requested paths, each of which
+may contain shell-style wildcards (as understood by fnmatch) in any of
+its components. A requested path selects the entry at that path and,
+if it is a directory, everything below it. Wildcards match within a
+single path component; '*' does not match across a '/'.
+
+The requested paths are compiled into a trie keyed on path components,
+such that classifying a path costs time proportional to its depth
+rather than to the number of requested paths. Each path classifies as
+one of:
+
+  - SELECTED: the path, and everything below it, is selected.
+  - ANCESTOR: the path is not itself selected, but something below it
+              may be (directories in this state must be created, but
+              their other contents skipped).
+  - EXCLUDED: neither the path nor anything below it is selected.
+
+filter_entries() uses this to prune entire subtrees from a manifest
+stream, relying on the manifest being ordered such that the contents
+of a directory immediately follow it.
+'''
+
+from __future__ import absolute_import
+from __future__ import with_statement
+
+import fnmatch
+
+EXCLUDED = 0
+ANCESTOR = 1
+SELECTED = 2
+
+_GLOB_CHARS = '*?['
+
+def _components(path):
+    '''@return The list of non-empty components of the given path, with
+    any '.' components removed.'''
+    return [ comp for comp in path.split('/') if comp and comp != '.' ]
+
+def is_literal(pattern):
+    '''@return Whether the given requested path contains no wildcards.'''
+    return not [ c for c in _GLOB_CHARS if c in pattern ]
+
+def normalize(path):
+    '''@return The given (literal) requested path in the form used by
+    manifests: relative, without empty or '.' components.'''
+    return '/'.join(_components(path))
+
+def ancestors(path):
+    '''@return The list of proper ancestors of the given (normalized)
+    path, outermost first.'''
+    comps = path.split('/')
+    return [ '/'.join(comps[0:n]) for n in xrange(1, len(comps)) ]
+
+class _Node(object):
+    __slots__ = ('terminal', 'literals', 'globs')
+
+    def __init__(self):
+        self.terminal = False # a requested path ends here
+        self.literals = dict() # component -> _Node
+        self.globs = []        # [(pattern, _Node)]
+
+    def child(self, comp):
+        if not is_literal(comp):
+            for pattern, node in self.globs:
+                if pattern == comp:
+                    return node
+            node = _Node()
+            self.globs.append((comp, node))
+            return node
+        else:
+            return self.literals.setdefault(comp, _Node())
+
+    def step(self, comp):
+        '''@return The list of child nodes matching the given component.'''
+        nodes = []
+        if comp in self.literals:
+            nodes.append(self.literals[comp])
+        for pattern, node in self.globs:
+            if fnmatch.fnmatchcase(comp, pattern):
+                nodes.append(node)
+        return nodes
+
+class PathSelector(object):
+    '''Classifies manifest paths against a set of requested paths and
+    globs (see module documentation).'''
+
+    def __init__(self, patterns):
+        '''
+        @param patterns: Iterable of requested paths, relative to the root of
+                         the manifest, possibly containing wildcards.
+        '''
+        self.patterns = list(patterns)
+
+        self.__root = _Node()
+        for pattern in self.patterns:
+            node = self.__root
+            for comp in _components(pattern):
+                node = node.child(comp)
+            node.terminal = True
+
+    def classify(self, path):
+        '''
+        @return SELECTED, ANCESTOR or EXCLUDED.'''
+        nodes = [ self.__root ]
+        for comp in _components(path):
+            if [ node for node in nodes if node.terminal ]:
+                return SELECTED
+
+            nextnodes = []
+            for node in nodes:
+                nextnodes.extend(node.step(comp))
+            if not nextnodes:
+                return EXCLUDED
+            nodes = nextnodes
+
+        if [ node for node in nodes if node.terminal ]:
+            return SELECTED
+        return ANCESTOR
+
+    def selects(self, path):
+        '''@return Whether the given path is selected.'''
+        return self.classify(path) == SELECTED
+
+def filter_entries(selector, entryiter):
+    '''Filter a manifest stream down to the entries relevant to the
+    given selection: selected entries, and the directories leading up
+    to them. Subtrees that are excluded or entirely selected are
+    recognized once, at their root, without classifying each entry
+    within them.
+
+    @param selector: A PathSelector.
+    @param entryiter: Iterable of (path, metadata, hashes) entries, in manifest order.
+    @return Generator of (path, metadata, hashes, state) tuples, where state is
+            SELECTED or ANCESTOR.'''
+    # Prefix (ending in '/') of the subtree currently being skipped or
+    # wholly selected, and its state.
+    subtree = None
+    subtree_state = None
+
+    for path, metadata, hashes in entryiter:
+        if subtree is not None:
+            if path.startswith(subtree):
+                if subtree_state == SELECTED:
+                    yield (path, metadata, hashes, SELECTED)
+                continue
+            subtree = None
+
+        state = selector.classify(path)
+        if state != ANCESTOR and metadata.is_directory:
+            subtree = path.rstrip('/') + '/'
+            subtree_state = state
+        if state != EXCLUDED:
+            yield (path, metadata, hashes, state)
@@ -55,45 +55,102 @@ def _hex_if_needed(c):
 # And the _enc_map, which simply maps characters to their encoded-if-needed version.
 _enc_map = dict([ (chr(c), _hex_if_needed(chr(c))) for c in xrange(0, 256) ])
 
+# And the _dec_map, mapping the two hex digits of an escape (in either
+# case) to the character.
+_dec_map = dict([ ('%02X' % (c,), chr(c)) for c in xrange(0, 256) ] +
+                [ ('%02x' % (c,), chr(c)) for c in xrange(0, 256) ])
+
+# Strings with more distinct characters to escape than this are encoded
+# character by character, rather than by one str.replace() per distinct
+# character.
+_MAX_REPLACE = 8
+
+# Separator of strings encoded in bulk; never occurs in UTF-8.
+_BULK_SEP = '\xff'
+
 # And these two guys are used by the public interface.
-def _urlenc(s):
-    return ''.join([ _enc_map[c] for c in s ])
+def _urlenc(s, keep=''):
+    # the characters to escape, found by deleting the others (fast
+    # path: none)
+    unsafe = s.translate(None, _safechars + keep)
+    if not unsafe:
+        return s
+
+    distinct = set(unsafe)
+    if len(distinct) > _MAX_REPLACE:
+        enc_map = _enc_map
+        if keep:
+            enc_map = dict(enc_map)
+            enc_map.update([ (c, c) for c in keep ])
+        return ''.join([ enc_map[c] for c in s ])
+
+    # '%' first, such that the escapes inserted thereafter are kept
+    if '%' in distinct:
+        s = s.replace('%', '%25')
+        distinct.discard('%')
+    for c in distinct:
+        s = s.replace(c, _enc_map[c])
+    return s
 
 def _urldec(s):
+    if '%' not in s:
+        return s
+
     parts = s.split('%')
 
     # for each part but the first, decode based on the first two
     # characters and replace destructively
     for i in xrange(1, len(parts)):
-        assert len(parts[i]) >= 2, 'broken string, expected hex after %%: %s' % (s,)
-        unhexed = chr(int(parts[i][0] + parts[i][1], 16))
-        parts[i] = unhexed + parts[i][2:]
+        part = parts[i]
+        assert len(part) >= 2, 'broken string, expected hex after %%: %s' % (s,)
+        unhexed = _dec_map.get(part[0:2])
+        if unhexed is None:
+            unhexed = chr(int(part[0:2], 16))
+        parts[i] = unhexed + part[2:]
 
     return ''.join(parts)
 
-def spencode(s):
+def _utf8(s):
     '''
-    @param s: Character string to encode.
-    
-    @return A ASCII character string as per the description in the
-            module documentation.
-
-    TODO: ugly hack to make it work with utf-8 input too.
+    @return The UTF-8 encoding of a character string (or of a byte
+            string that is already valid UTF-8).
     '''
     try:
-        bytestr = s.encode('utf-8')
+        return s.encode('utf-8')
     except Exception, e:
         try:
             # already utf-8?
             s.decode('utf-8')
-            bytestr = s[:]
+            return s[:]
         except:
             raise e
 
-    asciistr = "'%s'" % (_urlenc(bytestr))
+def spencode(s):
+    '''
+    @param s: Character string to encode.
+    
+    @return A ASCII character string as per the description in the
+            module documentation.
+
+    TODO: ugly hack to make it work with utf-8 input too.
+    '''
+    asciistr = "'%s'" % (_urlenc(_utf8(s)))
 
     return asciistr
 
+def spencode_many(strings):
+    '''
+    Encode many strings at once, as spencode() would each of them, but
+    in a single pass over all of them.
+
+    @param strings: A sequence of character strings to encode.
+    @return A list of ASCII character strings.
+    '''
+    if not strings:
+        return []
+    encoded = _urlenc(_BULK_SEP.join([ _utf8(s) for s in strings ]), keep=_BULK_SEP)
+    return [ "'%s'" % (e,) for e in encoded.split(_BULK_SEP) ]
+
 def spdecode(s):
     '''
     @param s: ASCII character string to decode.
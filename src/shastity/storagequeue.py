@@ -22,26 +22,92 @@ of the StorageQueue interface.
 
 The storage queue is also the place where retry logic is implemented
 (which is easy, given that all backend operations are idempotent).
+
+Hedged reads
+============
+
+Some backends (S3 in particular) exhibit a long latency tail; a small
+fraction of GET requests take many times longer than the median. When
+hedging is enabled, the storage queue tracks the latency of recent
+hedgeable operations, and when an operation has been outstanding for
+longer than a configured percentile of that latency it issues a
+duplicate request against a separate backend instance. Whichever
+attempt finishes first delivers the result; the other is discarded.
+
+A single hedging thread keeps the deadlines of the outstanding
+hedgeable operations. Hedges go through the gate of downloads (ahead
+of operations not yet started), and are thus subject to the same rate
+limits and concurrency limit as any other GET, each attempt occupying
+a worker slot until it completes. The download of every attempt is
+charged, including those whose result is discarded. The total number
+of hedges is capped to a configurable fraction of the hedgeable
+operations started.
+
+Rate limiting
+=============
+
+A storage queue may be given RateLimits (see shastity.ratelimit) on
+upload bytes, download bytes and operations per second, and
+optionally a RateSchedule which changes the limits by time of
+day. Limits can also be changed on a running queue.
+
+Throttling does not happen in enqueue(). Each operation is handed to
+one of three gates, by direction: uploads, downloads and everything
+else. A gate is a thread which takes its operations in order, waits
+for the rate limits that apply to the operation, and then waits for a
+free worker slot. Waiting for bandwidth thus never occupies a worker
+slot, and an upload waiting for upload bandwidth does not hold back
+GETs. enqueue() blocks while the operations waiting in the gate of the
+operation and those running number max_conc or more, such that (for
+operations of one direction) the queue holds no more than max_conc
+operations, as when enqueue() itself waited for a free slot.
+
+Once an operation has failed, operations still waiting in a gate are
+never started; they fail instead (see StorageOperation.abandon()).
+
+Uploads no larger than small_op_bytes are charged against the upload
+limit without waiting (the resulting debt is paid off by subsequent
+large uploads), so that small latency-bound operations are not held
+back behind bandwidth-bound ones. Since the size of a GET is not known
+until it completes, downloads are charged on completion and further
+GETs wait only while the download limit is in debt.
+
+When a RateSchedule is given, the limits are re-read before each
+operation is admitted, and at least every SCHEDULE_POLL_INTERVAL
+seconds while a gate is waiting.
 '''
 
 from __future__ import absolute_import
 from __future__ import with_statement
 
+import collections
+import heapq
 import thread
 import threading
+import time
 import traceback
 
 import shastity.logging as logging
+import shastity.ratelimit as ratelimit
 import shastity.util as util
 
 log = logging.get_logger(__name__)
 
+SCHEDULE_POLL_INTERVAL = 60.0 # seconds
+
 class StorageOperation(object):
     '''Abstract base class for all operations.
 
-    Specific baseclasses should implement execute().'''
+    Specific baseclasses should implement execute().
+
+    @cvar hedgeable Whether the storage queue may issue duplicate
+                    attempts of the operation (see module documentation).
+                    Only operations which are free of side-effects should
+                    be hedgeable.'''
 
-    def __init__(self, mnemonic, description, callback=None):
+    hedgeable = False
+
+    def __init__(self, mnemonic, description, callback=None, errback=None):
         '''
         @param mnemonic Short mnemonic indicating the type of operation.
         @param description Longer human-readable description of operations.
@@ -50,19 +116,30 @@ class StorageOperation(object):
                         will block the I/O worker until done; thus worker
                         invocation is subject to the concurrency limits of a
                         storage queue.
+        @param errback If given, a callable which will be called with a
+                       human-readable reason if and when the operation fails
+                       (including when the callback raises, and when the
+                       operation is abandoned). Like the callback, it runs
+                       before the result is set. Typically used to release
+                       the callbacks of other operations waiting on this one.
         '''
         self.mnemonic = mnemonic
         self.description = description
         self.callback = callback
+        self.errback = errback
+        self.finished = None # time at which the winning attempt completed
 
         self.__sq = None
         self.__result = None
-        self.__cond = threading.Condition() # protects __result only
+        self.__attempts = 0 # number of attempts currently executing
+        self.__delivering = False # set once an attempt has won, before its callback runs
+        self.__cond = threading.Condition() # protects __result, __attempts and __delivering only
 
     def wait(self):
         '''Wait for the operation to complete. The operation is
         complete when a value has been delivered and the callback, if
-        any, has completed.'''
+        any, has completed; the result is not set until then. A
+        callback which raises fails the operation.'''
         with self.__cond:
             while self.__result is None:
                 self.__cond.wait()
@@ -89,11 +166,23 @@ class StorageOperation(object):
             assert self.__result[0], 'value() called on failed operation'
             return self.__result[1]
 
-    def __set_result(self, success, data):
+    def abandon(self, reason):
+        '''Fail an operation which will never be performed, such as
+        one dropped by the storage queue after another operation has
+        failed. Releases waiters as any other failure would.
+
+        @param reason: Human-readable description of why.'''
         with self.__cond:
-            assert self.__result is None, '__set_result called twice?'
-            self.__result = (success, data)
+            assert self.__attempts == 0 and not self.__delivering, 'abandon() of a performed operation'
+            self.__delivering = True
+            self.finished = time.time()
+
+        self.__call_errback(reason)
+
+        with self.__cond:
+            self.__result = (False, reason)
             self.__cond.notifyAll()
+        log.debug('operation abandoned: %s (%s)', str(self), reason)
 
     def execute(self, backend):
         raise NotImplementedError
@@ -111,25 +200,92 @@ class StorageOperation(object):
         appropriate scaffolding to handling errors and result
         signalling. This will be called by the StorageQueue in some
         worker thread. Errors should not leak from this method (they
-        are not well handled).'''
+        are not well handled).
+
+        When the operation is hedged, perform() is called concurrently
+        more than once for the same operation (with distinct
+        backends). The first attempt to succeed delivers the result;
+        a failed attempt only fails the operation if no other attempt
+        is still outstanding.
+
+        @return (success, value) of this attempt, whether or not it
+                delivered the result of the operation.'''
+        with self.__cond:
+            self.__attempts += 1
+
         try:
             log.info('performing operation: %s', str(self))
-            self.__set_result(True, self.execute(backend))
-            log.debug('operation done: %s', str(self))
-
-            self.__sq.notify_operation_complete(self)
+            success, data = True, self.execute(backend)
         except KeyboardInterrupt, e:
             raise
         except Exception, e:
-            self.__set_result(False, traceback.format_exc())
+            success, data = False, traceback.format_exc()
+        attempt = (success, data)
 
+        with self.__cond:
+            self.__attempts -= 1
+
+            if self.__delivering:
+                log.debug('discarding result of redundant attempt: %s', str(self))
+                return attempt
+
+            if not success and self.__attempts > 0:
+                log.warning('attempt failed, but other attempts are outstanding: %s', str(self))
+                log.debug('traceback: %s', data)
+                return attempt
+
+            self.__delivering = True
+            self.finished = time.time()
+
+        if success and self.callback:
+            # The callback runs before the result is set and before we
+            # notify the queue, such that wait() on the operation or on
+            # the queue also waits for callbacks.
+            try:
+                self.callback(data)
+            except KeyboardInterrupt, e:
+                raise
+            except Exception, e:
+                success, data = False, traceback.format_exc()
+
+        if not success:
+            self.__call_errback(data)
+
+        with self.__cond:
+            self.__result = (success, data)
+            self.__cond.notifyAll()
+
+        if success:
+            log.debug('operation done: %s', str(self))
+
+            self.__sq.notify_operation_complete(self)
+        else:
             log.error('operation failed: %s', str(self))
-            log.error('traceback: %s', self.__result[1])
+            log.error('traceback: %s', data)
 
             self.__sq.notify_operation_failed(self)
 
-        if self.__result[0] and self.callback:
-            self.callback(self.__result[1])
+        return attempt
+
+    def __call_errback(self, reason):
+        if self.errback:
+            try:
+                self.errback(reason)
+            except KeyboardInterrupt, e:
+                raise
+            except Exception, e:
+                log.error('errback of failed operation raised: %s', str(self))
+                log.debug('traceback: %s', traceback.format_exc())
+
+    def bytes_up(self):
+        '''Number of bytes this operation uploads (for rate limiting
+        purposes).'''
+        return 0
+
+    def bytes_down(self, value):
+        '''Number of bytes an attempt at this operation downloaded
+        (for rate limiting purposes), given the value it produced.'''
+        return 0
 
     def __str__(self):
         return '%s %s' % (self.mnemonic, self.description)
@@ -138,8 +294,8 @@ class StorageOperation(object):
         return '<%s(%s %s)>' % (self.__class__.__name__, self.mnemonic, self.description)
 
 class PutOperation(StorageOperation):
-    def __init__(self, name, data, callback=None):
-        StorageOperation.__init__(self, 'PUT', '%s (%d bytes)' % (name, len(data)), callback)
+    def __init__(self, name, data, callback=None, errback=None):
+        StorageOperation.__init__(self, 'PUT', '%s (%d bytes)' % (name, len(data)), callback, errback)
 
         self.name = name
         self.data = data
@@ -147,18 +303,26 @@ class PutOperation(StorageOperation):
     def execute(self, backend):
         return backend.put(self.name, self.data)
 
+    def bytes_up(self):
+        return len(self.data)
+
 class GetOperation(StorageOperation):
-    def __init__(self, name, callback=None):
-        StorageOperation.__init__(self, 'GET', name, callback)
+    hedgeable = True
+
+    def __init__(self, name, callback=None, errback=None):
+        StorageOperation.__init__(self, 'GET', name, callback, errback)
 
         self.name = name
 
     def execute(self, backend):
         return backend.get(self.name)
 
+    def bytes_down(self, value):
+        return len(value)
+
 class DeleteOperation(StorageOperation):
-    def __init__(self, name, callback=None):
-        StorageOperation.__init__(self, 'DEL', name, callback)
+    def __init__(self, name, callback=None, errback=None):
+        StorageOperation.__init__(self, 'DEL', name, callback, errback)
 
         self.name = name
 
@@ -168,14 +332,80 @@ class DeleteOperation(StorageOperation):
 class OperationHasFailed(Exception):
     pass
 
+class _Hedge(object):
+    '''A hedge of an operation, waiting in a gate.'''
+    def __init__(self, op):
+        self.op = op
+
+class LatencyTracker(object):
+    '''Keeps track of the latencies of the most recently completed
+    operations, for the purpose of answering percentile queries.
+
+    Not thread-safe; the storage queue protects it with its own
+    lock.'''
+
+    def __init__(self, window=1000, min_samples=20, resort_interval=50):
+        '''
+        @param window: Number of most recent samples to consider.
+        @param min_samples: Minimum number of samples required before
+                            percentile() will produce an answer.
+        @param resort_interval: Number of samples to record between
+                                re-computations of the sorted sample set.
+        '''
+        self.min_samples = min_samples
+        self.resort_interval = resort_interval
+
+        self.__samples = collections.deque(maxlen=window)
+        self.__sorted = None   # sorted copy of __samples, or None if never computed
+        self.__unsorted = 0    # samples recorded since __sorted was computed
+
+    def record(self, seconds):
+        self.__samples.append(seconds)
+        self.__unsorted += 1
+
+    def percentile(self, pct):
+        '''
+        @param pct: Percentile (0-100).
+        @return The latency in seconds at the given percentile, or None if
+                too few samples have been recorded.'''
+        if len(self.__samples) < self.min_samples:
+            return None
+
+        if self.__sorted is None or self.__unsorted >= self.resort_interval:
+            self.__sorted = sorted(self.__samples)
+            self.__unsorted = 0
+
+        idx = min(len(self.__sorted) - 1, int(len(self.__sorted) * pct / 100.0))
+        return self.__sorted[idx]
+
 class StorageQueue(object):
-    def __init__(self, backend_factory, max_conc):
+    def __init__(self, backend_factory, max_conc, hedge_percentile=None, hedge_budget=0.05,
+                 limits=None, schedule=None, small_op_bytes=64*1024):
         '''
         @param backend_factory: Callable which will yield a newly constructed backend when called.
         @param max_conc: Maximum worker concurrency.
+        @param hedge_percentile: If not None, the latency percentile (0-100) after which a
+                                 hedgeable operation is hedged (see module documentation).
+        @param hedge_budget: Maximum number of hedges issued, as a fraction of the number of
+                             hedgeable operations started.
+        @param limits: RateLimits to apply, or None for unlimited.
+        @param schedule: RateSchedule to follow, or None. If given, it takes precedence
+                         over limits.
+        @param small_op_bytes: Uploads up to this size are never delayed by the upload limit.
         '''
         self.backend_factory = backend_factory
         self.max_conc = max_conc
+        self.hedge_percentile = hedge_percentile
+        self.hedge_budget = hedge_budget
+        self.schedule = schedule
+        self.small_op_bytes = small_op_bytes
+
+        self.__limits = ratelimit.UNLIMITED
+        self.__up_bucket = ratelimit.TokenBucket()
+        self.__down_bucket = ratelimit.TokenBucket()
+        self.__ops_bucket = ratelimit.TokenBucket()
+        if limits is not None:
+            self.set_rate_limits(limits)
 
         # We maintain a set of currently oustanding operations. We
         # never keep more here than the number of workers that we
@@ -188,15 +418,34 @@ class StorageQueue(object):
         #
         # The associated condition is signalled whenever an item is
         # removed from the dict. Its lock also protects access to the
-        # backend cache.
+        # backend cache and the hedging state.
         #
         # For the moment, we keep it simple.
+        #
+        # Operations not yet started wait in the gate of their
+        # direction (see module documentation); __gating is the set of
+        # directions whose gate thread is running.
         self.__ops = set()
+        self.__gates = dict([ (direction, collections.deque()) for direction in ('up', 'down', 'other') ])
+        self.__gating = set()
         self.__backends = set() # backend cache
         self.__cond = threading.Condition()
 
         self.__failed = False # set to true when an operation fails
 
+        # Attempts (operations and their hedges) currently executing;
+        # each occupies a worker slot.
+        self.__running = 0
+
+        # hedging state
+        self.__latencies = LatencyTracker()
+        self.__started = dict()    # op -> start time
+        self.__deadlines = []      # heap of (hedge deadline, sequence, op)
+        self.__deadline_seq = 0    # tie breaker for __deadlines
+        self.__hedging = False     # whether the hedging thread is running
+        self.__hedgeable_count = 0 # hedgeable operations started
+        self.__hedge_count = 0     # hedges issued
+
     def __enter__(self):
         return self
 
@@ -210,27 +459,197 @@ class StorageQueue(object):
         if self.__failed:
             raise OperationHasFailed('a previous operation has failed; refusing further work')
 
+        op.set_storage_queue(self)
+
+        direction = self.__direction(op)
         with self.__cond:
-            while len(self.__ops) >= self.max_conc:
+            gate = self.__gates[direction]
+            while len(gate) + self.__running >= self.max_conc:
                 self.__cond.wait()
-            self.__ops.add(op)
-            self.__start_op(op)
-
-    def __start_op(self, op):
+                if self.__failed:
+                    raise OperationHasFailed('a previous operation has failed; refusing further work')
+            gate.append(op)
+            if direction not in self.__gating:
+                self.__gating.add(direction)
+                thread.start_new_thread(self.__run_gate, (direction,))
+
+    def __direction(self, op):
+        if isinstance(op, GetOperation):
+            return 'down'
+        elif op.bytes_up() > 0:
+            return 'up'
+        else:
+            return 'other'
+
+    def __run_gate(self, direction):
+        '''Body of the gate thread of the given direction. Runs until
+        the gate is empty.'''
+        gate = self.__gates[direction]
+        while True:
+            with self.__cond:
+                self.__drop_if_failed(gate)
+                if not gate:
+                    self.__gating.remove(direction)
+                    self.__cond.notifyAll()
+                    return
+                item = gate[0] # left in the gate until started, for the benefit of wait()
+
+            self.__throttle(item.op if isinstance(item, _Hedge) else item)
+
+            with self.__cond:
+                while self.__running >= self.max_conc and not self.__failed:
+                    self.__cond.wait()
+                if self.__drop_if_failed(gate):
+                    continue
+                gate.popleft()
+                if isinstance(item, _Hedge):
+                    self.__start_hedge(item.op)
+                else:
+                    self.__ops.add(item)
+                    self.__start_op(item)
+                self.__cond.notifyAll()
+
+    def __drop_if_failed(self, gate):
+        '''Once an operation has failed, fail the operations of the
+        given gate rather than starting them.
+
+        @pre self.__cond locked
+        @return Whether operations were dropped.'''
+        if not (self.__failed and gate):
+            return False
+        log.warning('dropping %d operations not yet started after failure', len(gate))
+        while gate:
+            item = gate.popleft()
+            if not isinstance(item, _Hedge): # the hedged operation fails by itself
+                item.abandon('not started: a previous operation has failed')
+        self.__cond.notifyAll()
+        return True
+
+    def set_rate_limits(self, limits):
+        '''Change the rate limits of the queue. Takes effect
+        immediately, including for operations currently waiting in a
+        gate.
+
+        @type limits RateLimits'''
+        log.info('setting rate limits: %r', limits)
+        self.__limits = limits
+        self.__up_bucket.set_rate(limits.upload)
+        self.__down_bucket.set_rate(limits.download)
+        self.__ops_bucket.set_rate(limits.ops)
+
+    def get_rate_limits(self):
+        return self.__limits
+
+    def __follow_schedule(self):
+        if self.schedule is not None:
+            limits = self.schedule.limits_at()
+            if limits != self.__limits:
+                self.set_rate_limits(limits)
+
+    def __wait(self, bucket, amount=0):
+        '''Wait for the given bucket, following the schedule while
+        waiting.'''
+        timeout = SCHEDULE_POLL_INTERVAL if self.schedule is not None else None
+        while not bucket.wait(amount, timeout):
+            self.__follow_schedule()
+
+    def __throttle(self, op):
+        '''Block the gate thread of the operation as required by the
+        rate limits in effect.'''
+        self.__follow_schedule()
+
+        self.__wait(self.__ops_bucket, 1)
+        self.__ops_bucket.charge(1)
+
+        up = op.bytes_up()
+        if up > self.small_op_bytes:
+            self.__wait(self.__up_bucket, up)
+        self.__up_bucket.charge(up)
+
+        if isinstance(op, GetOperation):
+            self.__wait(self.__down_bucket)
+
+    def __get_backend(self):
         '''@pre self.__cond locked'''
-        # We should maintain a thread pool, but for simplicity in the
-        # initial implementation we just launch a dedicated thread.
         if self.__backends:
-            backend = self.__backends.pop()
+            return self.__backends.pop()
         else:
             log.debug('instantiating new backend')
-            backend = self.backend_factory()
+            return self.backend_factory()
+
+    def __start_op(self, op):
+        '''@pre self.__cond locked'''
+        self.__started[op] = time.time()
+
+        if op.hedgeable and self.hedge_percentile is not None:
+            self.__hedgeable_count += 1
+            threshold = self.__latencies.percentile(self.hedge_percentile)
+            if threshold is not None:
+                self.__deadline_seq += 1
+                heapq.heappush(self.__deadlines, (time.time() + threshold, self.__deadline_seq, op))
+                if not self.__hedging:
+                    self.__hedging = True
+                    thread.start_new_thread(self.__run_hedger, ())
+
+        self.__start_attempt(op)
 
-        def op_runner():
-            op.set_storage_queue(self)
-            op.perform(backend)
+    def __start_attempt(self, op):
+        '''@pre self.__cond locked'''
+        # We should maintain a thread pool, but for simplicity in the
+        # initial implementation we just launch a dedicated thread.
+        backend = self.__get_backend()
+        self.__running += 1
+        thread.start_new_thread(self.__attempt, (op, backend))
 
-        thread.start_new_thread(op_runner, ())
+    def __attempt(self, op, backend):
+        '''Body of the thread of an attempt at an operation.'''
+        try:
+            success, value = op.perform(backend)
+            if success:
+                self.__down_bucket.charge(op.bytes_down(value))
+        finally:
+            with self.__cond:
+                self.__running -= 1
+                self.__cond.notifyAll()
+
+    def __run_hedger(self):
+        '''Body of the hedging thread, which hands operations outstanding
+        past their hedging deadline to the gate of downloads. Runs until
+        no operation awaits its deadline.'''
+        with self.__cond:
+            while True:
+                deadlines = self.__deadlines
+                while deadlines and deadlines[0][2] not in self.__ops:
+                    heapq.heappop(deadlines) # completed in time
+                if not deadlines or self.__failed:
+                    del deadlines[:]
+                    self.__hedging = False
+                    return
+
+                deadline, seq, op = deadlines[0]
+                now = time.time()
+                if now < deadline:
+                    self.__cond.wait(deadline - now)
+                    continue
+                heapq.heappop(deadlines)
+
+                if self.__hedge_count >= self.hedge_budget * self.__hedgeable_count:
+                    log.debug('hedge budget exhausted; not hedging %s', str(op))
+                    continue
+
+                self.__hedge_count += 1
+                log.info('hedging slow operation: %s', str(op))
+                self.__gates['down'].appendleft(_Hedge(op))
+                if 'down' not in self.__gating:
+                    self.__gating.add('down')
+                    thread.start_new_thread(self.__run_gate, ('down',))
+
+    def __start_hedge(self, op):
+        '''@pre self.__cond locked'''
+        if op not in self.__ops:
+            log.debug('not starting hedge of completed operation %s', str(op))
+            return
+        self.__start_attempt(op)
 
     def __remove_op(self, op, success):
         with self.__cond:
@@ -239,8 +658,12 @@ class StorageQueue(object):
             if not success:
                 self.__failed = True
 
+            started = self.__started.pop(op)
+            if success and op.hedgeable:
+                self.__latencies.record(op.finished - started)
+
             self.__ops.remove(op)
-            self.__cond.notify()
+            self.__cond.notifyAll()
 
     def notify_operation_complete(self, op):
         self.__remove_op(op, True)
@@ -260,7 +683,7 @@ class StorageQueue(object):
     def wait(self):
         '''Wait for all outstanding operations to complete.'''
         with self.__cond:
-            while self.__ops:
+            while self.__ops or self.__gating:
                 self.__cond.wait()
 
         if self.__failed:
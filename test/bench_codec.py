@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2009 Peter Schuller <peter.schuller@infidyne.com>
+
+'''
+Benchmark of the encoding and parsing of (version 1) manifest lines,
+comparing the table driven codec with the previous implementation in
+terms of mode_to_str() and str_to_mode() (reproduced here).
+
+Not part of the test suite. Usage:
+
+  PYTHONPATH=../src python bench_codec.py [number of entries]
+
+The synthetic manifest (10 million entries by default) is generated
+and processed in batches, so that memory use does not depend on its
+size.
+'''
+
+from __future__ import absolute_import
+from __future__ import with_statement
+
+import sys
+import time
+
+import shastity.manifest as manifest
+import shastity.metadata as metadata
+import shastity.spencode as spencode
+
+BATCH = 100000
+
+_modes = [ '-rw-r--r--', '-rwxr-xr-x', 'drwxr-xr-x', '-rw-------', "lrwxrwxrwx" ]
+
+def make_entries(start, count):
+    entries = []
+    for n in xrange(start, start + count):
+        mode = _modes[n % len(_modes)]
+        symlink = (" '../target%d'" % (n,)) if mode[0] == 'l' else ''
+        md = metadata.FileMetaData.from_string('%s 1000 1000 %d 1262300000 %d 1262300000%s'
+                                               % (mode, n * 37, 1262300000 + n, symlink))
+        hashes = [ ('sha512', '%0128x' % (n * 7 + k,)) for k in xrange(0, n % 3) ]
+        entries.append((u'home/user/dir%d/sub%d/file%d.txt' % (n / 1000, n / 100 % 10, n), md, hashes))
+    return entries
+
+def legacy_to_string(md):
+    props = dict([ (prop, getattr(md, prop)) for prop in metadata.FileMetaData.propnames[0:18] ])
+    if md.is_symlink:
+        possible_symlink = ' %s' % (spencode.spencode(md.symlink_value),)
+    else:
+        possible_symlink = ''
+    return ('%(modestring)s %(uid)d %(gid)d %(size)d %(atime)d %(mtime)d %(ctime)d%(possible_symlink)s'
+            '' % dict(modestring=metadata.mode_to_str(props),
+                      uid=md.uid,
+                      gid=md.gid,
+                      size=md.size,
+                      atime=md.atime,
+                      mtime=md.mtime,
+                      ctime=md.ctime,
+                      possible_symlink=possible_symlink))
+
+def legacy_format_line(entry):
+    path, md, hashes = entry
+    rest = ' '.join([ '%s,%s' % (algo, hex) for (algo, hex) in hashes ])
+    return '%s | %s | %s' % (legacy_to_string(md), spencode.spencode(path), rest)
+
+def legacy_from_string(s):
+    comps = s.split()
+    d = metadata.str_to_mode(comps[0])
+    d['uid'] = int(comps[1])
+    d['gid'] = int(comps[2])
+    d['size'] = int(comps[3])
+    d['atime'] = int(comps[4])
+    d['mtime'] = int(comps[5])
+    d['ctime'] = int(comps[6])
+    if d['is_symlink']:
+        d['symlink_value'] = spencode.spdecode(comps[7])
+    return metadata.FileMetaData(d)
+
+def legacy_parse_line(line):
+    (md, path, rest) = [ s.strip() for s in line.split('|') ]
+    md = legacy_from_string(md)
+    path = spencode.spdecode(path)
+    if rest:
+        rest = [ (algo, hex) for (algo, hex) in [ pair.split(',') for pair in rest.split() ] ]
+    else:
+        rest = []
+    return (path, md, rest)
+
+def main(count):
+    codecs = [ ('before', legacy_format_line, legacy_parse_line),
+               ('after', manifest._format_line, manifest._parse_line) ]
+    elapsed = dict([ ((name, op), 0.0) for name, fmt, parse in codecs for op in ('format', 'parse') ])
+
+    for start in xrange(0, count, BATCH):
+        entries = make_entries(start, min(BATCH, count - start))
+        for name, fmt, parse in codecs:
+            t = time.time()
+            lines = [ fmt(entry) for entry in entries ]
+            elapsed[(name, 'format')] += time.time() - t
+
+            t = time.time()
+            parsed = [ parse(line) for line in lines ]
+            elapsed[(name, 'parse')] += time.time() - t
+
+            assert [ (p, md.to_string(), h) for p, md, h in parsed ] == \
+                   [ (p, md.to_string(), h) for p, md, h in entries ]
+
+    print '%d entries' % (count,)
+    for op in ('format', 'parse'):
+        before = count / elapsed[('before', op)]
+        after = count / elapsed[('after', op)]
+        print '%-6s  before: %9.0f lines/s  after: %9.0f lines/s  (%.1fx)' % (op, before, after, after / before)
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000000)
@@ -15,14 +15,24 @@ import unittest
 test_names = [ 'logging',
                'hash',
                'util',
+               'ratelimit',
+               'selection',
                'spencode',
                'metadata',
                'filesystem',
                'backends',
                'storagequeue',
+               'blockcache',
                'traversal',
                'persistence',
+               'metadatapass',
+               'pathindex',
+               'manifest',
+               'columnar',
+               'manifestcache',
+               'refindex',
                'materialization',
+               'commands',
                'config' ]
 
 if __name__ == "__main__":
@@ -12,6 +12,7 @@ import unittest
 
 import shastity.backend as backend
 import shastity.backends.directorybackend as directorybackend
+import shastity.backends.gpgcrypto as gpgcrypto
 import shastity.backends.memorybackend as memorybackend
 import shastity.backends.s3backend as s3backend
 import shastity.logging as logging
@@ -77,6 +78,19 @@ class BackendsBaseCase(object):
         self.assertEqual(self.backend.get(prefix('largetest')), mbyte)
         self.backend.delete(prefix('largetest'))
 
+    def test_get_chunks(self):
+        data = ''.join([ chr(n % 251) for n in xrange(0, 100000) ])
+        self.backend.put(prefix('chunktest'), data)
+        chunks = list(self.backend.get_chunks(prefix('chunktest'), 4096))
+        self.assertEqual(''.join(chunks), data)
+        self.assertTrue(len(chunks) >= 25)
+        self.assertEqual(list(self.backend.get_chunks(prefix('chunktest'), len(data))), [ data ])
+        self.backend.delete(prefix('chunktest'))
+
+        self.backend.put(prefix('chunktest'), '')
+        self.assertEqual(''.join(self.backend.get_chunks(prefix('chunktest'))), '')
+        self.backend.delete(prefix('chunktest'))
+
     def test_long_filename(self):
         lname = 'ldjfajfldjflasdjfklsdjfklasdjfldjfljsdljfasdjfklasdjfklasdjflasdjklfasdjklffweruasfasdfweruwaourweourwepoqurweipoqurqwepourqweiporewr'
         self.backend.put(prefix(lname), 'data')
@@ -111,6 +125,77 @@ class BackendsBaseCase(object):
         self.assertEqual(self.backend.get(prefix(funny_chars)), funny_chars)
         self.assertTrue(prefix(funny_chars) in self.get_testfiles())
 
+class CountingBackend(memorybackend.MemoryBackend):
+    '''Memory backend counting the chunks produced by get_chunks(),
+    and refusing get().'''
+    produced = []
+
+    def get(self, name):
+        raise AssertionError('get() used instead of get_chunks()')
+
+    def get_chunks(self, name, chunk_size=backend.DEFAULT_CHUNK_SIZE):
+        data = memorybackend.MemoryBackend.get(self, name)
+        for offset in xrange(0, len(data), chunk_size):
+            self.produced.append(offset)
+            yield data[offset:offset + chunk_size]
+
+if os.path.exists('/usr/bin/gpg'):
+    class GPGTests(unittest.TestCase):
+        # gpg is slow to start, so only streaming is tested here
+        def setUp(self):
+            self.next = CountingBackend('memory')
+            self.backend = gpgcrypto.DataCryptoGPG(self.next, 'unit test key')
+            del CountingBackend.produced[:]
+
+        def tearDown(self):
+            for name in self.next.list():
+                if name.startswith(PREFIX):
+                    self.next.delete(name)
+
+        def test_get_chunks(self):
+            data = ''.join([ chr(n % 251) for n in xrange(0, 1024 * 1024) ])
+            self.backend.put(prefix('gpgtest'), data)
+            total = len(list(self.next.get_chunks(prefix('gpgtest'), 4096)))
+            del CountingBackend.produced[:]
+
+            # verified: plain text is only produced once the message has
+            # all been read
+            chunks = self.backend.get_chunks(prefix('gpgtest'), 4096)
+            first = chunks.next()
+            self.assertEqual(len(CountingBackend.produced), total)
+            rest = list(chunks)
+            self.assertEqual(first + ''.join(rest), data)
+            self.assertTrue(max([ len(chunk) for chunk in rest ]) <= 4096)
+            del CountingBackend.produced[:]
+
+            # unverified: plain text is produced long before the message
+            # has been read
+            chunks = self.backend.get_unverified_chunks(prefix('gpgtest'), 4096)
+            first = chunks.next()
+            self.assertTrue(len(CountingBackend.produced) < total / 2,
+                            '%d of %d chunks read' % (len(CountingBackend.produced), total))
+            rest = list(chunks)
+            self.assertEqual(first + ''.join(rest), data)
+            self.assertTrue(max([ len(chunk) for chunk in rest ]) <= 4096)
+
+            # stopping early does not hang
+            chunks = self.backend.get_unverified_chunks(prefix('gpgtest'), 4096)
+            chunks.next()
+            chunks.close()
+
+        def test_get_chunks_corrupt(self):
+            self.next.put(prefix('gpgtest'), 'not a gpg message')
+            self.assertRaises(gpgcrypto.GPGError,
+                              lambda: list(self.backend.get_chunks(prefix('gpgtest'))))
+
+            # a message modified near its end yields no plain text at all
+            data = 'x' * (256 * 1024)
+            self.backend.put(prefix('gpgtest'), data)
+            message = self.next.get_chunks(prefix('gpgtest'), len(data) * 2).next()
+            self.next.put(prefix('gpgtest'), message[:-100] + chr(ord(message[-100]) ^ 1) + message[-99:])
+            self.assertRaises(gpgcrypto.GPGError,
+                              lambda: self.backend.get_chunks(prefix('gpgtest'), 4096).next())
+
 class MemoryBackendTests(BackendsBaseCase, unittest.TestCase):
     def make_backend(self):
         return memorybackend.MemoryBackend('memory')
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2009 Peter Schuller <peter.schuller@infidyne.com>
+
+from __future__ import absolute_import
+from __future__ import with_statement
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import shastity.blockcache as blockcache
+import shastity.metadata as metadata
+
+class BlockCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.spooldir = tempfile.mkdtemp(suffix='-shastity_blockcache_unittest')
+        self.loads = []
+
+    def tearDown(self):
+        shutil.rmtree(self.spooldir)
+
+    def loader(self, name, data):
+        def load():
+            self.loads.append(name)
+            return data
+        return load
+
+    def test_count_references(self):
+        md = metadata.FileMetaData.from_string('-rwxr-xr-x 5 6 7 8 9 10')
+        entries = [ ('a', md, [ ('sha512', 'x'), ('sha512', 'y') ]),
+                    ('b', md, [ ('sha512', 'x') ]),
+                    ('c', md, [ ('sha512', 'x'), ('sha512', 'z') ]) ]
+
+        self.assertEqual(blockcache.count_references(entries),
+                         dict(x=3, y=1, z=1))
+        self.assertEqual(blockcache.count_references(entries, lambda path: path != 'c'),
+                         dict(x=2, y=1))
+
+    def test_shared_fetched_once(self):
+        with blockcache.BlockCache(dict(x=3, y=1), spooldir=self.spooldir) as cache:
+            for n in xrange(0, 3):
+                self.assertEqual(cache.get('x', self.loader('x', 'xdata'))[0], 'xdata')
+                cache.release('x')
+            self.assertEqual(cache.get('y', self.loader('y', 'ydata')), ('ydata', False))
+            cache.release('y')
+
+            self.assertEqual(self.loads, [ 'x', 'y' ])
+            self.assertEqual((cache.hits, cache.misses), (2, 2))
+
+            # all references released, so nothing should remain
+            self.assertEqual(cache.get('x', self.loader('x', 'xdata')), ('xdata', False))
+
+    def test_spill_and_drop(self):
+        refcounts = dict(a=5, b=3, c=2)
+        with blockcache.BlockCache(refcounts, max_memory=10, max_disk=10,
+                                   spooldir=self.spooldir) as cache:
+            cache.get('a', self.loader('a', 'a' * 10))
+            cache.get('b', self.loader('b', 'b' * 10)) # spills b to disk
+            self.assertEqual(os.listdir(self.spooldir), [ 'b' ])
+
+            cache.get('c', self.loader('c', 'c' * 10)) # spills c, dropping it from disk
+            self.assertEqual(os.listdir(self.spooldir), [ 'b' ])
+
+            self.assertEqual(cache.get('a', self.loader('a', None)), ('a' * 10, True))
+            self.assertEqual(cache.get('b', self.loader('b', None)), ('b' * 10, True))
+            self.assertEqual(cache.get('c', self.loader('c', 'c' * 10)), ('c' * 10, False))
+
+            for n in xrange(0, 3):
+                cache.release('b')
+            self.assertEqual(os.listdir(self.spooldir), [])
+
+    def test_evict_after_release(self):
+        refcounts = dict(a=3, b=5, c=4)
+        with blockcache.BlockCache(refcounts, max_memory=20, max_disk=0,
+                                   spooldir=self.spooldir) as cache:
+            cache.get('a', self.loader('a', 'a' * 10))
+            cache.get('b', self.loader('b', 'b' * 10))
+            for n in xrange(0, 3):
+                cache.release('b')
+
+            # b now has the fewest remaining references
+            cache.get('c', self.loader('c', 'c' * 10))
+            self.assertEqual(cache.get('a', self.loader('a', None)), ('a' * 10, True))
+            self.assertEqual(cache.get('c', self.loader('c', None)), ('c' * 10, True))
+            self.assertEqual(cache.get('b', self.loader('b', 'b' * 10)), ('b' * 10, False))
+
+    def test_concurrent_load(self):
+        with blockcache.BlockCache(dict(x=10), spooldir=self.spooldir) as cache:
+            def slow_load():
+                time.sleep(0.2)
+                self.loads.append('x')
+                return 'xdata'
+
+            results = []
+            def getter():
+                results.append(cache.get('x', slow_load)[0])
+
+            threads = [ threading.Thread(target=getter) for n in xrange(0, 10) ]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+            self.assertEqual(results, [ 'xdata' ] * 10)
+            self.assertEqual(self.loads, [ 'x' ])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2009 Peter Schuller <peter.schuller@infidyne.com>
+
+from __future__ import absolute_import
+from __future__ import with_statement
+
+import unittest
+
+import shastity.backends.memorybackend as memorybackend
+import shastity.columnar as columnar
+import shastity.manifest as manifest
+import shastity.metadata as md
+import shastity.spencode as spencode
+
+def make_entries(n):
+    entries = [ (u'dir%d/f\xe5il%d' % (m / 10, m),
+                 md.FileMetaData.from_string('-rwsr-x--x %d %d %d %d -%d %d' % (m, m + 1, m * 1000, m, m, m)),
+                 [ ('sha512', '%0128x' % (k,)) for k in xrange(m % 3, m % 3 + m % 4) ])
+                for m in xrange(0, n) ]
+    entries.append((u'dir0', md.FileMetaData.from_string('drwxr-x--T 1 2 0 3 4 5'), [ ('sha512', 'nothex') ]))
+    entries.append((u'link', md.FileMetaData.from_string('lrwxrwxrwx 0 0 0 0 0 0 ' + spencode.spencode(u't\xe5rget')), []))
+    return entries
+
+def comparable(entries):
+    return [ (path, meta.to_string(), hashes) for path, meta, hashes in entries ]
+
+class ColumnarTests(unittest.TestCase):
+    def test_entries(self):
+        entries = make_entries(100)
+        mf = columnar.ColumnarManifest.from_entries(entries)
+
+        self.assertEqual(len(mf), len(entries))
+        self.assertEqual(comparable(mf), comparable(entries))
+        for n in (0, 1, 55, -2, -1):
+            self.assertEqual(comparable([ mf[n] ]), comparable([ entries[n] ]))
+            self.assertEqual(mf.path(n), entries[n][0])
+        self.assertRaises(IndexError, lambda: mf[len(entries)])
+        self.assertTrue(mf.metadata(-1).is_symlink)
+        self.assertEqual(mf.metadata(-1).symlink_value, u't\xe5rget')
+
+        self.assertEqual(comparable(columnar.ColumnarManifest.from_entries([])), [])
+
+    def test_columns(self):
+        entries = make_entries(100)
+        mf = columnar.ColumnarManifest.from_entries(entries)
+
+        self.assertEqual(list(mf.uid), [ meta.uid for path, meta, hashes in entries ])
+        self.assertEqual(list(mf.mtime), [ meta.mtime for path, meta, hashes in entries ])
+        self.assertEqual(mf.total_size(), sum([ meta.size for path, meta, hashes in entries ]))
+        self.assertEqual(mf.block_count(), sum([ len(hashes) for path, meta, hashes in entries ]))
+        self.assertEqual(mf.hash_offsets[-1], mf.block_count())
+        self.assertEqual(mf.blocks(), set([ h for path, meta, hashes in entries for h in hashes ]))
+
+        stats = mf.stats()
+        self.assertEqual((stats.files, stats.blocks, stats.bytes),
+                         (len(entries), mf.block_count(), mf.total_size()))
+
+    def test_load(self):
+        with memorybackend.MemoryBackend('test_columnar') as b:
+            entries = make_entries(100)
+            manifest.write_manifest(b, 'test_manifest', entries, version=2)
+            try:
+                self.assertEqual(comparable(columnar.load(b, 'test_manifest')), comparable(entries))
+            finally:
+                manifest.delete_manifest(b, 'test_manifest')
+
+if __name__ == "__main__":
+    unittest.main()
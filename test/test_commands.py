@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2009 Peter Schuller <peter.schuller@infidyne.com>
+
+from __future__ import absolute_import
+from __future__ import with_statement
+
+import os
+import shutil
+import StringIO
+import sys
+import tempfile
+import unittest
+
+import shastity.backends.directorybackend as directorybackend
+import shastity.cmdline as cmdline
+import shastity.commands as commands
+import shastity.manifest as manifest
+import shastity.metadata as md
+import shastity.refindex as refindex
+
+def block(n):
+    return ('sha512', '%0128x' % (n,))
+
+def make_entries(blocks):
+    return [ (u'f%d' % (n,), md.FileMetaData.from_string('-rw-r--r-- 0 0 1 0 0 0'), [ block(b) ])
+             for n, b in enumerate(blocks) ]
+
+class GarbageCollectTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(suffix='-shastity_commands_unittest')
+        os.mkdir(os.path.join(self.tempdir, 'manifests'))
+        os.mkdir(os.path.join(self.tempdir, 'data'))
+        self.manifests = directorybackend.DirectoryBackend(os.path.join(self.tempdir, 'manifests'))
+        self.data = directorybackend.DirectoryBackend(os.path.join(self.tempdir, 'data'))
+
+        backends = { 'manifests': self.manifests, 'data': self.data }
+        self.get_backend_factory = commands.get_backend_factory
+        commands.get_backend_factory = lambda uri, config: (lambda: backends[uri])
+
+        self.config = cmdline._make_config('garbage-collect')
+        self.config.get_option('manifest-cache-mb').set(0)
+
+    def tearDown(self):
+        commands.get_backend_factory = self.get_backend_factory
+        shutil.rmtree(self.tempdir)
+
+    def blocks(self):
+        return sorted([ int(name, 16) for name in self.data.list() ])
+
+    def test_legacy_manifest(self):
+        for n in xrange(1, 5):
+            self.data.put(block(n)[1], 'block')
+
+        # a manifest with a dotted name, written before dots were
+        # reserved and not accounted for by the index
+        manifest.write_manifest(self.manifests, 'current', make_entries([ 1 ]), segment_size=4096, index=True)
+        refindex.RefcountIndex(self.manifests).sync()
+        manifest.write_manifest(self.manifests, 'backup.2009-01-01', make_entries([ 2, 3 ]))
+
+        self.config.get_option('dry-run').set(True)
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            commands.garbage_collect(self.config, 'manifests,data')
+            printed = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(printed, block(4)[1] + '\n')
+        self.assertEqual(self.blocks(), [ 1, 2, 3, 4 ])
+
+        self.config.get_option('dry-run').set(False)
+        commands.garbage_collect(self.config, 'manifests,data')
+        self.assertEqual(self.blocks(), [ 1, 2, 3 ])
+
+    def test_unexplained_objects(self):
+        for n in xrange(1, 3):
+            self.data.put(block(n)[1], 'block')
+        manifest.write_manifest(self.manifests, 'current', make_entries([ 1 ]))
+
+        # e.g. a segment of a manifest whose root is yet to be written
+        self.manifests.put('next.000000', '')
+        self.assertRaises(commands.CommandError,
+                          lambda: commands.garbage_collect(self.config, 'manifests,data'))
+        self.assertEqual(self.blocks(), [ 1, 2 ])
+
+        self.manifests.delete('next.000000')
+        commands.garbage_collect(self.config, 'manifests,data')
+        self.assertEqual(self.blocks(), [ 1 ])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -10,6 +10,7 @@ import os.path
 import unittest
 
 import shastity.filesystem as fs
+import shastity.metadata as metadata
 
 class FileSystemBaseCase(object):
     def setUp(self):
@@ -84,6 +85,23 @@ class FileSystemBaseCase(object):
 
         self.assertFalse(self.fs.exists(tpath), 'tempdir should be removed')
 
+    def test_attributes(self):
+        with self.fs.tempdir() as tdir:
+            fname = os.path.join(tdir.path, 'file')
+            self.fs.open(fname, 'w').close()
+
+            self.fs.chmod(fname, 0640)
+            self.fs.utime(fname, 1000, 2000)
+
+            md = self.fs.lstat(fname)
+            self.assertEqual(metadata.mode_to_bits(md), 0640)
+            self.assertEqual(md.atime, 1000)
+            self.assertEqual(md.mtime, 2000)
+
+            uid, gid = md.uid, md.gid
+            self.fs.lchown(fname, uid, gid)
+            self.assertEqual((self.fs.lstat(fname).uid, self.fs.lstat(fname).gid), (uid, gid))
+
 class LocalFileSystemTests(FileSystemBaseCase, unittest.TestCase):
     def make_file_system(self):
         return fs.LocalFileSystem()
@@ -13,12 +13,14 @@ import unittest
 
 import shastity.backends.directorybackend as directorybackend
 import shastity.backends.memorybackend as memorybackend
+import shastity.binmanifest as binmanifest
 import shastity.filesystem as fs
 import shastity.hash as hash
 import shastity.logging as logging
 import shastity.manifest as manifest
 import shastity.metadata as md
 import shastity.persistence as persistence
+import shastity.spencode as spencode
 import shastity.storagequeue as storagequeue
 import shastity.traversal as traversal
 
@@ -68,6 +70,353 @@ class ManifestBaseCase(object):
             self.assertEqual([ to_comparable(entry) for entry in entries_in ],
                              [ to_comparable(entry) for entry in entries_out])
 
+    def test_binary(self):
+        with self.make_backend() as b:
+            entries_in = []
+            for n in xrange(0, 100):
+                path = u'dir%d/sub/f\xe5il%d' % (n / 10, n)
+                hashes = [ ('sha512', hash.make_hasher('sha512')(str(m))[1]) for m in xrange(0, n % 4) ]
+                entries_in.append((path, md.FileMetaData.from_string('-rwsr-xr-x 5 6 %d 8 -9 10' % (n,)), hashes))
+            entries_in.append((u'dir0', md.FileMetaData.from_string('drwxr-x--T 1 2 0 3 4 5'), [ ('sha512', 'conte') ]))
+            entries_in.append((u'link', md.FileMetaData.from_string('lrwxrwxrwx 0 0 0 0 0 0 ' + spencode.spencode(u't\xe5rget')), []))
+
+            manifest.write_manifest(b, 'test_manifest', entries_in, version=2)
+            entries_out = list(manifest.read_manifest(b, 'test_manifest'))
+            data = b.get('test_manifest')
+            manifest.delete_manifest(b, 'test_manifest')
+
+            def to_comparable(entry):
+                path, md, algos = entry
+
+                return (path, md.to_string(), algos)
+
+            self.assertEqual([ to_comparable(entry) for entry in entries_in ],
+                             [ to_comparable(entry) for entry in entries_out])
+
+            # random access
+            mf = binmanifest.BinaryManifest(data, data.index('\nend\n') + len('\nend\n'))
+            self.assertEqual(len(mf), len(entries_in))
+            for n in (0, 1, 15, 16, 17, 63, 100, -1):
+                self.assertEqual(to_comparable(entries_in[n]), to_comparable(mf[n]))
+            self.assertRaises(IndexError, lambda: mf[len(entries_in)])
+
+    def test_streaming(self):
+        with self.make_backend() as b:
+            entries_in = [ (u'f%d' % (n,), md.FileMetaData.from_string('-rw-r--r-- 0 0 %d 0 0 0' % (n,)), [])
+                           for n in xrange(0, 1000) ]
+            for version in manifest.FORMAT_VERSIONS:
+                manifest.write_manifest(b, 'test_manifest', entries_in, version=version)
+
+                # parse with chunks cutting through lines and the header
+                chunks = []
+                def get_chunks(name, chunk_size=None):
+                    for chunk in b.get_chunks(name, 7):
+                        chunks.append(chunk)
+                        yield chunk
+                class ChunkingBackend(object):
+                    pass
+                cb = ChunkingBackend()
+                cb.get_chunks = get_chunks
+
+                entries_out = manifest.read_manifest(cb, 'test_manifest')
+                self.assertEqual(entries_out.next()[0], u'f0')
+                if version == 1:
+                    # entries are produced before the download completes
+                    self.assertTrue(len(chunks) * 7 < len(b.get('test_manifest')) / 10)
+                self.assertEqual([ path for path, meta, hashes in entries_out ],
+                                 [ path for path, meta, hashes in entries_in[1:] ])
+
+                manifest.delete_manifest(b, 'test_manifest')
+
+    def test_segmented(self):
+        with self.make_backend() as b:
+            entries_in = [ (u'dir/f%04d' % (n,), md.FileMetaData.from_string('-rw-r--r-- 0 0 %d 0 0 0' % (n,)),
+                            [ ('sha512', '%0128x' % (n,)) ])
+                           for n in xrange(0, 500) ]
+            def to_comparable(entry):
+                path, md, algos = entry
+
+                return (path, md.to_string(), algos)
+
+            for version in manifest.FORMAT_VERSIONS:
+                manifest.write_manifest(b, 'test_manifest', entries_in, version=version, segment_size=4096)
+
+                self.assertEqual(manifest.list_manifests(b), [ 'test_manifest' ])
+                segments = manifest.list_segments(b, 'test_manifest')
+                self.assertTrue(len(segments) > 10)
+                self.assertEqual(sum([ count for name, count, first in segments ]), len(entries_in))
+                self.assertEqual(segments[1][2], entries_in[segments[0][1]][0])
+                for name, count, first in segments:
+                    self.assertTrue(len(b.get(name)) <= 4096)
+
+                for kwargs in (dict(), dict(backend_factory=self.make_backend, prefetch=3)):
+                    entries_out = manifest.read_manifest(b, 'test_manifest', **kwargs)
+                    self.assertEqual([ to_comparable(entry) for entry in entries_in ],
+                                     [ to_comparable(entry) for entry in entries_out ])
+
+                manifest.delete_manifest(b, 'test_manifest')
+                self.assertEqual([ name for name in b.list() if name.startswith('test_manifest') ], [])
+
+            manifest.write_manifest(b, 'test_manifest', entries_in)
+            self.assertEqual(manifest.list_segments(b, 'test_manifest'), None)
+            manifest.delete_manifest(b, 'test_manifest')
+
+    def test_lookup(self):
+        with self.make_backend() as b:
+            entries_in = [ (u'dir%d/f\xe5il%04d' % (n / 100, n), md.FileMetaData.from_string('-rw-r--r-- 0 0 %d 0 0 0' % (n,)),
+                            [ ('sha512', '%0128x' % (n,)) ])
+                           for n in xrange(0, 500) ]
+            wanted = [ entries_in[n][0] for n in (0, 17, 255, 499) ]
+            by_path = dict([ (entry[0], entry) for entry in entries_in ])
+
+            def to_comparable(entry):
+                path, md, algos = entry
+
+                return (path, md.to_string(), algos)
+
+            class CountingBackend(object):
+                def __init__(self):
+                    self.gets = []
+                def get(self, name):
+                    self.gets.append(name)
+                    return b.get(name)
+                def get_chunks(self, name):
+                    self.gets.append(name)
+                    return b.get_chunks(name)
+            cb = CountingBackend()
+
+            for version in manifest.FORMAT_VERSIONS:
+                for segment_size in (None, 4096):
+                    manifest.write_manifest(b, 'test_manifest', entries_in, version=version,
+                                            segment_size=segment_size, index=True)
+                    self.assertEqual(manifest.list_manifests(b), [ 'test_manifest' ])
+                    self.assertTrue(manifest.has_path_index(b, 'test_manifest'))
+
+                    cb.gets = []
+                    found = manifest.lookup(cb, 'test_manifest', wanted + [ u'dir0/missing' ])
+                    self.assertEqual(sorted(found.keys()), wanted)
+                    for path in wanted:
+                        self.assertEqual(to_comparable(found[path]), to_comparable(by_path[path]))
+
+                    # the root, the index and the segments containing the paths
+                    if segment_size is None:
+                        self.assertEqual(len(cb.gets), 2)
+                    else:
+                        ends = []
+                        for name, count, first in manifest.list_segments(b, 'test_manifest'):
+                            ends.append(count + (ends[-1] if ends else 0))
+                        segments = set([ len([ end for end in ends if end <= n ]) for n in (0, 17, 255, 499) ])
+                        self.assertEqual(len(cb.gets), 2 + len(segments))
+
+                    self.assertTrue(manifest.might_contain(b, 'test_manifest', wanted[1]))
+                    self.assertFalse(manifest.might_contain(b, 'test_manifest', u'dir0/missing'))
+
+                    manifest.delete_manifest(b, 'test_manifest')
+                    self.assertEqual([ name for name in b.list() if name.startswith('test_manifest') ], [])
+
+            # without an index, lookup scans the manifest
+            manifest.write_manifest(b, 'test_manifest', entries_in)
+            self.assertFalse(manifest.has_path_index(b, 'test_manifest'))
+            self.assertEqual(sorted(manifest.lookup(b, 'test_manifest', wanted).keys()), wanted)
+            self.assertTrue(manifest.might_contain(b, 'test_manifest', u'dir0/missing'))
+            manifest.delete_manifest(b, 'test_manifest')
+
+    def test_delta(self):
+        with self.make_backend() as b:
+            def make_entry(n, size):
+                return (u'dir%d/f\xe5il%04d' % (n / 100, n), md.FileMetaData.from_string('-rw-r--r-- 0 0 %d 0 0 0' % (size,)),
+                        [ ('sha512', '%0128x' % (size,)) ])
+            def to_comparable(entry):
+                path, md, algos = entry
+
+                return (path, md.to_string(), algos)
+
+            # n -> size; change, remove and add a few entries in each generation
+            sizes = dict([ (n, n) for n in xrange(0, 500) ])
+            generations = []
+            for g in xrange(0, 5):
+                if g > 0:
+                    for n in sizes.keys():
+                        if n % 101 == g:
+                            del sizes[n]
+                        elif n % 97 == 0:
+                            sizes[n] += g
+                    sizes[500 + g] = g
+                generations.append(sorted([ make_entry(n, size) for n, size in sizes.iteritems() ],
+                                          key=lambda entry: entry[0].split('/')))
+
+            manifest.write_manifest(b, 'gen0', generations[0], index=True)
+            for g in xrange(1, 5):
+                manifest.write_manifest(b, 'gen%d' % (g,), generations[g], parent='gen%d' % (g - 1,), max_depth=2)
+
+            depths = [ manifest._open(b.get_chunks('gen%d' % (g,)))[1]['depth'] for g in xrange(0, 5) ]
+            self.assertEqual(depths, [ 0, 1, 2, 0, 1 ])
+            self.assertTrue(len(b.get('gen1')) < len(b.get('gen0')) / 10)
+
+            for g in xrange(0, 5):
+                self.assertEqual([ to_comparable(entry) for entry in generations[g] ],
+                                 [ to_comparable(entry) for entry in manifest.read_manifest(b, 'gen%d' % (g,)) ])
+
+            # lookups through the chain
+            wanted = [ make_entry(n, 0)[0] for n in (0, 101, 102, 501) ]
+            found = manifest.lookup(b, 'gen2', wanted)
+            by_path = dict([ (entry[0], entry) for entry in generations[2] ])
+            self.assertEqual(sorted(found.keys()), sorted([ p for p in wanted if p in by_path ]))
+            for path, entry in found.iteritems():
+                self.assertEqual(to_comparable(entry), to_comparable(by_path[path]))
+            self.assertTrue(manifest.has_path_index(b, 'gen2'))
+            self.assertFalse(manifest.might_contain(b, 'gen2', make_entry(102, 0)[0])) # removed in gen1
+            self.assertTrue(manifest.might_contain(b, 'gen2', make_entry(501, 0)[0]))
+            self.assertFalse(manifest.might_contain(b, 'gen2', u'dir0/missing'))
+
+            # parents cannot be deleted
+            self.assertEqual(manifest.dependents(b, 'gen1'), [ 'gen2' ])
+            self.assertRaises(manifest.ManifestError, manifest.delete_manifest, b, 'gen1')
+            self.assertRaises(manifest.ManifestError, manifest.write_manifest, b, 'gen4', generations[4], parent='gen4')
+
+            # entries out of order cannot be diffed
+            self.assertRaises(manifest.ManifestError, manifest.write_manifest, b, 'gen5', reversed(generations[4]), parent='gen4')
+
+            for g in (4, 3, 2, 1, 0):
+                manifest.delete_manifest(b, 'gen%d' % (g,))
+            self.assertEqual(b.list(), [])
+
+    def test_stats(self):
+        with self.make_backend() as b:
+            entries_in = [ (u'dir/f%04d' % (n,), md.FileMetaData.from_string('-rw-r--r-- 0 0 %d 0 0 0' % (n,)),
+                            [ ('sha512', '%0128x' % (m,)) for m in xrange(0, n % 3) ])
+                           for n in xrange(0, 500) ]
+            expected = (500, sum([ n % 3 for n in xrange(0, 500) ]), sum(xrange(0, 500)))
+
+            def stats_of(name):
+                stats = manifest.read_stats(b, name)
+                return (stats.files, stats.blocks, stats.bytes, stats.new_blocks)
+
+            for version in manifest.FORMAT_VERSIONS:
+                for segment_size in (None, 4096):
+                    manifest.write_manifest(b, 'test_manifest', entries_in, version=version,
+                                            segment_size=segment_size, new_blocks=lambda: 17)
+                    self.assertEqual(stats_of('test_manifest'), expected + (17,))
+                    self.assertEqual(len(list(manifest.read_manifest(b, 'test_manifest'))), 500)
+
+            manifest.write_manifest(b, 'test_delta', entries_in[1:], parent='test_manifest')
+            self.assertEqual(stats_of('test_delta'), (499, expected[1], expected[2], None))
+            manifest.delete_manifest(b, 'test_delta')
+            manifest.delete_manifest(b, 'test_manifest')
+
+            # identifiers change whenever a manifest is written
+            ids = set()
+            for n in xrange(0, 3):
+                manifest.write_manifest(b, 'test_manifest', entries_in)
+                ids.add(manifest.read_id(b, 'test_manifest'))
+            self.assertEqual(len(ids), 3)
+            self.assertFalse(None in ids)
+
+            # and are known from the listing alone
+            ident = manifest.read_id(b, 'test_manifest')
+            self.assertEqual(manifest.list_ids(b), { 'test_manifest': [ ident ] })
+            manifest.write_manifest(b, 'test_delta', entries_in[1:], parent='test_manifest')
+            self.assertEqual(manifest.list_ids(b)['test_delta'],
+                             [ manifest.read_id(b, 'test_delta').split('/')[0] ])
+            self.assertEqual(manifest.read_chain(b, 'test_delta'), [ 'test_delta', 'test_manifest' ])
+            manifest.delete_manifest(b, 'test_delta')
+            # an interrupted write leaves both identifiers
+            b.put(manifest.id_name('test_manifest', '0' * 32), '')
+            self.assertEqual(manifest.list_ids(b), { 'test_manifest': sorted([ '0' * 32, ident ]) })
+            manifest.delete_manifest(b, 'test_manifest')
+            self.assertEqual(b.list(), [])
+
+            # manifests predating statistics (and identifiers)
+            b.put('test_manifest', manifest._encode(entries_in, 1))
+            self.assertEqual(manifest.read_stats(b, 'test_manifest'), None)
+            self.assertEqual(manifest.read_id(b, 'test_manifest'), None)
+            stats = manifest.ManifestStats.for_entries(manifest.read_manifest(b, 'test_manifest'))
+            self.assertEqual((stats.files, stats.blocks, stats.bytes), expected)
+            manifest.delete_manifest(b, 'test_manifest')
+
+    def test_names(self):
+        with self.make_backend() as b:
+            entries_in = [ (u'dir/f%04d' % (n,), md.FileMetaData.from_string('-rw-r--r-- 0 0 %d 0 0 0' % (n,)),
+                            [ ('sha512', '%0128x' % (n,)) ])
+                           for n in xrange(0, 500) ]
+
+            # dotted names that are not derived from manifests are manifests
+            for name in ('legacy.2009-01-01', 'refcount', 'x.index.old', 'x.12345'):
+                manifest.write_manifest(b, name, entries_in[:10])
+                self.assertEqual(manifest.list_manifests(b), [ name ])
+                self.assertEqual(len(list(manifest.read_manifest(b, name))), 10)
+                manifest.delete_manifest(b, name)
+                self.assertEqual(b.list(), [])
+
+            for name in ('x.000001', 'x.index', 'x.bloom', 'x.blocks', 'x.id-' + '0' * 32,
+                         'refcount.manifests', 'refcount.07'):
+                self.assertTrue(manifest.is_derived_name(name))
+                self.assertRaises(manifest.ManifestError,
+                                  lambda: manifest.write_manifest(b, name, entries_in))
+                self.assertRaises(manifest.ManifestError, lambda: manifest.read_stats(b, name))
+            manifest.write_manifest(b, 'test_manifest', entries_in)
+            self.assertRaises(manifest.ManifestError,
+                              lambda: manifest.write_manifest(b, 'test_delta', entries_in, parent='x.index'))
+            manifest.delete_manifest(b, 'test_manifest')
+
+            # replacing a manifest leaves none of its derived objects behind
+            manifest.write_manifest(b, 'test_manifest', entries_in, segment_size=4096, index=True)
+            manifest.write_manifest(b, 'test_manifest', entries_in[:50], segment_size=4096)
+            ident = manifest.read_id(b, 'test_manifest')
+            self.assertEqual(sorted(b.list()),
+                             sorted([ 'test_manifest', manifest.id_name('test_manifest', ident) ] +
+                                    [ name for name, count, first
+                                      in manifest.list_segments(b, 'test_manifest') ]))
+            manifest.write_manifest(b, 'test_manifest', entries_in)
+            ident = manifest.read_id(b, 'test_manifest')
+            self.assertEqual(sorted(b.list()), [ 'test_manifest', manifest.id_name('test_manifest', ident) ])
+            self.assertEqual(len(list(manifest.read_manifest(b, 'test_manifest'))), 500)
+            manifest.delete_manifest(b, 'test_manifest')
+
+    def test_empty(self):
+        with self.make_backend() as b:
+            for version in manifest.FORMAT_VERSIONS:
+                for segment_size in (None, 4096):
+                    manifest.write_manifest(b, 'test_manifest', [], version=version, segment_size=segment_size)
+                    self.assertEqual(list(manifest.read_manifest(b, 'test_manifest')), [])
+                    manifest.delete_manifest(b, 'test_manifest')
+
+class BinaryManifestTests(unittest.TestCase):
+    def entries(self):
+        return [ (u'dir/f\xe5il%d' % (n,), md.FileMetaData.from_string('-rw-r--r-- 0 0 %d 0 0 0' % (n,)),
+                  [ ('sha512', '%08x' % (n,)), ('sha512', 'nothex') ])
+                 for n in xrange(0, 20) ] + \
+               [ (u'link', md.FileMetaData.from_string('lrwxrwxrwx 0 0 0 0 0 0 ' + spencode.spencode(u't\xe5rget')), []) ]
+
+    def decode(self, data):
+        '''Decode data both sequentially and randomly, expecting either
+        success or BinaryManifestError.'''
+        try:
+            mf = binmanifest.BinaryManifest(data)
+            list(mf)
+            for n in (0, 17, len(mf) - 1):
+                mf[n]
+        except binmanifest.BinaryManifestError:
+            return False
+        return True
+
+    def test_truncated(self):
+        data = binmanifest.encode(self.entries())
+        self.assertTrue(self.decode(data))
+        for n in xrange(0, len(data)):
+            self.assertFalse(self.decode(data[0:n]))
+
+        # records cut short, the rest intact
+        algo_offset = binmanifest._FOOTER.unpack(data[-binmanifest._FOOTER.size:])[0]
+        for n in xrange(0, algo_offset):
+            self.assertFalse(self.decode(data[0:n] + '\xff' * (algo_offset - n) + data[algo_offset:]))
+
+    def test_corrupt(self):
+        data = binmanifest.encode(self.entries())
+        for n in xrange(0, len(data)):
+            for byte in ('\x00', '\x7f', '\xff'):
+                self.decode(data[0:n] + byte + data[n + 1:]) # only BinaryManifestError is raised
+
 class MemoryTests(ManifestBaseCase, unittest.TestCase):
     def make_file_system(self):
         return fs.MemoryFileSystem()
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2009 Peter Schuller <peter.schuller@infidyne.com>
+
+from __future__ import absolute_import
+from __future__ import with_statement
+
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+
+import shastity.backends.directorybackend as directorybackend
+import shastity.manifest as manifest
+import shastity.manifestcache as manifestcache
+import shastity.metadata as md
+
+def make_entries(n):
+    return [ (u'f\xe5%d' % (m,), md.FileMetaData.from_string('-rw-r--r-- 1 2 %d 3 4 5' % (m,)),
+              [ ('sha512', '%0128x' % (m,)), ('sha512', 'nothex') ])
+             for m in xrange(0, n) ]
+
+def get_all(cache, backend):
+    return [ (name, cache.get(backend, name)) for name in manifest.list_manifests(backend) ]
+
+def comparable(entries):
+    return [ (path, meta.to_string(), hashes) for path, meta, hashes in entries ]
+
+class ReadCountingBackend(object):
+    '''Passes calls on to a backend, recording the names of the objects
+    read.'''
+    def __init__(self, backend):
+        self.backend = backend
+        self.reads = []
+
+    def get(self, name):
+        self.reads.append(name)
+        return self.backend.get(name)
+
+    def get_chunks(self, name):
+        self.reads.append(name)
+        return self.backend.get_chunks(name)
+
+    def __getattr__(self, attr):
+        return getattr(self.backend, attr)
+
+class ManifestCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(suffix='-shastity_manifestcache_unittest')
+        self.cachedir = os.path.join(self.tempdir, 'cache')
+        os.mkdir(os.path.join(self.tempdir, 'backend'))
+        self.backend = directorybackend.DirectoryBackend(os.path.join(self.tempdir, 'backend'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def cached_files(self):
+        return sorted([ fname for fname in os.listdir(self.cachedir) if fname.endswith('.mf') ])
+
+    def test_basic(self):
+        manifest.write_manifest(self.backend, 'one', make_entries(10))
+        manifest.write_manifest(self.backend, 'two', make_entries(20), segment_size=512)
+
+        cache = manifestcache.ManifestCache(self.cachedir, 'uri')
+        mfs = dict(get_all(cache, self.backend))
+        self.assertEqual((cache.hits, cache.misses), (0, 2))
+        self.assertEqual(comparable(mfs['one']), comparable(make_entries(10)))
+        self.assertEqual(comparable(mfs['two']), comparable(make_entries(20)))
+
+        # validated by the listing alone
+        counting = ReadCountingBackend(self.backend)
+        cache = manifestcache.ManifestCache(self.cachedir, 'uri')
+        mfs = dict(get_all(cache, counting))
+        self.assertEqual((cache.hits, cache.misses), (2, 0))
+        self.assertEqual(counting.reads, [])
+        self.assertEqual(comparable(mfs['two']), comparable(make_entries(20)))
+
+        # other backends do not share entries
+        other = manifestcache.ManifestCache(self.cachedir, 'other-uri')
+        other.get(self.backend, 'one')
+        self.assertEqual((other.hits, other.misses), (0, 1))
+        self.assertEqual(len(self.cached_files()), 3)
+
+        # deleted manifests are dropped, only for the backend listed
+        manifest.delete_manifest(self.backend, 'two')
+        cache = manifestcache.ManifestCache(self.cachedir, 'uri')
+        self.assertEqual([ name for name, entries in get_all(cache, self.backend) ], [ 'one' ])
+        self.assertEqual(len(self.cached_files()), 2)
+        other.get(self.backend, 'one')
+        self.assertEqual(other.hits, 1)
+
+    def test_rewritten(self):
+        manifest.write_manifest(self.backend, 'one', make_entries(10))
+        manifest.write_manifest(self.backend, 'two', make_entries(10)[1:], parent='one')
+        cache = manifestcache.ManifestCache(self.cachedir, 'uri')
+        get_all(cache, self.backend)
+
+        # the same name, rewritten, is not served from the cache; nor are
+        # deltas against it
+        manifest.write_manifest(self.backend, 'one', make_entries(5))
+        cache = manifestcache.ManifestCache(self.cachedir, 'uri')
+        mfs = dict(get_all(cache, self.backend))
+        self.assertEqual((cache.hits, cache.misses), (0, 2))
+        self.assertEqual(comparable(mfs['one']), comparable(make_entries(5)))
+        self.assertEqual(comparable(mfs['two']), comparable(make_entries(5)[1:]))
+        get_all(cache, self.backend)
+        self.assertEqual(cache.hits, 2)
+
+        # manifests predating identifiers are assumed unchanged
+        self.backend.put('old', manifest._encode(make_entries(5), 1))
+        cache = manifestcache.ManifestCache(self.cachedir, 'uri')
+        cache.get(self.backend, 'old')
+        self.assertEqual(len(cache.get(self.backend, 'old')), 5)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_corrupt(self):
+        manifest.write_manifest(self.backend, 'one', make_entries(10))
+        cache = manifestcache.ManifestCache(self.cachedir, 'uri')
+        cache.get(self.backend, 'one')
+
+        path = os.path.join(self.cachedir, self.cached_files()[0])
+        with open(path, 'r+b') as f:
+            f.truncate(os.path.getsize(path) - 1)
+
+        self.assertEqual(comparable(cache.get(self.backend, 'one')), comparable(make_entries(10)))
+        self.assertEqual((cache.hits, cache.misses), (0, 2))
+        self.assertEqual(comparable(cache.get(self.backend, 'one')), comparable(make_entries(10)))
+        self.assertEqual(cache.hits, 1)
+
+    def test_eviction(self):
+        for n in xrange(0, 5):
+            manifest.write_manifest(self.backend, 'm%d' % (n,), make_entries(50))
+
+        cache = manifestcache.ManifestCache(self.cachedir, 'uri')
+        cache.get(self.backend, 'm0')
+        size = os.path.getsize(os.path.join(self.cachedir, self.cached_files()[0]))
+
+        cache = manifestcache.ManifestCache(self.cachedir, 'uri', max_bytes=size * 3)
+        os.utime(os.path.join(self.cachedir, self.cached_files()[0]), (0, 0))
+        get_all(cache, self.backend)
+        self.assertEqual(len(self.cached_files()), 3)
+
+if __name__ == "__main__":
+    unittest.main()
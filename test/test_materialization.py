@@ -5,12 +5,17 @@
 from __future__ import absolute_import
 from __future__ import with_statement
 
+import StringIO
 import errno
 import os.path
 import shutil
+import tarfile
 import tempfile
+import threading
+import time
 import unittest
 
+import shastity.blockcache as blockcache
 import shastity.backends.directorybackend as directorybackend
 import shastity.backends.memorybackend as memorybackend
 import shastity.filesystem as fs
@@ -19,6 +24,7 @@ import shastity.logging as logging
 import shastity.materialization as materialization
 import shastity.metadata as md
 import shastity.persistence as persistence
+import shastity.spencode as spencode
 import shastity.storagequeue as storagequeue
 import shastity.traversal as traversal
 
@@ -26,6 +32,22 @@ log = logging.get_logger(__name__)
 
 CONCURRENCY = 10
 
+class CountingStorageQueue(object):
+    '''Passes operations on to a storage queue, recording the names
+    of those enqueued.'''
+    def __init__(self, sq):
+        self.sq = sq
+        self.gets = []
+        self.ops = []
+
+    def enqueue(self, op):
+        self.gets.append(op.name)
+        self.sq.enqueue(op)
+        self.ops.append(op)
+
+    def wait(self):
+        self.sq.wait()
+
 class MaterializationBaseCase(object):
     def setUp(self):
         self.tempdir = tempfile.mkdtemp(suffix='-shastity_directory_backend_unittest')
@@ -35,6 +57,11 @@ class MaterializationBaseCase(object):
         self.backend = self.make_backend() # provided by subclass
 
     def tearDown(self):
+        # the memory backend is shared between instances; clean up for
+        # the benefit of tests counting blocks
+        for fname in self.backend.list():
+            self.backend.delete(fname)
+
         shutil.rmtree(self.tempdir)
 
     def path(self, base, p):
@@ -98,6 +125,467 @@ class MaterializationBaseCase(object):
 
                     rec(tdir.path, rdir.path)
 
+    def populate(self, base):
+        '''Populate a tree with a mix of file sizes, including files
+        whose size is not a multiple of the block size.'''
+        self.fs.mkdir(self.path(base, 'dir'))
+        self.fs.mkdir(self.path(base, 'dir/subdir'))
+        self.fs.open(self.path(base, 'dir/empty'), 'w').close()
+        for name, size in [ ('dir/small', 5),
+                            ('dir/exact', 40),
+                            ('dir/subdir/large', 1234),
+                            ('top', 21) ]:
+            with self.fs.open(self.path(base, name), 'w') as f:
+                f.write(''.join([ chr(ord('a') + (n * 7 + size) % 26) for n in xrange(0, size) ]))
+
+    def persist(self, sq, base, blocksize=20):
+        return [ elt for elt in persistence.persist(self.fs,
+                                                    traversal.traverse(self.fs, base),
+                                                    None,
+                                                    base,
+                                                    sq,
+                                                    blocksize=blocksize) ]
+
+    def read(self, fname):
+        with self.fs.open(fname, 'r') as f:
+            return f.read()
+
+    def assertSameTree(self, refdir, tstdir):
+        '''Recursively compare listings and regular file contents.'''
+        reflst = sorted(self.fs.listdir(refdir))
+        tstlst = sorted(self.fs.listdir(tstdir))
+
+        self.assertEqual(tstlst, reflst)
+
+        for entry in reflst:
+            refpath = os.path.join(refdir, entry)
+            tstpath = os.path.join(tstdir, entry)
+            if self.fs.is_symlink(refpath):
+                pass
+            elif self.fs.is_dir(refpath):
+                self.assertSameTree(refpath, tstpath)
+            else:
+                self.assertEqual(self.read(tstpath), self.read(refpath))
+
+    def test_positional(self):
+        with storagequeue.StorageQueue(lambda: self.make_backend(), CONCURRENCY) as sq:
+            with self.fs.tempdir() as tdir:
+                self.populate(tdir.path)
+                manifest = self.persist(sq, tdir.path)
+
+                with self.fs.tempdir() as rdir:
+                    materialization.materialize(self.fs, rdir.path, manifest, sq,
+                                                positional=True, blocksize=20)
+                    self.assertSameTree(tdir.path, rdir.path)
+
+                # a block size not matching the manifest falls back to
+                # sequential writes
+                with self.fs.tempdir() as rdir:
+                    materialization.materialize(self.fs, rdir.path, manifest, sq,
+                                                positional=True, blocksize=7)
+                    self.assertSameTree(tdir.path, rdir.path)
+
+    def test_sync_policies(self):
+        with storagequeue.StorageQueue(lambda: self.make_backend(), CONCURRENCY) as sq:
+            with self.fs.tempdir() as tdir:
+                self.populate(tdir.path)
+                manifest = self.persist(sq, tdir.path)
+
+                for name in ('file', 'batch', 'syncfs', 'none'):
+                    for positional in (False, True):
+                        if name == 'batch':
+                            # small enough for batches to fill up mid-way
+                            policy = materialization.BatchedSync(max_files=2, max_bytes=1024)
+                        else:
+                            policy = materialization.make_sync_policy(name)
+                        with self.fs.tempdir() as rdir:
+                            materialization.materialize(self.fs, rdir.path, manifest, sq,
+                                                        positional=positional, blocksize=20,
+                                                        sync_policy=policy)
+                            # also verifies that no temporary names remain
+                            self.assertSameTree(tdir.path, rdir.path)
+
+        self.assertRaises(ValueError, lambda: materialization.make_sync_policy('sometimes'))
+
+    def test_selective(self):
+        with storagequeue.StorageQueue(lambda: self.make_backend(), CONCURRENCY) as sq:
+            with self.fs.tempdir() as tdir:
+                self.populate(tdir.path)
+                manifest = self.persist(sq, tdir.path)
+
+                with self.fs.tempdir() as rdir:
+                    materialization.materialize(self.fs, rdir.path, manifest, sq,
+                                                files=[ 'dir/subdir', 'dir/s*l', 'to' ])
+                    self.assertEqual(sorted(self.fs.listdir(rdir.path)), [ 'dir' ])
+                    self.assertEqual(sorted(self.fs.listdir(self.path(rdir.path, 'dir'))),
+                                     [ 'small', 'subdir' ])
+                    self.assertSameTree(self.path(tdir.path, 'dir/subdir'),
+                                        self.path(rdir.path, 'dir/subdir'))
+                    self.assertEqual(self.read(self.path(rdir.path, 'dir/small')),
+                                     self.read(self.path(tdir.path, 'dir/small')))
+
+    def test_delta(self):
+        with storagequeue.StorageQueue(lambda: self.make_backend(), CONCURRENCY) as sq:
+            with self.fs.tempdir() as tdir:
+                self.populate(tdir.path)
+                manifest = self.persist(sq, tdir.path)
+
+                with self.fs.tempdir() as rdir:
+                    materialization.materialize(self.fs, rdir.path, manifest, sq)
+
+                    # make the replica stale: modify a block in the middle,
+                    # shrink one file, extend another and remove a third
+                    with self.fs.open(self.path(rdir.path, 'dir/subdir/large'), 'r+') as f:
+                        self.fs.pwrite(f, 105, 'XXXXX')
+                    with self.fs.open(self.path(rdir.path, 'dir/exact'), 'r+') as f:
+                        f.truncate(30)
+                    with self.fs.open(self.path(rdir.path, 'top'), 'a') as f:
+                        f.write('trailing garbage')
+                    self.fs.unlink(self.path(rdir.path, 'dir/small'))
+
+                    csq = CountingStorageQueue(sq)
+
+                    materialization.materialize(self.fs, rdir.path, manifest, csq,
+                                                blocksize=20, delta=True, hash_threads=2)
+                    self.assertSameTree(tdir.path, rdir.path)
+
+                    # one block each of large, exact (the truncated one), top
+                    # (the extended one) and small
+                    self.assertEqual(len(csq.gets), 4)
+
+    def test_delta_in_the_way(self):
+        with storagequeue.StorageQueue(lambda: self.make_backend(), CONCURRENCY) as sq:
+            with self.fs.tempdir() as tdir:
+                self.populate(tdir.path)
+                manifest = self.persist(sq, tdir.path)
+
+                with self.fs.tempdir() as rdir:
+                    with self.fs.tempdir() as odir:
+                        outside = self.path(odir.path, 'outside')
+                        with self.fs.open(outside, 'w') as f:
+                            f.write('outside the destination')
+
+                        materialization.materialize(self.fs, rdir.path, manifest, sq)
+
+                        # a symlink where a file belongs is replaced, not followed
+                        self.fs.unlink(self.path(rdir.path, 'top'))
+                        self.fs.symlink(outside, self.path(rdir.path, 'top'))
+
+                        # a read-only file is updated, and left read-only
+                        large = self.path(rdir.path, 'dir/subdir/large')
+                        with self.fs.open(large, 'r+') as f:
+                            self.fs.pwrite(f, 105, 'XXXXX')
+                        self.fs.chmod(large, 0444)
+
+                        for positional in (False, True):
+                            materialization.materialize(self.fs, rdir.path, manifest, sq, positional=positional,
+                                                        blocksize=20, delta=True, hash_threads=2)
+                            self.assertSameTree(tdir.path, rdir.path)
+                            self.assertFalse(self.fs.is_symlink(self.path(rdir.path, 'top')))
+                            self.assertEqual(self.read(outside), 'outside the destination')
+                            self.assertEqual(md.mode_to_bits(self.fs.lstat(large)), 0444)
+
+    def test_sparse(self):
+        with storagequeue.StorageQueue(lambda: self.make_backend(), CONCURRENCY) as sq:
+            with self.fs.tempdir() as tdir:
+                self.populate(tdir.path)
+                with self.fs.open(self.path(tdir.path, 'dir/sparse'), 'w') as f:
+                    f.write('a' * 20 + '\0' * 60 + 'b' * 20 + '\0' * 15)
+                with self.fs.open(self.path(tdir.path, 'dir/zeros'), 'w') as f:
+                    f.write('\0' * 50)
+                manifest = self.persist(sq, tdir.path)
+
+                csq = CountingStorageQueue(sq)
+
+                for positional in (False, True):
+                    with self.fs.tempdir() as rdir:
+                        del csq.gets[:]
+                        materialization.materialize(self.fs, rdir.path, manifest, csq,
+                                                    positional=positional, blocksize=20, sparse=True)
+                        self.assertSameTree(tdir.path, rdir.path)
+                        # zero blocks are known from their hashes, and not fetched
+                        self.assertEqual(len(csq.gets), 62 + 2 + 1 + 2 + 2)
+
+                # without the block size, zero blocks are recognized on receipt
+                with self.fs.tempdir() as rdir:
+                    materialization.materialize(self.fs, rdir.path, manifest, sq, sparse=True)
+                    self.assertSameTree(tdir.path, rdir.path)
+
+                # zeroing parts of an existing file
+                with self.fs.tempdir() as rdir:
+                    materialization.materialize(self.fs, rdir.path, manifest, sq)
+                    with self.fs.open(self.path(rdir.path, 'dir/sparse'), 'r+') as f:
+                        self.fs.pwrite(f, 30, 'x' * 40)
+                    materialization.materialize(self.fs, rdir.path, manifest, sq,
+                                                blocksize=20, delta=True, sparse=True)
+                    self.assertSameTree(tdir.path, rdir.path)
+
+        self.assertTrue(materialization.is_zero('\0' * 10))
+        self.assertFalse(materialization.is_zero('\0' * 10 + 'a'))
+
+    def test_apply_metadata(self):
+        with storagequeue.StorageQueue(lambda: self.make_backend(), CONCURRENCY) as sq:
+            with self.fs.tempdir() as tdir:
+                self.populate(tdir.path)
+                self.fs.symlink('small', self.path(tdir.path, 'dir/link'))
+                for name, bits, mtime in [ ('dir', 0750, 1000),
+                                           ('dir/subdir', 0700, 2000),
+                                           ('dir/small', 0600, 3000),
+                                           ('top', 0755, 4000) ]:
+                    self.fs.chmod(self.path(tdir.path, name), bits)
+                    self.fs.utime(self.path(tdir.path, name), mtime, mtime)
+                manifest = self.persist(sq, tdir.path)
+
+                with self.fs.tempdir() as rdir:
+                    materialization.materialize(self.fs, rdir.path, manifest, sq,
+                                                apply_metadata=True, metadata_threads=2)
+                    self.assertSameTree(tdir.path, rdir.path)
+
+                    self.assertTrue(self.fs.is_symlink(self.path(rdir.path, 'dir/link')))
+                    for path, meta, hashes in manifest:
+                        if meta.is_symlink:
+                            continue
+                        got = self.fs.lstat(self.path(rdir.path, path))
+                        self.assertEqual(md.mode_to_bits(got), md.mode_to_bits(meta))
+                        self.assertEqual(got.mtime, meta.mtime)
+
+    def test_resume(self):
+        with storagequeue.StorageQueue(lambda: self.make_backend(), CONCURRENCY) as sq:
+            with self.fs.tempdir() as tdir:
+                self.populate(tdir.path)
+                manifest = self.persist(sq, tdir.path)
+
+                csq = CountingStorageQueue(sq)
+
+                with self.fs.tempdir() as rdir:
+                    jpath = self.path(rdir.path, materialization.JOURNAL_NAME)
+
+                    journal = materialization.RestoreJournal(self.fs, jpath)
+                    materialization.materialize(self.fs, rdir.path, manifest, sq, journal=journal)
+                    journal.close()
+
+                    # all files were recorded
+                    journal = materialization.RestoreJournal(self.fs, jpath, resume=True)
+                    for name in ('dir/empty', 'dir/small', 'dir/exact', 'dir/subdir/large', 'top'):
+                        self.assertTrue(journal.is_complete(self.path(rdir.path, name)), name)
+                    journal.close()
+
+                    # simulate an interruption in the middle of large, by
+                    # truncating it and forgetting it (and top) in the journal;
+                    # top is left at its final size, but with stale contents
+                    # (as by an interrupted in-place update), and a partial
+                    # file is left behind
+                    with self.fs.open(jpath, 'w') as f:
+                        f.write(spencode.spencode(self.path(rdir.path, 'dir/small')) + '\n')
+                        f.write(spencode.spencode(self.path(rdir.path, 'dir/exact')) + '\n')
+                        f.write("'torn")
+                    with self.fs.open(self.path(rdir.path, 'dir/subdir/large'), 'r+') as f:
+                        f.truncate(510)
+                    with self.fs.open(self.path(rdir.path, 'top'), 'r+') as f:
+                        f.write('X')
+                    partial = materialization.partial_path(self.path(rdir.path, 'dir/exact'))
+                    with self.fs.open(partial, 'w') as f:
+                        f.write('partial')
+
+                    # files not in the journal are hash-checked; large
+                    # continues from its last complete block
+                    journal = materialization.RestoreJournal(self.fs, jpath, resume=True)
+                    materialization.materialize(self.fs, rdir.path, manifest, csq,
+                                                blocksize=20, journal=journal, resume=True)
+                    journal.close()
+                    self.assertEqual(len(csq.gets), 62 - 25 + 1)
+                    for name in ('dir/subdir/large', 'top'):
+                        self.assertEqual(self.read(self.path(rdir.path, name)),
+                                         self.read(self.path(tdir.path, name)))
+                    self.assertFalse(self.fs.exists(partial))
+
+                    # with verification, even files in the journal are checked
+                    del csq.gets[:]
+                    with self.fs.open(self.path(rdir.path, 'dir/subdir/large'), 'r+') as f:
+                        self.fs.pwrite(f, 105, 'XXXXX')
+                    journal = materialization.RestoreJournal(self.fs, jpath, resume=True)
+                    self.assertTrue(journal.is_complete(self.path(rdir.path, 'dir/subdir/large')))
+                    materialization.materialize(self.fs, rdir.path, manifest, csq,
+                                                blocksize=20, journal=journal, resume=True, verify=True)
+                    journal.close(remove=True)
+                    self.assertEqual(len(csq.gets), 1)
+                    self.assertSameTree(tdir.path, rdir.path)
+
+    def test_extract_range(self):
+        with storagequeue.StorageQueue(lambda: self.make_backend(), CONCURRENCY) as sq:
+            with self.fs.tempdir() as tdir:
+                self.populate(tdir.path)
+                manifest = self.persist(sq, tdir.path)
+                contents = self.read(self.path(tdir.path, 'dir/subdir/large'))
+
+                csq = CountingStorageQueue(sq)
+
+                for offset, length, blocks in [ (0, 1234, 62),
+                                                (0, None, 62),
+                                                (0, 20, 1),
+                                                (15, 10, 2),
+                                                (100, 200, 10),
+                                                (1230, 100, 1),
+                                                (1234, 10, 0),
+                                                (5000, 10, 0) ]:
+                    del csq.gets[:]
+                    out = StringIO.StringIO()
+                    written = materialization.extract_range(manifest, 'dir/subdir/large',
+                                                            csq, out, 20,
+                                                            offset=offset, length=length)
+                    end = len(contents) if length is None else offset + length
+                    self.assertEqual(out.getvalue(), contents[offset:end])
+                    self.assertEqual(written, len(out.getvalue()))
+                    self.assertEqual(len(csq.gets), blocks)
+
+                # paths are normalized, and match whether unicode or UTF-8
+                # encoded, as do the paths of the entries
+                with self.fs.open(self.path(tdir.path, 'dir/sm\xc3\xa5ll'), 'w') as f:
+                    f.write('non-ascii')
+                manifest = self.persist(sq, tdir.path)
+                decoded = [ (path.decode('utf-8'), meta, hashes) for path, meta, hashes in manifest ]
+                for entries in (manifest, decoded):
+                    for path in ('dir/sm\xc3\xa5ll', u'/dir/./sm\xe5ll'):
+                        out = StringIO.StringIO()
+                        materialization.extract_range(entries, path, sq, out, 20)
+                        self.assertEqual(out.getvalue(), 'non-ascii')
+
+                self.assertRaises(materialization.ExtractError,
+                                  lambda: materialization.extract_range(manifest, 'nonexistent', sq,
+                                                                        StringIO.StringIO(), 20))
+                self.assertRaises(materialization.ExtractError,
+                                  lambda: materialization.extract_range(manifest, 'dir', sq,
+                                                                        StringIO.StringIO(), 20))
+                self.assertRaises(materialization.ExtractError,
+                                  lambda: materialization.extract_range(manifest, 'dir/subdir/large', sq,
+                                                                        StringIO.StringIO(), 7))
+
+    def assertFailsPromptly(self, fn):
+        '''Assert that fn(csq) raises OperationHasFailed, and that no
+        operation enqueued via csq is left waiting.'''
+        with storagequeue.StorageQueue(lambda: self.make_backend(), CONCURRENCY) as sq:
+            csq = CountingStorageQueue(sq)
+            result = []
+            def run():
+                try:
+                    fn(csq)
+                    result.append(None)
+                except Exception, e:
+                    result.append(e)
+            t = threading.Thread(target=run)
+            t.setDaemon(True)
+            t.start()
+            t.join(10)
+            self.assertFalse(t.isAlive(), 'still waiting for blocks after a failure')
+            self.assertTrue(isinstance(result[0], storagequeue.OperationHasFailed), result[0])
+
+            deadline = time.time() + 10
+            while not all([ op.is_done() for op in csq.ops ]) and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertEqual([ op for op in csq.ops if not op.is_done() ], [])
+
+    def test_failed_block(self):
+        # a block in the middle of a file fails to be fetched; the
+        # blocks following it must not wait for it forever
+        with storagequeue.StorageQueue(lambda: self.make_backend(), CONCURRENCY) as sq:
+            with self.fs.tempdir() as tdir:
+                self.populate(tdir.path)
+                manifest = self.persist(sq, tdir.path)
+        hashes = dict([ (path, hashes) for path, meta, hashes in manifest ])['dir/subdir/large']
+        self.backend.delete(hashes[5][1])
+
+        self.assertFailsPromptly(lambda sq: materialization.extract_range(manifest, 'dir/subdir/large',
+                                                                          sq, StringIO.StringIO(), 20))
+        self.assertFailsPromptly(lambda sq: materialization.materialize_to_tar(manifest, sq,
+                                                                               StringIO.StringIO()))
+        with self.fs.tempdir() as rdir:
+            self.assertFailsPromptly(lambda sq: materialization.materialize(self.fs, rdir.path, manifest, sq))
+
+    def test_to_tar(self):
+        with storagequeue.StorageQueue(lambda: self.make_backend(), CONCURRENCY) as sq:
+            with self.fs.tempdir() as tdir:
+                self.populate(tdir.path)
+                self.fs.symlink('small', self.path(tdir.path, 'dir/link'))
+                self.fs.chmod(self.path(tdir.path, 'dir/small'), 0640)
+                self.fs.utime(self.path(tdir.path, 'dir/small'), 1000, 2000)
+                manifest = self.persist(sq, tdir.path)
+
+                out = StringIO.StringIO()
+                materialization.materialize_to_tar(manifest, sq, out)
+                self.assertEqual(len(out.getvalue()) % tarfile.RECORDSIZE, 0)
+
+                tf = tarfile.open(fileobj=StringIO.StringIO(out.getvalue()), mode='r')
+                members = tf.getmembers()
+                self.assertEqual([ m.name for m in members ], [ path for path, meta, hashes in manifest ])
+                for m in members:
+                    path = self.path(tdir.path, m.name)
+                    meta = self.fs.lstat(path)
+                    self.assertEqual(m.mtime, meta.mtime)
+                    if m.issym():
+                        self.assertEqual(m.linkname, 'small')
+                        continue
+                    self.assertEqual(m.mode, md.mode_to_bits(meta))
+                    if m.isdir():
+                        self.assertTrue(meta.is_directory)
+                    else:
+                        self.assertEqual(tf.extractfile(m).read(), self.read(path))
+                self.assertEqual(tf.getmember('dir/small').mode, 0640)
+
+                # selective
+                out = StringIO.StringIO()
+                materialization.materialize_to_tar(manifest, sq, out, files=[ 'dir/subdir' ])
+                tf = tarfile.open(fileobj=StringIO.StringIO(out.getvalue()), mode='r')
+                self.assertEqual(tf.getnames(), [ 'dir', 'dir/subdir', 'dir/subdir/large' ])
+
+    def test_block_cache(self):
+        with storagequeue.StorageQueue(lambda: self.make_backend(), CONCURRENCY) as sq:
+            with self.fs.tempdir() as tdir:
+                # three identical files of two blocks each, plus a
+                # file sharing one of the blocks
+                self.fs.mkdir(self.path(tdir.path, 'dir'))
+                for name, body in [ ('dir/a', 'x' * 20 + 'y' * 20),
+                                    ('dir/b', 'x' * 20 + 'y' * 20),
+                                    ('dir/c', 'x' * 20 + 'y' * 20),
+                                    ('d', 'x' * 20 + 'z' * 5) ]:
+                    with self.fs.open(self.path(tdir.path, name), 'w') as f:
+                        f.write(body)
+                manifest = self.persist(sq, tdir.path)
+
+                for positional in [ False, True ]:
+                    with self.fs.tempdir() as rdir:
+                        with blockcache.BlockCache(blockcache.count_references(manifest),
+                                                   max_disk=0) as cache:
+                            materialization.materialize(self.fs, rdir.path, manifest, sq,
+                                                        positional=positional, blocksize=20,
+                                                        block_cache=cache)
+                            self.assertEqual(cache.misses, 3)
+                            self.assertEqual(cache.hits, 5)
+                        self.assertSameTree(tdir.path, rdir.path)
+
+    def test_shard_spool(self):
+        entries = [ (u'dir/f\xe5il w', md.FileMetaData.from_string('-rw-r--r-- 5 6 7 8 9 10'),
+                     [ ('sha512', 'ab' * 64), ('sha512', 'cd' * 64) ]),
+                    (u'dir/empty', md.FileMetaData.from_string('-rw-r--r-- 5 6 0 8 9 10'), []),
+                    (u'dir/link', md.FileMetaData.from_string("lrwxrwxrwx 5 6 7 8 9 10 '../a%20b'"), []) ]
+        with materialization.ShardSpool(2) as spool:
+            for entry in entries:
+                spool.add(*entry)
+            spool.finish()
+
+            for shard in (0, 1):
+                expected = [ (path, meta.to_string(), hashes) for path, meta, hashes in entries
+                             if materialization.shard_of(path, 2) == shard ]
+                for n in (0, 1): # readable more than once
+                    self.assertEqual([ (path, meta.to_string(), hashes)
+                                       for path, meta, hashes in spool.entries(shard) ], expected)
+
+    def test_blocks_fit(self):
+        self.assertTrue(materialization.blocks_fit(0, 0, 20))
+        self.assertTrue(materialization.blocks_fit(20, 1, 20))
+        self.assertTrue(materialization.blocks_fit(21, 2, 20))
+        self.assertFalse(materialization.blocks_fit(20, 2, 20))
+        self.assertFalse(materialization.blocks_fit(41, 2, 20))
+
 class MemoryTests(MaterializationBaseCase, unittest.TestCase):
     def make_file_system(self):
         return fs.MemoryFileSystem()
@@ -112,6 +600,55 @@ class LocalFileSystemTests(MaterializationBaseCase, unittest.TestCase):
     def make_backend(self):
         return directorybackend.DirectoryBackend(self.tempdir)
 
+    def test_sharded(self):
+        # child processes cannot write to a memory file system, hence
+        # only tested here
+        with storagequeue.StorageQueue(lambda: self.make_backend(), CONCURRENCY) as sq:
+            with self.fs.tempdir() as tdir:
+                self.populate(tdir.path)
+                self.fs.symlink('small', self.path(tdir.path, 'dir/link'))
+                self.fs.chmod(self.path(tdir.path, 'dir/subdir'), 0700)
+                self.fs.utime(self.path(tdir.path, 'dir/subdir'), 1000, 1000)
+                manifest = self.persist(sq, tdir.path)
+
+                with self.fs.tempdir() as rdir:
+                    caches = []
+                    def cache_factory(entries):
+                        caches.append(None)
+                        return blockcache.BlockCache(blockcache.count_references(entries))
+                    reads = []
+                    def entries_factory():
+                        reads.append(None)
+                        return iter(manifest)
+                    materialization.materialize_sharded(self.fs, rdir.path,
+                                                        entries_factory,
+                                                        lambda: storagequeue.StorageQueue(lambda: self.make_backend(),
+                                                                                          CONCURRENCY),
+                                                        3,
+                                                        cache_factory=cache_factory,
+                                                        apply_metadata=True,
+                                                        positional=True,
+                                                        blocksize=20)
+                    self.assertSameTree(tdir.path, rdir.path)
+                    self.assertEqual(self.fs.lstat(self.path(rdir.path, 'dir/subdir')).mtime, 1000)
+                    # caches are created in the children
+                    self.assertEqual(caches, [])
+                    # the manifest is read once
+                    self.assertEqual(len(reads), 1)
+
+                # a failing shard fails the whole
+                with self.fs.tempdir() as rdir:
+                    def failing_factory():
+                        raise AssertionError('deliberate failure in child')
+                    self.assertRaises(materialization.ShardFailed,
+                                      lambda: materialization.materialize_sharded(self.fs, rdir.path,
+                                                                                  lambda: manifest,
+                                                                                  failing_factory,
+                                                                                  2))
+
+        self.assertEqual(materialization.shard_of('some/path', 1), 0)
+        self.assertEqual(materialization.shard_of('some/path', 7), materialization.shard_of(u'some/path', 7))
+
 if os.getenv('SHASTITY_UNITTEST_S3_BUCKET') != None:
     class S3Tests(MaterializationBaseCase, unittest.TestCase):
         def make_file_system(self):
@@ -6,7 +6,11 @@ from __future__ import absolute_import
 from __future__ import with_statement
 
 import errno
+import os
 import os.path
+import pickle
+import shutil
+import tempfile
 import unittest
 
 import shastity.metadata as metadata
@@ -40,6 +44,17 @@ class MetaDataTests(unittest.TestCase):
             md.user_write = False
         self.assertRaises(AssertionError, assign_test)
 
+    def test_parsed(self):
+        md = metadata.FileMetaData.from_string('-rwxr-x--- 1 2 3 4 5 6')
+        def assign_test():
+            md.user_write = False
+        self.assertRaises(AssertionError, assign_test)
+
+        # copies with changed properties do not keep the parsed mode string
+        copy = metadata.FileMetaData(props=dict(user_write=False), other=md)
+        self.assertEqual(copy.to_string(), '-r-xr-x--- 1 2 3 4 5 6')
+        self.assertEqual(md.to_string(), '-rwxr-x--- 1 2 3 4 5 6')
+
     def test_init_assignment(self):
         for propname in metadata.FileMetaData.propnames:
             for boolval in [ True, False ]:
@@ -497,6 +512,36 @@ class MetaDataTests(unittest.TestCase):
         self.assertRaises(AssertionError, from_s, 'd!wxr-xr-x 5 6 7 8 9 10')
         self.assertRaises(AssertionError, from_s, '!rwxr-xr-x 5 6 7 8 9 10')
 
+    def test_mode_bits(self):
+        def conv(s, bits):
+            d = metadata.str_to_mode(s)
+            self.assertEqual(metadata.mode_to_bits(d), bits)
+            for prop, val in metadata.bits_to_mode(bits).iteritems():
+                self.assertEqual(d[prop], val)
+
+        conv('drwxr-xr-x', 0755)
+        conv('-rw-r-----', 0640)
+        conv('-rwsr-sr-T', 07754)
+        conv('drwxrwxrwt', 01777)
+        conv('----------', 0)
+
+    def test_mode_tables(self):
+        for char in '-bcdlp':
+            for bits in xrange(0, 4096):
+                d = metadata.str_to_mode(char + '---------')
+                d.update(metadata.bits_to_mode(bits))
+                s = metadata.mode_to_str(d)
+
+                md = metadata.FileMetaData(d, other=metadata.FileMetaData.from_string('-rw-r--r-- 1 2 3 4 5 6'))
+                if char == 'l':
+                    md = metadata.FileMetaData(dict(symlink_value=u'target'), other=md)
+                self.assertEqual(md.to_string().split(' ')[0], s)
+
+                parsed = metadata.FileMetaData.from_string(md.to_string())
+                for prop, val in d.iteritems():
+                    self.assertEqual(parsed[prop], val)
+                self.assertEqual(parsed.to_string(), md.to_string())
+
     def test_symlink_special_cases(self):
         def conv(s):
             md = metadata.FileMetaData.from_string(s)
@@ -513,5 +558,42 @@ class MetaDataTests(unittest.TestCase):
         self.assertRaises(AssertionError, conv, "drwxr-xr-x 5 6 7 8 9 10 '/path'")
         self.assertRaises(AssertionError, conv, "lrwxr-xr-x 5 6 7 8 9 10")
 
+    def test_stat_metadata(self):
+        tempdir = tempfile.mkdtemp(suffix='-shastity_metadata_unittest')
+        try:
+            fpath = os.path.join(tempdir, 'file')
+            with open(fpath, 'w') as f:
+                f.write('contents')
+            os.chmod(fpath, 04751)
+            lpath = os.path.join(tempdir, 'link')
+            os.symlink('file', lpath)
+
+            def check(path, mode):
+                st = os.lstat(path)
+                md = metadata.StatMetaData.from_stat(st, os.readlink(path) if os.path.islink(path) else None)
+                self.assertEqual(md.to_string().split(' ')[0], mode)
+                self.assertEqual((md.uid, md.gid, md.size, md.mtime), (st.st_uid, st.st_gid, st.st_size, int(st.st_mtime)))
+
+                # same properties as the equivalent FileMetaData
+                fmd = metadata.FileMetaData.from_string(md.to_string())
+                for prop in metadata.FileMetaData.propnames:
+                    self.assertEqual(md[prop], getattr(fmd, prop))
+                self.assertEqual(metadata.FileMetaData(other=md).to_string(), md.to_string())
+                self.assertRaises(KeyError, lambda: md['st_mode_nonexistent'])
+
+                def assign_test():
+                    md.user_write = False
+                self.assertRaises(AssertionError, assign_test)
+                self.assertFalse(hasattr(md, '__dict__'))
+
+                self.assertEqual(pickle.loads(pickle.dumps(md, 2)).to_string(), md.to_string())
+
+            check(fpath, '-rwsr-x--x')
+            check(lpath, 'lrwxrwxrwx')
+            os.chmod(tempdir, 01750)
+            check(tempdir, 'drwxr-x--T')
+        finally:
+            shutil.rmtree(tempdir)
+
 if __name__ == "__main__":
     unittest.main()
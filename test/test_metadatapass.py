@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2009 Peter Schuller <peter.schuller@infidyne.com>
+
+from __future__ import absolute_import
+from __future__ import with_statement
+
+import os.path
+import threading
+import unittest
+
+import shastity.filesystem as fs
+import shastity.metadata as metadata
+import shastity.metadatapass as metadatapass
+
+class MetadataPassBaseCase(object):
+    def setUp(self):
+        self.fs = self.make_file_system() # provided by subclass
+
+    def md(self, modestr, mtime):
+        return metadata.FileMetaData.from_string('%s 0 0 0 %d %d %d' % (modestr, mtime - 1, mtime, mtime))
+
+    def test_apply(self):
+        with self.fs.tempdir() as tdir:
+            a = os.path.join(tdir.path, 'a')
+            b = os.path.join(a, 'b')
+            f = os.path.join(b, 'f')
+            self.fs.mkdir(a)
+            self.fs.mkdir(b)
+            self.fs.open(f, 'w').close()
+
+            with metadatapass.MetadataSpool() as spool:
+                # directories come first in manifests; apply() must still
+                # not touch them until their contents are done
+                spool.add(a, self.md('drwxr-x---', 1000), 0)
+                spool.add(b, self.md('dr-x------', 2000), 1)
+                spool.add(f, self.md('-r--r--r--', 3000), 2)
+                self.assertEqual(spool.count, 3)
+
+                spool.apply(self.fs, threads=3)
+
+            for path, bits, mtime in [ (a, 0750, 1000),
+                                       (b, 0500, 2000),
+                                       (f, 0444, 3000) ]:
+                md = self.fs.lstat(path)
+                self.assertEqual(metadata.mode_to_bits(md), bits)
+                self.assertEqual(md.atime, mtime - 1)
+                self.assertEqual(md.mtime, mtime)
+
+            self.fs.chmod(b, 0700) # allow cleanup
+
+class LocalFileSystemTests(MetadataPassBaseCase, unittest.TestCase):
+    def make_file_system(self):
+        return fs.LocalFileSystem()
+
+class MemoryFileSystemTests(MetadataPassBaseCase, unittest.TestCase):
+    def make_file_system(self):
+        return fs.MemoryFileSystem()
+
+class RunParallelTests(unittest.TestCase):
+    def test_run_parallel(self):
+        seen = []
+        lock = threading.Lock()
+        def func(item):
+            with lock:
+                seen.append(item)
+        metadatapass.run_parallel(func, xrange(0, 1000), 4)
+        self.assertEqual(sorted(seen), range(0, 1000))
+
+    def test_errors(self):
+        def func(item):
+            if item == 500:
+                raise ValueError(item)
+        self.assertRaises(ValueError, lambda: metadatapass.run_parallel(func, xrange(0, 1000), 4))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2009 Peter Schuller <peter.schuller@infidyne.com>
+
+from __future__ import absolute_import
+from __future__ import with_statement
+
+import unittest
+
+import shastity.pathindex as pathindex
+
+class PathIndexTests(unittest.TestCase):
+    def test_lookup(self):
+        builder = pathindex.IndexBuilder()
+        paths = [ u'dir%d/f\xe5il%d' % (n / 100, n) for n in xrange(0, 1000) ]
+        for n, path in enumerate(paths):
+            builder.add(path, n / 100, n % 100)
+        self.assertEqual(len(builder), 1000)
+
+        index = pathindex.PathIndex(builder.index())
+        self.assertEqual(len(index), 1000)
+        for n, path in enumerate(paths):
+            self.assertEqual(index.lookup(path), [ (n / 100, n % 100) ])
+            self.assertEqual(index.lookup(path.encode('utf-8')), [ (n / 100, n % 100) ])
+        self.assertEqual(index.lookup(u'dir0/missing'), [])
+
+        # duplicate keys yield all candidates
+        builder.add(paths[0], 7, 42)
+        index = pathindex.PathIndex(builder.index())
+        self.assertEqual(sorted(index.lookup(paths[0])), [ (0, 0), (7, 42) ])
+
+        self.assertRaises(pathindex.PathIndexError, lambda: pathindex.PathIndex('garbage'))
+        self.assertRaises(pathindex.PathIndexError, lambda: pathindex.PathIndex(builder.index()[:-1]))
+
+    def test_runs(self):
+        # records sorted in many runs produce the same objects
+        builders = [ pathindex.IndexBuilder(), pathindex.IndexBuilder(run_records=64) ]
+        for n in xrange(0, 1000):
+            for builder in builders:
+                builder.add(u'f%d' % ((n * 7919) % 1000,), n / 100, n % 100)
+        self.assertEqual(builders[0].index(), builders[1].index())
+        self.assertEqual(builders[0].bloom().to_string(), builders[1].bloom().to_string())
+        for builder in builders:
+            self.assertEqual(len(builder), 1000)
+            builder.close()
+
+    def test_empty(self):
+        builder = pathindex.IndexBuilder()
+        self.assertEqual(pathindex.PathIndex(builder.index()).lookup(u'x'), [])
+        self.assertFalse(pathindex.BloomFilter.from_string(builder.bloom().to_string()).might_contain(u'x'))
+
+    def test_bloom(self):
+        builder = pathindex.IndexBuilder()
+        for n in xrange(0, 1000):
+            builder.add(u'present%d' % (n,), 0, n)
+        bf = pathindex.BloomFilter.from_string(builder.bloom().to_string())
+
+        for n in xrange(0, 1000):
+            self.assertTrue(bf.might_contain(u'present%d' % (n,)))
+
+        false_positives = len([ n for n in xrange(0, 10000) if bf.might_contain(u'absent%d' % (n,)) ])
+        self.assertTrue(false_positives < 300, false_positives) # ~1% expected
+
+        self.assertRaises(pathindex.PathIndexError,
+                          lambda: pathindex.BloomFilter.from_string(bf.to_string()[:-1]))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -35,6 +35,9 @@ class PersistenceBaseCase(object):
         self.backend = self.make_backend() # provided by subclass
 
     def tearDown(self):
+        # the memory backend shares its storage across instances
+        for name in self.backend.list():
+            self.backend.delete(name)
         shutil.rmtree(self.tempdir)
 
     def path(self, base, p):
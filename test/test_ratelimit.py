@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2009 Peter Schuller <peter.schuller@infidyne.com>
+
+from __future__ import absolute_import
+from __future__ import with_statement
+
+import threading
+import time
+import unittest
+
+import shastity.ratelimit as ratelimit
+
+class TokenBucketTests(unittest.TestCase):
+    def test_unlimited(self):
+        bucket = ratelimit.TokenBucket()
+        start = time.time()
+        for n in xrange(0, 1000):
+            bucket.consume(1024 * 1024)
+        self.assertTrue(time.time() - start < 1.0)
+
+    def test_rate(self):
+        bucket = ratelimit.TokenBucket(rate=100, burst=10)
+        start = time.time()
+        for n in xrange(0, 30):
+            bucket.consume(1)
+        elapsed = time.time() - start
+        self.assertTrue(elapsed >= 0.15, 'too fast: %s' % (elapsed,))
+        self.assertTrue(elapsed < 1.0, 'too slow: %s' % (elapsed,))
+
+    def test_debt(self):
+        bucket = ratelimit.TokenBucket(rate=100, burst=100)
+        bucket.charge(150) # 100 available, puts us 50 in debt
+        start = time.time()
+        bucket.wait()
+        elapsed = time.time() - start
+        self.assertTrue(elapsed >= 0.4, 'too fast: %s' % (elapsed,))
+
+    def test_set_rate_wakes_waiters(self):
+        bucket = ratelimit.TokenBucket(rate=1, burst=1)
+        bucket.charge(1000)
+
+        done = []
+        def waiter():
+            bucket.wait()
+            done.append(True)
+        t = threading.Thread(target=waiter)
+        t.start()
+
+        time.sleep(0.1)
+        self.assertFalse(done)
+        bucket.set_rate(None)
+        t.join(2.0)
+        self.assertTrue(done)
+
+    def test_wait_timeout(self):
+        bucket = ratelimit.TokenBucket(rate=1, burst=1)
+        bucket.charge(1000)
+
+        start = time.time()
+        self.assertFalse(bucket.wait(timeout=0.2))
+        elapsed = time.time() - start
+        self.assertTrue(0.15 <= elapsed < 1.0, 'bad timeout: %s' % (elapsed,))
+
+        bucket.set_rate(None)
+        self.assertTrue(bucket.wait(timeout=0.2))
+
+class ParseTests(unittest.TestCase):
+    def test_parse_limits(self):
+        self.assertEqual(ratelimit.parse_limits('up=512k down=2M ops=50'),
+                         ratelimit.RateLimits(upload=512 * 1024, download=2 * 1024 * 1024, ops=50))
+        self.assertEqual(ratelimit.parse_limits('up=10'), ratelimit.RateLimits(upload=10))
+        self.assertEqual(ratelimit.parse_limits(''), ratelimit.UNLIMITED)
+        self.assertRaises(ratelimit.RateLimitParseError, lambda: ratelimit.parse_limits('up=fast'))
+        self.assertRaises(ratelimit.RateLimitParseError, lambda: ratelimit.parse_limits('sideways=5'))
+
+    def test_schedule(self):
+        default = ratelimit.RateLimits(upload=1)
+        sched = ratelimit.parse_schedule('08:00-18:00 up=2; 22:00-06:00 up=3', default=default)
+
+        def at(hour, minute):
+            tm = time.localtime()
+            return time.mktime((tm.tm_year, tm.tm_mon, tm.tm_mday, hour, minute, 0, 0, 0, -1))
+
+        self.assertEqual(sched.limits_at(at(12, 0)).upload, 2)
+        self.assertEqual(sched.limits_at(at(8, 0)).upload, 2)
+        self.assertEqual(sched.limits_at(at(18, 0)).upload, 1)
+        self.assertEqual(sched.limits_at(at(23, 30)).upload, 3)
+        self.assertEqual(sched.limits_at(at(3, 0)).upload, 3)
+        self.assertEqual(sched.limits_at(at(7, 59)).upload, 1)
+
+        self.assertRaises(ratelimit.RateLimitParseError, lambda: ratelimit.parse_schedule('8-18 up=1'))
+
+        # hours end at 23, except for the end of the day
+        sched = ratelimit.parse_schedule('18:00-24:00 up=2; 00:00-23:59 up=3', default=default)
+        self.assertEqual(sched.limits_at(at(23, 59)).upload, 2)
+        self.assertEqual(sched.limits_at(at(0, 0)).upload, 3)
+        for bad in ('24:00-06:00', '22:00-24:01', '22:00-24:59', '25:00-06:00', '22:00-23:60'):
+            self.assertRaises(ratelimit.RateLimitParseError, lambda: ratelimit.parse_schedule(bad + ' up=1'))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2009 Peter Schuller <peter.schuller@infidyne.com>
+
+from __future__ import absolute_import
+from __future__ import with_statement
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import shastity.backends.directorybackend as directorybackend
+import shastity.manifest as manifest
+import shastity.metadata as md
+import shastity.refindex as refindex
+
+def block(n):
+    return ('sha512', '%0128x' % (n,))
+
+def make_entries(blocks):
+    return [ (u'f%d' % (n,), md.FileMetaData.from_string('-rw-r--r-- 0 0 1 0 0 0'), [ block(b) ])
+             for n, b in enumerate(blocks) ]
+
+class RefindexTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(suffix='-shastity_refindex_unittest')
+        self.backend = directorybackend.DirectoryBackend(self.tempdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def write(self, name, blocks, index=None):
+        entries = make_entries(blocks)
+        manifest.write_manifest(self.backend, name, entries)
+        if index is not None:
+            refindex.write_block_set(self.backend, name, refindex.block_set(entries))
+            index.add(name, refindex.block_set(entries))
+
+    def counts(self):
+        return dict([ (int(hex, 16), count)
+                      for (algo, hex), count in refindex.RefcountIndex(self.backend).counts().iteritems() ])
+
+    def test_add_remove(self):
+        index = refindex.RefcountIndex(self.backend)
+        self.write('one', [ 1, 2, 2, 3 ], index)
+        self.write('two', [ 2, 3, 4 ], index)
+        index.add('two', [ block(5) ]) # already accounted for
+
+        self.assertEqual(self.counts(), { 1: 1, 2: 2, 3: 2, 4: 1 })
+        self.assertEqual(refindex.RefcountIndex(self.backend).manifests(), set([ 'one', 'two' ]))
+        self.assertEqual(sorted(manifest.list_manifests(self.backend)), [ 'one', 'two' ])
+
+        index.delete_manifest('one')
+        self.assertEqual(self.counts(), { 2: 1, 3: 1, 4: 1 })
+        self.assertFalse(refindex.blocks_name('one') in self.backend.list())
+        self.assertEqual(refindex.RefcountIndex(self.backend).referenced(),
+                         set([ block(2), block(3), block(4) ]))
+
+    def test_sync(self):
+        # manifests predating the index
+        self.write('one', [ 1, 2 ])
+        self.write('two', [ 2, 3 ])
+
+        index = refindex.RefcountIndex(self.backend)
+        index.sync()
+        self.assertEqual(self.counts(), { 1: 1, 2: 2, 3: 1 })
+        self.assertTrue(refindex.blocks_name('one') in self.backend.list())
+
+        # a manifest deleted behind the index's back, and one added
+        manifest.delete_manifest(self.backend, 'one')
+        self.write('three', [ 3, 4 ])
+        loaded = []
+        def loader(name):
+            loaded.append(name)
+            return manifest.read_manifest(self.backend, name)
+        refindex.RefcountIndex(self.backend).sync(loader=loader)
+        self.assertEqual(loaded, [ 'three' ])
+        self.assertEqual(self.counts(), { 2: 1, 3: 2, 4: 1 })
+
+        # nothing to do
+        refindex.RefcountIndex(self.backend).sync(loader=None)
+        self.assertEqual(self.counts(), { 2: 1, 3: 2, 4: 1 })
+
+        # without the block set of a deleted manifest, counts are rebuilt
+        manifest.delete_manifest(self.backend, 'two')
+        self.backend.delete(refindex.blocks_name('two'))
+        refindex.RefcountIndex(self.backend).sync()
+        self.assertEqual(self.counts(), { 3: 1, 4: 1 })
+        self.assertEqual(refindex.RefcountIndex(self.backend).manifests(), set([ 'three' ]))
+
+if __name__ == "__main__":
+    unittest.main()
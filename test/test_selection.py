@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2009 Peter Schuller <peter.schuller@infidyne.com>
+
+from __future__ import absolute_import
+from __future__ import with_statement
+
+import unittest
+
+import shastity.selection as selection
+
+class FakeMetadata(object):
+    def __init__(self, is_directory):
+        self.is_directory = is_directory
+
+class SelectionTests(unittest.TestCase):
+    def test_classify(self):
+        sel = selection.PathSelector([ 'a/b/c', 'd', 'e/*.txt', './f/' ])
+
+        self.assertEqual(sel.classify('a'), selection.ANCESTOR)
+        self.assertEqual(sel.classify('a/b'), selection.ANCESTOR)
+        self.assertEqual(sel.classify('a/b/c'), selection.SELECTED)
+        self.assertEqual(sel.classify('a/b/c/x/y'), selection.SELECTED)
+        self.assertEqual(sel.classify('a/b/cc'), selection.EXCLUDED)
+        self.assertEqual(sel.classify('a/x'), selection.EXCLUDED)
+        self.assertEqual(sel.classify('d'), selection.SELECTED)
+        self.assertEqual(sel.classify('dd'), selection.EXCLUDED)
+        self.assertEqual(sel.classify('e'), selection.ANCESTOR)
+        self.assertEqual(sel.classify('e/x.txt'), selection.SELECTED)
+        self.assertEqual(sel.classify('e/x.txt.gz'), selection.EXCLUDED)
+        self.assertEqual(sel.classify('e/sub/x.txt'), selection.EXCLUDED)
+        self.assertEqual(sel.classify('f'), selection.SELECTED)
+
+    def test_metacharacters(self):
+        # regular expression metacharacters are not special
+        sel = selection.PathSelector([ 'a+b/c.d' ])
+        self.assertEqual(sel.classify('a+b/c.d'), selection.SELECTED)
+        self.assertEqual(sel.classify('aab/cxd'), selection.EXCLUDED)
+
+    def test_filter_entries(self):
+        d = FakeMetadata(True)
+        f = FakeMetadata(False)
+        entries = [ ('a', d),
+                    ('a/b', d),
+                    ('a/b/x', f),
+                    ('a/c', d),
+                    ('a/c/y', f),
+                    ('a/c/z', d),
+                    ('a/c/z/w', f),
+                    ('a/d', f),
+                    ('ab', d),
+                    ('ab/x', f),
+                    ('b', f) ]
+        sel = selection.PathSelector([ 'a/c', 'a/d' ])
+        result = [ (path, state) for path, md, hashes, state
+                   in selection.filter_entries(sel, [ (path, md, []) for path, md in entries ]) ]
+        self.assertEqual(result, [ ('a', selection.ANCESTOR),
+                                   ('a/c', selection.SELECTED),
+                                   ('a/c/y', selection.SELECTED),
+                                   ('a/c/z', selection.SELECTED),
+                                   ('a/c/z/w', selection.SELECTED),
+                                   ('a/d', selection.SELECTED) ])
+
+    def test_literal_paths(self):
+        self.assertTrue(selection.is_literal('a/b/c'))
+        self.assertFalse(selection.is_literal('a/*/c'))
+        self.assertFalse(selection.is_literal('a/b[cd]'))
+        self.assertEqual(selection.normalize('/a//b/./c/'), 'a/b/c')
+        self.assertEqual(selection.ancestors('a/b/c'), [ 'a', 'a/b' ])
+        self.assertEqual(selection.ancestors('a'), [])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -5,10 +5,48 @@
 from __future__ import absolute_import
 from __future__ import with_statement
 
+import random
 import unittest
 
 import shastity.spencode as sp
 
+# The original, character by character, implementation of the encoding;
+# the reference for the differential tests.
+def ref_urlenc(s):
+    return ''.join([ sp._enc_map[c] for c in s ])
+
+def ref_urldec(s):
+    parts = s.split('%')
+    for i in xrange(1, len(parts)):
+        assert len(parts[i]) >= 2, 'broken string, expected hex after %%: %s' % (s,)
+        unhexed = chr(int(parts[i][0] + parts[i][1], 16))
+        parts[i] = unhexed + parts[i][2:]
+    return ''.join(parts)
+
+def ref_spencode(s):
+    if isinstance(s, unicode):
+        s = s.encode('utf-8')
+    return "'%s'" % (ref_urlenc(s),)
+
+def corpus():
+    '''@return A list of character strings exercising the fast paths and
+    fallbacks of the encoding.'''
+    strings = [ u'', u'w', u'%', u'%%', u'%25', u"'", u'a b', u'www/new window',
+                u'home/user/dir/file.txt', u'100% done/file 5%.txt',
+                u'\xe5\xe4\xf6', u'j\xf6rg/\xc5ngstr\xf6m/f\xe5il w.txt',
+                u'\u20ac \u4e2d\u6587 \U0001d11e' ]
+    strings.extend([ unichr(n) for n in xrange(0, 512) ])
+
+    rnd = random.Random(4711)
+    alphabets = [ sp._safechars,
+                  sp._safechars + ' w%',
+                  ''.join([ chr(n) for n in xrange(0, 128) ]),
+                  u'ab/ \xe5\u20ac%w\'' ]
+    for alphabet in alphabets:
+        for n in xrange(0, 500):
+            strings.append(u''.join([ unicode(rnd.choice(alphabet)) for m in xrange(0, rnd.randint(0, 40)) ]))
+    return strings
+
 class SpencodeTests(unittest.TestCase):
 
     def conv(self, s):
@@ -49,5 +87,25 @@ class SpencodeTests(unittest.TestCase):
         for b in all_bytes:
             self.assertEqual(b, sp._urldec(sp._urlenc(b)))
 
+    def test_differential(self):
+        strings = corpus()
+        encoded = [ ref_spencode(s) for s in strings ]
+
+        self.assertEqual([ sp.spencode(s) for s in strings ], encoded)
+        self.assertEqual([ sp.spencode(s.encode('utf-8')) for s in strings ], encoded)
+        self.assertEqual(sp.spencode_many(strings), encoded)
+        self.assertEqual(sp.spencode_many(strings[0:1]), encoded[0:1])
+        self.assertEqual(sp.spencode_many([]), [])
+        self.assertEqual([ sp.spdecode(e) for e in encoded ], strings)
+
+        # escapes are decoded in either case
+        for e in encoded:
+            lower = e.lower()
+            self.assertEqual(sp._urldec(lower), ref_urldec(lower))
+
+        all_bytes = ''.join([ chr(n) for n in xrange(0, 256) ])
+        self.assertEqual(sp._urlenc(all_bytes), ref_urlenc(all_bytes))
+        self.assertRaises(AssertionError, sp._urldec, 'abc%4')
+
 if __name__ == "__main__":
     unittest.main()
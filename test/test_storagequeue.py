@@ -8,6 +8,8 @@ from __future__ import with_statement
 import os
 import shutil
 import tempfile
+import threading
+import time
 import unittest
 
 import shastity.backend as backend
@@ -15,6 +17,7 @@ import shastity.backends.directorybackend as directorybackend
 import shastity.backends.memorybackend as memorybackend
 import shastity.backends.s3backend as s3backend
 import shastity.logging as logging
+import shastity.ratelimit as ratelimit
 import shastity.storagequeue as storagequeue
 
 log = logging.get_logger(__name__)
@@ -51,7 +54,11 @@ class StorageQueueBaseCase(object):
                 backend.delete(fname)
 
     def tearDown(self):
-        pass
+        # Other tests share the memory backend's storage, so leave
+        # nothing behind.
+        with self.make_backend() as backend:
+            for fname in self.get_testfiles(backend):
+                backend.delete(fname)
 
     def get_testfiles(self, backend):
         return [ name for name in backend.list() if name.startswith(PREFIX)]
@@ -110,14 +117,16 @@ class StorageQueueBaseCase(object):
         with logging.FakeLogger(storagequeue, 'log'):
             with storagequeue.StorageQueue(lambda: self.make_backend(), CONCURRENCY) as sq:
                 p1 = storagequeue.PutOperation(prefix('test1'), 'data')
+                failures = []
                 g1 = storagequeue.GetOperation(prefix('test1'))
-                g2 = storagequeue.GetOperation(prefix('test2'))
+                g2 = storagequeue.GetOperation(prefix('test2'), errback=failures.append)
 
                 sq.enqueue(p1)
                 sq.enqueue(g1)
                 sq.enqueue(g2)
 
                 self.assertRaises(storagequeue.OperationHasFailed, sq.wait)
+                self.assertEqual(len(failures), 1)
 
     def test_bad_put_fail(self):
         class FailingPut(storagequeue.PutOperation):
@@ -132,6 +141,56 @@ class StorageQueueBaseCase(object):
 
                 self.assertRaises(storagequeue.OperationHasFailed, sq.wait)
 
+    def test_failing_callback(self):
+        def callback(data):
+            raise AssertionError('callback failed for unit testing purposes')
+
+        with logging.FakeLogger(storagequeue, 'log'):
+            with storagequeue.StorageQueue(lambda: self.make_backend(), CONCURRENCY) as sq:
+                failures = []
+                p1 = storagequeue.PutOperation(prefix('test1'), 'data', callback, failures.append)
+
+                sq.enqueue(p1)
+
+                self.assertRaises(storagequeue.OperationHasFailed, sq.wait)
+                self.assertEqual(len(failures), 1)
+                self.assertTrue('callback failed' in failures[0])
+                self.assertTrue(p1.is_done())
+                self.assertFalse(p1.succeeded())
+                self.assertRaises(AssertionError, p1.value)
+
+    def test_work_behind_failure(self):
+        class FailingDelete(storagequeue.DeleteOperation):
+            def execute(self, backend):
+                raise AssertionError('delete failed for unit testing purposes')
+
+        with logging.FakeLogger(storagequeue, 'log'):
+            with storagequeue.StorageQueue(lambda: self.make_backend(), CONCURRENCY,
+                                           small_op_bytes=64) as sq:
+                # uploads held in their gate by the upload limit
+                sq.set_rate_limits(ratelimit.RateLimits(upload=1024))
+                failures = []
+                puts = [ storagequeue.PutOperation(prefix('large%d' % (n,)), 'x' * 1024,
+                                                   errback=failures.append)
+                         for n in xrange(0, 4) ]
+                for p in puts:
+                    sq.enqueue(p)
+                sq.enqueue(FailingDelete(prefix('test1')))
+
+                # operations not yet started fail rather than never finishing
+                start = time.time()
+                while not puts[-1].is_done() and time.time() - start < 5.0:
+                    time.sleep(0.01)
+                self.assertTrue(puts[-1].is_done(), 'operation dropped without a result')
+                self.assertFalse(puts[-1].succeeded())
+                puts[-1].wait()
+                self.assertTrue(len(failures) > 0)
+
+                self.assertRaises(storagequeue.OperationHasFailed, sq.barrier)
+                self.assertRaises(storagequeue.OperationHasFailed,
+                                  lambda: sq.enqueue(storagequeue.DeleteOperation(prefix('test2'))))
+                self.assertTrue(time.time() - start < 3.0)
+
     def test_bulk_ops(self):
         with storagequeue.StorageQueue(lambda: self.make_backend(), CONCURRENCY) as sq:
             COUNT = 100
@@ -161,6 +220,66 @@ class StorageQueueBaseCase(object):
 
             self.assertEqual([g.value() for g in gets], [ str(n) for n in xrange(0, COUNT) ])
 
+    def test_rate_limits(self):
+        limits = ratelimit.RateLimits(ops=50)
+        with storagequeue.StorageQueue(lambda: self.make_backend(), CONCURRENCY,
+                                       limits=limits) as sq:
+            self.assertEqual(sq.get_rate_limits(), limits)
+
+            start = time.time()
+            for n in xrange(0, 100):
+                sq.enqueue(storagequeue.PutOperation(prefix(str(n)), str(n)))
+            sq.wait()
+            elapsed = time.time() - start
+            self.assertTrue(elapsed >= 0.9, 'rate limit not enforced (%s seconds)' % (elapsed,))
+
+            # lifting the limits on a running queue takes effect immediately
+            sq.set_rate_limits(ratelimit.UNLIMITED)
+            start = time.time()
+            for n in xrange(0, 100):
+                sq.enqueue(storagequeue.GetOperation(prefix(str(n))))
+            sq.wait()
+            self.assertTrue(time.time() - start < 0.9)
+
+    def test_small_uploads_not_delayed(self):
+        limits = ratelimit.RateLimits(upload=1024)
+        with storagequeue.StorageQueue(lambda: self.make_backend(), CONCURRENCY,
+                                       limits=limits, small_op_bytes=64) as sq:
+            start = time.time()
+            for n in xrange(0, 20):
+                sq.enqueue(storagequeue.PutOperation(prefix(str(n)), 'x' * 64))
+            sq.wait()
+            self.assertTrue(time.time() - start < 0.9)
+
+            # a large upload has to pay off the accumulated debt first
+            start = time.time()
+            sq.enqueue(storagequeue.PutOperation(prefix('large'), 'x' * 512))
+            sq.wait()
+            self.assertTrue(time.time() - start >= 0.5)
+
+    def test_gets_not_held_back_by_uploads(self):
+        with storagequeue.StorageQueue(lambda: self.make_backend(), CONCURRENCY,
+                                       small_op_bytes=64) as sq:
+            sq.enqueue(storagequeue.PutOperation(prefix('small'), 'data'))
+            sq.wait()
+
+            sq.set_rate_limits(ratelimit.RateLimits(upload=1024))
+            start = time.time()
+            sq.enqueue(storagequeue.PutOperation(prefix('large1'), 'x' * 1024))
+            sq.enqueue(storagequeue.PutOperation(prefix('large2'), 'x' * 1024))
+
+            # the uploads wait for bandwidth; the GET enqueued behind
+            # them does not
+            g = storagequeue.GetOperation(prefix('small'))
+            sq.enqueue(g)
+            while not g.is_done() and time.time() - start < 5.0:
+                time.sleep(0.01)
+            self.assertTrue(time.time() - start < 0.8, 'GET held back by upload')
+            self.assertEqual(g.value(), 'data')
+
+            sq.wait()
+            self.assertTrue(time.time() - start >= 0.9, 'upload limit not enforced')
+
 class MemoryBackendTests(StorageQueueBaseCase, unittest.TestCase):
     def make_backend(self):
         return memorybackend.MemoryBackend('memory', dict(max_fake_delay=0.1))
@@ -181,6 +300,115 @@ class DirectoryBackendTests(StorageQueueBaseCase, unittest.TestCase):
         log.debug('cleaning temporary directory %s', self.tempdir)
         shutil.rmtree(self.tempdir)
 
+class StallingBackend(memorybackend.MemoryBackend):
+    '''Memory backend whose first GET of a file named 'stall' takes a
+    long time. Keeps track of the largest number of concurrent GETs.'''
+    stalled = []
+    stalled_lock = threading.Lock()
+    concurrent = [ 0, 0 ] # current, max
+
+    def get(self, name):
+        with self.stalled_lock:
+            self.concurrent[0] += 1
+            self.concurrent[1] = max(self.concurrent)
+        try:
+            if name == prefix('stall'):
+                with self.stalled_lock:
+                    first = not self.stalled
+                    self.stalled.append(name)
+                if first:
+                    time.sleep(3.0)
+            return memorybackend.MemoryBackend.get(self, name)
+        finally:
+            with self.stalled_lock:
+                self.concurrent[0] -= 1
+
+class HedgingTests(StorageQueueBaseCase, unittest.TestCase):
+    def make_backend(self):
+        return StallingBackend('memory')
+
+    def test_latency_tracker(self):
+        tracker = storagequeue.LatencyTracker(window=100, min_samples=10)
+        for n in xrange(0, 9):
+            tracker.record(float(n))
+        self.assertEqual(tracker.percentile(50), None)
+
+        for n in xrange(9, 200):
+            tracker.record(float(n))
+        self.assertEqual(tracker.percentile(0), 100.0)
+        self.assertEqual(tracker.percentile(100), 199.0)
+
+    def test_hedged_get(self):
+        del StallingBackend.stalled[:]
+
+        with storagequeue.StorageQueue(lambda: self.make_backend(), CONCURRENCY,
+                                       hedge_percentile=90, hedge_budget=1.0) as sq:
+            names = [ prefix('fast%d' % (n,)) for n in xrange(0, 50) ] + [ prefix('stall') ]
+            for name in names:
+                sq.enqueue(storagequeue.PutOperation(name, name))
+            sq.wait()
+
+            # prime the latency tracker
+            for name in names[:-1]:
+                sq.enqueue(storagequeue.GetOperation(name))
+            sq.wait()
+
+            start = time.time()
+            g = storagequeue.GetOperation(prefix('stall'))
+            sq.enqueue(g)
+            sq.wait()
+
+            self.assertTrue(time.time() - start < 2.0, 'hedge did not take effect')
+            self.assertEqual(g.value(), prefix('stall'))
+            self.assertEqual(len(StallingBackend.stalled), 2)
+
+    def test_hedge_concurrency(self):
+        # hedges take worker slots like any other operation
+        del StallingBackend.stalled[:]
+
+        with storagequeue.StorageQueue(lambda: self.make_backend(), 1,
+                                       hedge_percentile=90, hedge_budget=1.0) as sq:
+            names = [ prefix('fast%d' % (n,)) for n in xrange(0, 30) ]
+            for name in names:
+                sq.enqueue(storagequeue.PutOperation(name, name))
+            sq.enqueue(storagequeue.PutOperation(prefix('stall'), 'data'))
+            sq.wait()
+
+            for name in names:
+                sq.enqueue(storagequeue.GetOperation(name))
+            sq.wait()
+
+            StallingBackend.concurrent[1] = 0
+            g = storagequeue.GetOperation(prefix('stall'))
+            sq.enqueue(g)
+            sq.wait()
+
+            self.assertEqual(g.value(), 'data')
+            self.assertEqual(StallingBackend.concurrent[1], 1)
+            self.assertEqual(len(StallingBackend.stalled), 1) # the hedge found it done
+
+    def test_hedge_budget(self):
+        del StallingBackend.stalled[:]
+
+        with storagequeue.StorageQueue(lambda: self.make_backend(), CONCURRENCY,
+                                       hedge_percentile=90, hedge_budget=0.0) as sq:
+            names = [ prefix('fast%d' % (n,)) for n in xrange(0, 30) ]
+            for name in names:
+                sq.enqueue(storagequeue.PutOperation(name, name))
+            sq.enqueue(storagequeue.PutOperation(prefix('stall'), 'data'))
+            sq.wait()
+
+            for name in names:
+                sq.enqueue(storagequeue.GetOperation(name))
+            sq.wait()
+
+            g = storagequeue.GetOperation(prefix('stall'))
+            sq.enqueue(g)
+            sq.wait()
+
+            self.assertEqual(g.value(), 'data')
+            self.assertEqual(len(StallingBackend.stalled), 1)
+
 if os.getenv('SHASTITY_UNITTEST_S3_BUCKET') != None:
     class S3BackendTests(StorageQueueBaseCase, unittest.TestCase):
         def make_backend(self):